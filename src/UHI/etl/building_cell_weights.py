@@ -0,0 +1,328 @@
+from UHI.config import *
+from UHI.regular_grid import RegularGrid
+
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+"""
+Reusable sparse building x cell weight matrix.
+
+Every grid aggregation of the building metrics computes the building / cell overlaps again: the aggregation SQL in
+citydb_aggregate_building_metrics_to_grid, calculate_grid_overlaps in the QGIS BuildingAnalysisPipeline and the
+gpd.sjoin calls in building_heights.py and roof_area.py. BuildingCellWeights computes the overlaps once, as the share
+of each building footprint that lies in each cell, and keeps them as a sparse matrix in COO form (building position,
+cell position, weight). Aggregating any per-building metric is then one sparse matrix-vector product (a bincount over
+the cell positions), so adding a metric costs milliseconds instead of another round of intersections.
+
+The matrix is cached as an .npz file named after a hash of the grid and a hash of the building set (ids and
+geometries), so it is reused as long as neither changes and recomputed automatically when one of them does.
+
+Pairs are found like in the aggregation SQL: buildings touching a cell without overlapping it get no weight, and
+buildings covered by a single cell get weight 1 without clipping.
+"""
+
+
+WEIGHTS_CACHE_DIR = PROCESSED_DATA_DIR / "building_cell_weights"
+
+
+def _digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def grid_hash(grid, grid_id_column='grid_id'):
+    """Hash of a RegularGrid (its parameters) or a grid GeoDataFrame (cell ids and geometries)"""
+
+    if isinstance(grid, RegularGrid):
+        return _digest(sorted(grid.params().items()))
+
+    return _digest(str(grid.crs), np.asarray(grid[grid_id_column]).astype(str).tobytes(),
+                   *shapely.to_wkb(grid.geometry.values))
+
+
+def building_set_hash(buildings_gdf, id_column='building_objectid'):
+    """Hash of a building set (ids and footprints)"""
+
+    return _digest(str(buildings_gdf.crs), np.asarray(buildings_gdf[id_column]).astype(str).tobytes(),
+                   *shapely.to_wkb(buildings_gdf.geometry.values))
+
+
+def _candidate_pairs_regular(geometries, grid):
+    """(building position, flat cell index) of every cell in each building's bbox range, plus the cell polygons"""
+
+    minx, miny, maxx, maxy = shapely.bounds(geometries).T
+    i_min, i_max, j_min, j_max = grid.bbox_to_cell_range(minx, miny, maxx, maxy)
+
+    ni = np.clip(i_max - i_min + 1, 0, None)
+    nj = np.clip(j_max - j_min + 1, 0, None)
+    counts = ni * nj
+
+    buildings = np.repeat(np.arange(len(geometries), dtype=np.int64), counts)
+    offsets = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = np.repeat(i_min, counts) + offsets // np.repeat(nj, counts)
+    j = np.repeat(j_min, counts) + offsets % np.repeat(nj, counts)
+
+    return buildings, grid.flat_index(i, j), grid.cell_polygons(i, j)
+
+
+def _candidate_pairs_polygons(geometries, cells_gdf):
+    """(building position, cell position) of every building / cell pair whose geometries intersect"""
+
+    buildings, cells = cells_gdf.sindex.query(geometries, predicate="intersects")
+    order = np.lexsort((cells, buildings))
+
+    return buildings[order], cells[order], np.asarray(cells_gdf.geometry.values)[cells[order]]
+
+
+class BuildingCellWeights:
+    """Sparse (building x cell) matrix of footprint area shares in COO form"""
+
+    def __init__(self, building_ids, cell_ids, rows, cols, weights, grid_key=None, building_key=None):
+        self.building_ids = np.asarray(building_ids)
+        self.cell_ids = np.asarray(cell_ids)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.grid_key = grid_key
+        self.building_key = building_key
+
+    def __repr__(self):
+        return (f"BuildingCellWeights({self.n_buildings} buildings x {self.n_cells} cells, {self.nnz} pairs, "
+                f"grid {self.grid_key}, buildings {self.building_key})")
+
+    @property
+    def n_buildings(self):
+        return len(self.building_ids)
+
+    @property
+    def n_cells(self):
+        return len(self.cell_ids)
+
+    @property
+    def nnz(self):
+        return len(self.weights)
+
+    # Building
+
+    @classmethod
+    def compute(cls, buildings_gdf, grid, id_column='building_objectid', grid_id_column='grid_id'):
+        """
+        Compute the weights of a building set on a grid
+
+        Parameters:
+        - buildings_gdf: Building footprints (e.g. fetch_building_metrics_with_geometry) with an id column
+        - grid: RegularGrid (cells in flat index order, ids "cell_{i}_{j}") or grid GeoDataFrame with grid_id_column
+        - id_column: Building id column
+        - grid_id_column: Cell id column of a grid GeoDataFrame
+
+        Returns:
+        - BuildingCellWeights
+        """
+
+        start_time = time.perf_counter()
+
+        if isinstance(grid, RegularGrid):
+            if buildings_gdf.crs is not None and buildings_gdf.crs != grid.crs:
+                raise ValueError(f"Buildings are in {buildings_gdf.crs}, the grid is in {grid.crs}")
+            cell_ids = grid.cell_ids(*grid.all_indices()).astype(str)
+        else:
+            if buildings_gdf.crs != grid.crs:
+                raise ValueError(f"Buildings are in {buildings_gdf.crs}, the grid is in {grid.crs}")
+            cell_ids = np.asarray(grid[grid_id_column]).astype(str)
+
+        geometries = np.asarray(buildings_gdf.geometry.values)
+        building_area = shapely.area(geometries)
+
+        if isinstance(grid, RegularGrid):
+            rows, cols, cell_geometries = _candidate_pairs_regular(geometries, grid)
+        else:
+            rows, cols, cell_geometries = _candidate_pairs_polygons(geometries, grid)
+
+        # Fast path: footprints covered by the cell keep their whole area, only the others are clipped
+        covered = shapely.covered_by(geometries[rows], cell_geometries)
+        weights = np.ones(len(rows))
+        clipped = ~covered
+        weights[clipped] = shapely.area(shapely.intersection(geometries[rows[clipped]],
+                                                             cell_geometries[clipped]))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights[clipped] /= building_area[rows[clipped]]
+
+        keep = (weights > 0) & np.isfinite(weights)
+
+        result = cls(
+            building_ids=np.asarray(buildings_gdf[id_column]),
+            cell_ids=cell_ids,
+            rows=rows[keep],
+            cols=cols[keep],
+            weights=weights[keep],
+            grid_key=grid_hash(grid, grid_id_column),
+            building_key=building_set_hash(buildings_gdf, id_column)
+        )
+
+        print(f"✅ Computed {result.nnz} building-cell weights for {result.n_buildings} buildings in "
+              f"{time.perf_counter() - start_time:.1f}s ({int(covered.sum())} covered by a single cell)")
+
+        return result
+
+    # Cache
+
+    @staticmethod
+    def cache_path(cache_dir, grid_key, building_key):
+        return Path(cache_dir) / f"weights_{grid_key}_{building_key}.npz"
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        building_ids = self.building_ids
+        if building_ids.dtype == object:
+            building_ids = building_ids.astype(str)
+
+        np.savez_compressed(path, building_ids=building_ids, cell_ids=self.cell_ids.astype(str), rows=self.rows,
+                            cols=self.cols, weights=self.weights, grid_key=str(self.grid_key),
+                            building_key=str(self.building_key))
+
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['building_ids'], data['cell_ids'], data['rows'], data['cols'], data['weights'],
+                       grid_key=str(data['grid_key']), building_key=str(data['building_key']))
+
+    @classmethod
+    def load_or_compute(cls, buildings_gdf, grid, cache_dir=WEIGHTS_CACHE_DIR, id_column='building_objectid',
+                        grid_id_column='grid_id'):
+        """
+        Cached weights of a building set on a grid, computed (and cached) when the grid or the buildings changed
+
+        Parameters:
+        - cache_dir: Directory of the .npz files, one per grid hash / building set hash combination
+        - Others: See compute
+        """
+
+        path = cls.cache_path(cache_dir, grid_hash(grid, grid_id_column),
+                              building_set_hash(buildings_gdf, id_column))
+
+        if path.exists():
+            weights = cls.load(path)
+            print(f"✓ Loaded {weights.nnz} building-cell weights from {path}")
+            return weights
+
+        weights = cls.compute(buildings_gdf, grid, id_column=id_column, grid_id_column=grid_id_column)
+        weights.save(path)
+        print(f"✓ Cached weights in {path}")
+
+        return weights
+
+    # Aggregation
+
+    def _building_values(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape[0] != self.n_buildings:
+            raise ValueError(f"Expected one value per building ({self.n_buildings}), got {values.shape[0]}")
+        return np.nan_to_num(values)
+
+    def aggregate(self, values):
+        """
+        Weighted sum per cell (W^T @ values)
+
+        Parameters:
+        - values: Array with one value per building, in the order of building_ids
+
+        Returns:
+        - Array with one value per cell, in the order of cell_ids
+        """
+
+        values = self._building_values(values)
+        return np.bincount(self.cols, weights=self.weights * values[self.rows], minlength=self.n_cells)
+
+    def coverage(self):
+        """Sum of the building shares per cell"""
+
+        return np.bincount(self.cols, weights=self.weights, minlength=self.n_cells)
+
+    def pair_count(self):
+        """Number of buildings overlapping each cell"""
+
+        return np.bincount(self.cols, minlength=self.n_cells)
+
+    def pair_mean(self, values):
+        """Unweighted mean per cell over the overlapping buildings (0 for cells without buildings)"""
+
+        values = self._building_values(values)
+        totals = np.bincount(self.cols, weights=values[self.rows], minlength=self.n_cells)
+        counts = self.pair_count()
+
+        return np.divide(totals, counts, out=np.zeros(self.n_cells), where=counts > 0)
+
+    def aggregate_frame(self, metrics_df, columns, id_column='building_objectid', prefix='grid_total_'):
+        """
+        Weighted sums of several metric columns per cell
+
+        Parameters:
+        - metrics_df: Per-building metrics with id_column (any order, missing buildings count as 0)
+        - columns: Metric columns to aggregate
+
+        Returns:
+        - DataFrame with grid_id and one "{prefix}{column}" column per metric, one row per cell
+        """
+
+        aligned = self._align(metrics_df, columns, id_column)
+
+        return pd.DataFrame({
+            'grid_id': self.cell_ids,
+            **{f"{prefix}{column}": self.aggregate(aligned[column].to_numpy()) for column in columns}
+        })
+
+    def _align(self, metrics_df, columns, id_column):
+        """Metric columns in the order of building_ids (ids compared as strings, missing buildings are NaN)"""
+
+        aligned = metrics_df[list(columns)].set_axis(metrics_df[id_column].astype(str).to_numpy())
+        return aligned.reindex(self.building_ids.astype(str))
+
+
+def aggregate_building_metrics(buildings_gdf, grid, weights=None, cache_dir=WEIGHTS_CACHE_DIR,
+                               id_column='building_objectid', grid_id_column='grid_id'):
+    """
+    Building metrics per cell with the columns of citydb.aggregated_building_metrics_30m
+
+    Parameters:
+    - buildings_gdf: Buildings with id_column, total_roof_area, total_floor_area, total_building_volume,
+                     building_height and geometry
+    - grid: RegularGrid or grid GeoDataFrame
+    - weights: Optional BuildingCellWeights (default: loaded from / computed into cache_dir)
+
+    Returns:
+    - DataFrame with one row per cell (zeros for cells without buildings)
+    """
+
+    if weights is None:
+        weights = BuildingCellWeights.load_or_compute(buildings_gdf, grid, cache_dir=cache_dir, id_column=id_column,
+                                                      grid_id_column=grid_id_column)
+
+    start_time = time.perf_counter()
+    aligned = weights._align(buildings_gdf, ['total_roof_area', 'total_floor_area', 'total_building_volume',
+                                             'building_height'], id_column)
+
+    aggregated_df = pd.DataFrame({
+        'grid_id': weights.cell_ids,
+        'grid_total_roof_area': weights.aggregate(aligned['total_roof_area'].to_numpy()),
+        'grid_total_floor_area': weights.aggregate(aligned['total_floor_area'].to_numpy()),
+        'grid_total_building_volume': weights.aggregate(aligned['total_building_volume'].to_numpy()),
+        'grid_avg_building_height': weights.pair_mean(aligned['building_height'].to_numpy()),
+        'total_building_coverage': weights.coverage(),
+        'building_intersection_count': weights.pair_count()
+    })
+
+    print(f"✅ Aggregated building metrics to {len(aggregated_df)} cells in "
+          f"{(time.perf_counter() - start_time) * 1000:.0f} ms")
+
+    return aggregated_df
@@ -1,7 +1,12 @@
 from UHI.config import *
+from UHI.etl.building_cell_weights import WEIGHTS_CACHE_DIR, aggregate_building_metrics
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 #import geoalchemy2
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import geopandas as gpd
 
@@ -16,12 +21,18 @@ Aggregates / applies
 """
 
 
-def create_db_engine():
+def create_db_engine(pool_size=None):
     """
     Create SQLAlchemy engine for database connection
+
+    Parameters:
+    - pool_size: Optional number of pooled connections (for running statements in parallel)
     """
     connection_string = f"postgresql://{PGADMIN}:{PGADMIN_PASSWORD}@{PGHOST}:5432/{PGCITYDB}"
-    engine = create_engine(connection_string)
+    if pool_size is not None:
+        engine = create_engine(connection_string, pool_size=pool_size, max_overflow=0)
+    else:
+        engine = create_engine(connection_string)
 
     return engine
 
@@ -37,11 +48,13 @@ def fetch_building_metrics_with_geometry():
         bm.total_roof_area,
         bm.total_floor_area,
         bm.total_building_volume,
+        bm.building_height,
         f.envelope as geometry  -- Get geometry directly (already in EPSG:25832)
     FROM 
         building_metrics bm
     JOIN 
         citydb.feature f ON f.objectid = bm.building_objectid
+                         AND f.objectclass_id = 901  -- Only Building features, as in the aggregation SQL
     WHERE 
         bm.building_objectid IS NOT NULL
         AND f.envelope IS NOT NULL;
@@ -208,28 +221,66 @@ def fetch_building_metrics_with_geometry():
 
 #     return result
 
-def create_aggregated_building_metrics_table(grid_gdf):
-    """
-    Create aggregated_building_metrics table in PostGIS with grid_id as primary key
-    Sums all building metrics (which were previously calculated by object) by grid for each grid cell
+def aggregation_select_sql(grid_table="citydb.temp_grid"):
     """
+    SELECT aggregating the building metrics per grid cell
 
-    print("🔧 Creating aggregated building metrics table in PostGIS...")
+    Every building-cell pair found by the index (ST_Intersects) gets its area share in one LATERAL subquery:
+    - buildings that are covered by the cell (the majority on a 30m grid) get 1, without clipping anything
+    - for the others ST_Intersection is evaluated exactly once, instead of once in the SELECT and once in the WHERE
 
-    engine = create_db_engine()
+    The planner would otherwise flatten the subquery and inline the CTE, pasting the CASE into the WHERE and into
+    every SUM (PostgreSQL doesn't reuse common subexpressions). OFFSET 0 keeps the subquery and MATERIALIZED the CTE
+    as separate plan nodes, benchmark_aggregation_sql checks that ST_Intersection is only in one node.
 
-    # Upload grid to temporary PostGIS table in citydb schema
-    grid_gdf.to_postgis('temp_grid', engine, schema='citydb', if_exists='replace', index=False)
+    Same output as legacy_aggregation_select_sql. AVG(allocated_height / area_percentage) there is simply the
+    average building height of the pairs.
+    """
 
-    print("🔧 Calculating aggregated metrics by grid cell...")
+    return f"""
+    WITH weighted_intersections AS MATERIALIZED (
+        SELECT 
+            g.grid_id,
+            bm.total_roof_area,
+            bm.total_floor_area,
+            bm.building_height,
+            bm.total_building_volume,
+            share.area_percentage
+        FROM 
+            citydb.building_metrics bm
+        JOIN 
+            citydb.feature f ON f.objectid = bm.building_objectid 
+                             AND f.objectclass_id = 901  -- CRITICAL: Only join to Building features!
+        JOIN 
+            {grid_table} g ON ST_Intersects(f.envelope, g.geometry)
+        CROSS JOIN LATERAL (
+            SELECT CASE
+                WHEN ST_CoveredBy(f.envelope, g.geometry) THEN 1.0
+                ELSE ST_Area(ST_Intersection(f.envelope, g.geometry)) / NULLIF(ST_Area(f.envelope), 0)
+            END AS area_percentage
+            OFFSET 0  -- Optimisation fence, so the CASE is evaluated once per pair
+        ) share
+        WHERE 
+            bm.building_objectid IS NOT NULL 
+            AND f.envelope IS NOT NULL
+            AND share.area_percentage > 0
+    )
+    SELECT 
+        grid_id,
+        SUM(total_roof_area * area_percentage) as grid_total_roof_area,
+        SUM(total_floor_area * area_percentage) as grid_total_floor_area,
+        SUM(total_building_volume * area_percentage) as grid_total_building_volume,
+        AVG(building_height) as grid_avg_building_height,
+        SUM(area_percentage) as total_building_coverage,
+        COUNT(*) as building_intersection_count
+    FROM weighted_intersections
+    GROUP BY grid_id"""
 
-    # SQL to create the aggregated table
-    sql_create_table = text("""
-    -- Drop table if it exists
-    DROP TABLE IF EXISTS citydb.aggregated_building_metrics_30m;
-    
-    -- Create aggregated building metrics table
-    CREATE TABLE citydb.aggregated_building_metrics_30m AS
+
+def legacy_aggregation_select_sql(grid_table="citydb.temp_grid"):
+    """The previous aggregation query (two ST_Intersection calls per pair), kept as the benchmark baseline"""
+
+    return f"""
     WITH weighted_intersections AS (
         SELECT 
             g.grid_id,
@@ -246,7 +297,7 @@ def create_aggregated_building_metrics_table(grid_gdf):
             citydb.feature f ON f.objectid = bm.building_objectid 
                              AND f.objectclass_id = 901  -- CRITICAL: Only join to Building features!
         JOIN 
-            citydb.temp_grid g ON ST_Intersects(f.envelope, g.geometry)
+            {grid_table} g ON ST_Intersects(f.envelope, g.geometry)
         WHERE 
             bm.building_objectid IS NOT NULL 
             AND f.envelope IS NOT NULL
@@ -272,7 +323,308 @@ def create_aggregated_building_metrics_table(grid_gdf):
         SUM(area_percentage) as total_building_coverage,
         COUNT(*) as building_intersection_count
     FROM allocated_metrics
-    GROUP BY grid_id;
+    GROUP BY grid_id"""
+
+
+def _grid_srid(grid):
+    return int(str(grid.crs).upper().replace("EPSG:", ""))
+
+
+def grid_arithmetic_params(grid, block=None):
+    """
+    Bind parameters of grid_arithmetic_select_sql for a RegularGrid
+
+    Parameters:
+    - block: Optional (i0, j0, nx, ny) block of cells to restrict the query to (default: the whole grid)
+    """
+
+    i0, j0, block_nx, block_ny = block if block is not None else (0, 0, grid.nx, grid.ny)
+    i1 = min(i0 + block_nx, grid.nx) - 1
+    j1 = min(j0 + block_ny, grid.ny) - 1
+
+    return {
+        'origin_x': grid.origin_x,
+        'origin_y': grid.origin_y,
+        'cell_size': grid.cell_size,
+        'i0': int(i0),
+        'i1': int(i1),
+        'j0': int(j0),
+        'j1': int(j1),
+        'block_minx': grid.origin_x + i0 * grid.cell_size,
+        'block_miny': grid.origin_y + j0 * grid.cell_size,
+        'block_maxx': grid.origin_x + (i1 + 1) * grid.cell_size,
+        'block_maxy': grid.origin_y + (j1 + 1) * grid.cell_size,
+        'srid': _grid_srid(grid)
+    }
+
+
+def grid_arithmetic_select_sql():
+    """
+    SELECT aggregating the building metrics per cell of a RegularGrid, without a grid table
+
+    The grid only comes in as bind parameters (see grid_arithmetic_params). The candidate cells of each building are
+    the index range of its envelope bounds (the same arithmetic as RegularGrid.bbox_to_cell_range), expanded with
+    generate_series. Buildings whose bounds lie in a single cell get area_percentage 1, and cell polygons are only
+    built with ST_MakeEnvelope for the buildings that cross cell edges. Cells are full squares with ids
+    "cell_{i}_{j}", and only cells with buildings are returned. As in aggregation_select_sql, the area share is
+    fenced (OFFSET 0, MATERIALIZED) so it is not inlined into the WHERE and every SUM.
+
+    The cells can be restricted to a block (i0..i1, j0..j1). Every building-cell pair belongs to the block of its
+    cell, so running the query for disjoint blocks counts each pair exactly once, also for buildings crossing block
+    edges.
+    """
+
+    return """
+    WITH building_ranges AS (
+        SELECT 
+            bm.total_roof_area,
+            bm.total_floor_area,
+            bm.building_height,
+            bm.total_building_volume,
+            f.envelope,
+            floor((ST_XMin(f.envelope) - :origin_x) / :cell_size)::int AS i_min,
+            floor((ST_YMin(f.envelope) - :origin_y) / :cell_size)::int AS j_min,
+            -- A bbox edge lying exactly on a grid line does not overlap the next cell
+            GREATEST(ceil((ST_XMax(f.envelope) - :origin_x) / :cell_size)::int - 1,
+                     floor((ST_XMin(f.envelope) - :origin_x) / :cell_size)::int) AS i_max,
+            GREATEST(ceil((ST_YMax(f.envelope) - :origin_y) / :cell_size)::int - 1,
+                     floor((ST_YMin(f.envelope) - :origin_y) / :cell_size)::int) AS j_max
+        FROM 
+            citydb.building_metrics bm
+        JOIN 
+            citydb.feature f ON f.objectid = bm.building_objectid 
+                             AND f.objectclass_id = 901  -- CRITICAL: Only join to Building features!
+        WHERE 
+            bm.building_objectid IS NOT NULL 
+            AND f.envelope IS NOT NULL
+            -- Grid / block extent, answered by the spatial index on citydb.feature
+            AND f.envelope && ST_MakeEnvelope(:block_minx, :block_miny, :block_maxx, :block_maxy, :srid)
+    ),
+    weighted_intersections AS MATERIALIZED (
+        SELECT 
+            'cell_' || gi.i || '_' || gj.j AS grid_id,
+            b.total_roof_area,
+            b.total_floor_area,
+            b.building_height,
+            b.total_building_volume,
+            share.area_percentage
+        FROM 
+            building_ranges b
+        CROSS JOIN LATERAL generate_series(GREATEST(b.i_min, :i0), LEAST(b.i_max, :i1)) AS gi(i)
+        CROSS JOIN LATERAL generate_series(GREATEST(b.j_min, :j0), LEAST(b.j_max, :j1)) AS gj(j)
+        CROSS JOIN LATERAL (
+            SELECT CASE
+                WHEN b.i_min = b.i_max AND b.j_min = b.j_max THEN 1.0
+                ELSE ST_Area(ST_Intersection(b.envelope, ST_MakeEnvelope(
+                    :origin_x + gi.i * :cell_size, :origin_y + gj.j * :cell_size,
+                    :origin_x + (gi.i + 1) * :cell_size, :origin_y + (gj.j + 1) * :cell_size, :srid
+                ))) / NULLIF(ST_Area(b.envelope), 0)
+            END AS area_percentage
+            OFFSET 0  -- Optimisation fence, so the CASE is evaluated once per pair
+        ) share
+    )
+    SELECT 
+        grid_id,
+        SUM(total_roof_area * area_percentage) as grid_total_roof_area,
+        SUM(total_floor_area * area_percentage) as grid_total_floor_area,
+        SUM(total_building_volume * area_percentage) as grid_total_building_volume,
+        AVG(building_height) as grid_avg_building_height,
+        SUM(area_percentage) as total_building_coverage,
+        COUNT(*) as building_intersection_count
+    FROM weighted_intersections
+    WHERE area_percentage > 0
+    GROUP BY grid_id"""
+
+
+def zero_fill_aggregated_metrics(aggregated_df, grid_ids):
+    """Restrict aggregated metrics to grid_ids, with zeros for the cells without buildings"""
+
+    filled = aggregated_df.set_index('grid_id').reindex(pd.Index(grid_ids, name='grid_id')).fillna(0)
+    filled['building_intersection_count'] = filled['building_intersection_count'].astype('int64')
+
+    return filled.reset_index()
+
+
+def _intersection_nodes(plan):
+    """Plan nodes (EXPLAIN VERBOSE, FORMAT JSON) whose expressions call ST_Intersection"""
+
+    nodes = []
+
+    def _walk(node):
+        own = {key: value for key, value in node.items() if key != 'Plans'}
+        if 'st_intersection(' in json.dumps(own).lower():
+            nodes.append(node['Node Type'])
+        for child in node.get('Plans', []):
+            _walk(child)
+
+    _walk(plan['Plan'])
+
+    return nodes
+
+
+def benchmark_aggregation_sql(grid_gdf, runs=3, grid=None):
+    """
+    EXPLAIN ANALYZE the legacy and the single-evaluation aggregation query against the local PostGIS
+
+    Parameters:
+    - grid_gdf: Grid with grid_id and geometry (uploaded as citydb.temp_grid)
+    - runs: Runs per query, the first one also warms the cache
+    - grid: Optional RegularGrid of grid_gdf, to also time the grid arithmetic query (without its upload)
+
+    Returns:
+    - DataFrame with query, run, execution_ms and planning_ms, plus a check that both queries agree and the plan
+      nodes evaluating ST_Intersection per query (.attrs['intersection_nodes'], one node = one evaluation per pair)
+    """
+
+    engine = create_db_engine()
+    grid_gdf.to_postgis('temp_grid', engine, schema='citydb', if_exists='replace', index=False)
+
+    queries = {'legacy': legacy_aggregation_select_sql(), 'single_intersection': aggregation_select_sql()}
+    params = {}
+    if grid is not None:
+        queries['grid_arithmetic'] = grid_arithmetic_select_sql()
+        params['grid_arithmetic'] = grid_arithmetic_params(grid)
+    rows = []
+
+    with engine.connect() as conn:
+        conn.execute(text("ANALYZE citydb.temp_grid"))
+
+        intersection_nodes = {}
+        for name, query in queries.items():
+            plan = conn.execute(text(f"EXPLAIN (VERBOSE, FORMAT JSON) {query}"), params.get(name, {})).scalar()
+            intersection_nodes[name] = _intersection_nodes(plan[0] if isinstance(plan, list) else plan)
+            print(f"  {name}: ST_Intersection in {len(intersection_nodes[name])} plan node(s) "
+                  f"{intersection_nodes[name]}")
+
+        for run in range(runs):
+            for name, query in queries.items():
+                plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}"),
+                                    params.get(name, {})).scalar()
+                plan = plan[0] if isinstance(plan, list) else plan
+                rows.append({
+                    'query': name,
+                    'run': run,
+                    'execution_ms': plan['Execution Time'],
+                    'planning_ms': plan['Planning Time']
+                })
+                print(f"  {name} run {run + 1}/{runs}: {plan['Execution Time']:.0f} ms")
+
+        results = {name: pd.read_sql_query(text(query + " ORDER BY grid_id"), conn, params=params.get(name))
+                   for name, query in queries.items()}
+
+    benchmark = pd.DataFrame(rows)
+
+    legacy, new = results['legacy'], results['single_intersection']
+    columns = ['grid_total_roof_area', 'grid_total_floor_area', 'grid_total_building_volume',
+               'total_building_coverage']
+    same_cells = legacy['grid_id'].tolist() == new['grid_id'].tolist()
+    max_difference = (legacy[columns] - new[columns]).abs().max().max() if same_cells else float('nan')
+
+    summary = benchmark.groupby('query')['execution_ms'].median()
+    print(f"✅ Median execution: legacy {summary['legacy']:.0f} ms, "
+          f"single intersection {summary['single_intersection']:.0f} ms "
+          f"({summary['legacy'] / summary['single_intersection']:.1f}x)")
+    if grid is not None:
+        print(f"   grid arithmetic {summary['grid_arithmetic']:.0f} ms "
+              f"({summary['legacy'] / summary['grid_arithmetic']:.1f}x)")
+    print(f"   Same cells: {same_cells}, max metric difference: {max_difference:.6f}")
+
+    for name in ('single_intersection', 'grid_arithmetic'):
+        if name in intersection_nodes and len(intersection_nodes[name]) > 1:
+            print(f"⚠️ {name}: ST_Intersection is evaluated in {len(intersection_nodes[name])} plan nodes")
+
+    benchmark.attrs['same_cells'] = same_cells
+    benchmark.attrs['max_difference'] = max_difference
+    benchmark.attrs['intersection_nodes'] = intersection_nodes
+
+    return benchmark
+
+
+def _read_aggregated_table(engine):
+    sql_query = text("""
+    SELECT 
+        grid_id,
+        grid_total_roof_area,
+        grid_total_floor_area,
+        grid_total_building_volume,
+        grid_avg_building_height,
+        total_building_coverage,
+        building_intersection_count
+    FROM citydb.aggregated_building_metrics_30m
+    ORDER BY grid_id;
+    """)
+
+    return pd.read_sql_query(sql_query, engine)
+
+
+def _create_aggregated_table_by_grid_arithmetic(engine, grid_gdf, grid):
+    """create_aggregated_building_metrics_table with the grid passed as parameters instead of the temp_grid table"""
+
+    print(f"🔧 Calculating aggregated metrics by grid arithmetic on {grid} (no grid upload)...")
+
+    sql_create_table = text(f"""
+    DROP TABLE IF EXISTS citydb.aggregated_building_metrics_30m;
+    
+    CREATE TABLE citydb.aggregated_building_metrics_30m AS
+    {grid_arithmetic_select_sql()};
+    
+    ALTER TABLE citydb.aggregated_building_metrics_30m
+    ADD CONSTRAINT aggregated_building_metrics_30m_pk PRIMARY KEY (grid_id);
+    
+    CREATE INDEX idx_aggregated_building_metrics_grid_30m_id 
+    ON citydb.aggregated_building_metrics_30m (grid_id);
+    """
+    )
+
+    with engine.connect() as conn:
+        conn.execute(sql_create_table, grid_arithmetic_params(grid))
+        conn.commit()
+
+    aggregated_df = _read_aggregated_table(engine)
+    print(f"✅ Created citydb.aggregated_building_metrics_30m table ({len(aggregated_df)} cells with buildings)")
+
+    # Cells without buildings are only added here, the database never sees the full grid
+    aggregated_df = zero_fill_aggregated_metrics(aggregated_df, grid_gdf['grid_id'])
+    print(f"✅ Fetched aggregated metrics for {len(aggregated_df)} grid cells")
+
+    return aggregated_df
+
+
+def create_aggregated_building_metrics_table(grid_gdf, grid=None):
+    """
+    Create aggregated_building_metrics table in PostGIS with grid_id as primary key
+    Sums all building metrics (which were previously calculated by object) by grid for each grid cell
+
+    Parameters:
+    - grid_gdf: Grid with grid_id and geometry
+    - grid: Optional RegularGrid of grid_gdf. Only its parameters are then sent to the database (no temp_grid upload
+            and no spatial join, see grid_arithmetic_select_sql), the table only holds the cells with buildings and
+            the other cells of grid_gdf are zero-filled in the returned DataFrame
+    """
+
+    print("🔧 Creating aggregated building metrics table in PostGIS...")
+
+    engine = create_db_engine()
+
+    if grid is not None:
+        return _create_aggregated_table_by_grid_arithmetic(engine, grid_gdf, grid)
+
+    # Upload grid to temporary PostGIS table in citydb schema
+    grid_gdf.to_postgis('temp_grid', engine, schema='citydb', if_exists='replace', index=False)
+
+    print("🔧 Calculating aggregated metrics by grid cell...")
+
+    # SQL to create the aggregated table
+    sql_create_table = text(f"""
+    -- Drop table if it exists
+    DROP TABLE IF EXISTS citydb.aggregated_building_metrics_30m;
+    
+    -- Up to date statistics for the planner on the freshly uploaded grid
+    ANALYZE citydb.temp_grid;
+    
+    -- Create aggregated building metrics table
+    CREATE TABLE citydb.aggregated_building_metrics_30m AS
+    {aggregation_select_sql()};
     
     -- Add primary key constraint
     ALTER TABLE citydb.aggregated_building_metrics_30m
@@ -314,20 +666,7 @@ def create_aggregated_building_metrics_table(grid_gdf):
         conn.commit()
 
 
-    sql_query = text("""
-    SELECT 
-        grid_id,
-        grid_total_roof_area,
-        grid_total_floor_area,
-        grid_total_building_volume,
-        grid_avg_building_height,
-        total_building_coverage,
-        building_intersection_count
-    FROM citydb.aggregated_building_metrics_30m
-    ORDER BY grid_id;
-    """)
-
-    aggregated_df = pd.read_sql_query(sql_query, engine)
+    aggregated_df = _read_aggregated_table(engine)
 
     # Clean up temporary table
     # with engine.connect() as conn:
@@ -343,9 +682,149 @@ def create_aggregated_building_metrics_table(grid_gdf):
     return aggregated_df
 
 
-def run_aggregated_metrics_pipeline(grid_path, output_dir):
+def grid_blocks(grid, block_cells=64):
+    """(i0, j0, nx, ny) blocks of at most block_cells x block_cells cells covering the grid"""
+
+    return [(i0, j0, min(block_cells, grid.nx - i0), min(block_cells, grid.ny - j0))
+            for i0 in range(0, grid.nx, block_cells)
+            for j0 in range(0, grid.ny, block_cells)]
+
+
+def create_aggregated_building_metrics_table_tiled(grid_gdf, grid, workers=4, block_cells=64):
+    """
+    create_aggregated_building_metrics_table split into blocks of cells, run in parallel on a pool of connections
+
+    The single CREATE TABLE ... AS statement runs on one backend (one core). Here the grid is split into blocks, and
+    every block inserts its cells into the table with its own INSERT ... SELECT (grid_arithmetic_select_sql
+    restricted to the block) on its own connection, so the blocks are processed by several backends at once. A
+    building crossing a block edge contributes to each block only with the cells inside it, so every building-cell
+    pair is counted exactly once and the table is the same as the non-tiled one.
+
+    Parameters:
+    - grid_gdf: Grid with grid_id (cells without buildings are zero-filled in the returned DataFrame)
+    - grid: RegularGrid of grid_gdf
+    - workers: Number of parallel connections
+    - block_cells: Block edge length in cells
+
+    Returns:
+    - Aggregated metrics DataFrame, with the timing in .attrs['tiling']
+    """
+
+    blocks = grid_blocks(grid, block_cells)
+    print(f"🔧 Aggregating building metrics in {len(blocks)} blocks of {block_cells}x{block_cells} cells "
+          f"on {workers} connections...")
+
+    engine = create_db_engine(pool_size=workers)
+    start_time = time.perf_counter()
+
+    # Empty table with the columns of the query
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+        DROP TABLE IF EXISTS citydb.aggregated_building_metrics_30m;
+        
+        CREATE TABLE citydb.aggregated_building_metrics_30m AS
+        {grid_arithmetic_select_sql()}
+        WITH NO DATA;
+        """), grid_arithmetic_params(grid))
+        conn.commit()
+
+    insert_sql = text(f"INSERT INTO citydb.aggregated_building_metrics_30m {grid_arithmetic_select_sql()}")
+
+    def _aggregate_block(block):
+        with engine.begin() as conn:
+            return conn.execute(insert_sql, grid_arithmetic_params(grid, block)).rowcount
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        inserted = list(executor.map(_aggregate_block, blocks))
+
+    aggregation_seconds = time.perf_counter() - start_time
+
+    with engine.connect() as conn:
+        conn.execute(text("""
+        ALTER TABLE citydb.aggregated_building_metrics_30m
+        ADD CONSTRAINT aggregated_building_metrics_30m_pk PRIMARY KEY (grid_id);
+        
+        CREATE INDEX idx_aggregated_building_metrics_grid_30m_id 
+        ON citydb.aggregated_building_metrics_30m (grid_id);
+        """))
+        conn.commit()
+
+    aggregated_df = _read_aggregated_table(engine)
+    engine.dispose()
+
+    print(f"✅ Created citydb.aggregated_building_metrics_30m table ({sum(inserted)} cells with buildings) "
+          f"in {aggregation_seconds:.1f}s")
+
+    aggregated_df = zero_fill_aggregated_metrics(aggregated_df, grid_gdf['grid_id'])
+    aggregated_df.attrs['tiling'] = {
+        'workers': workers,
+        'block_cells': block_cells,
+        'blocks': len(blocks),
+        'seconds': round(aggregation_seconds, 3)
+    }
+
+    return aggregated_df
+
+
+def benchmark_tiled_aggregation(grid_gdf, grid, worker_counts=(1, 2, 4, 8), block_cells=64):
+    """
+    Speedup of the tiled aggregation against the number of workers on the local PostGIS
+
+    Each worker count rebuilds citydb.aggregated_building_metrics_30m, the results are checked against the first run.
+
+    Returns:
+    - DataFrame with workers, seconds and speedup (relative to the first worker count)
+    """
+
+    rows = []
+    reference = None
+
+    for workers in worker_counts:
+        aggregated_df = create_aggregated_building_metrics_table_tiled(grid_gdf, grid, workers=workers,
+                                                                       block_cells=block_cells)
+        seconds = aggregated_df.attrs['tiling']['seconds']
+
+        if reference is None:
+            reference = aggregated_df
+        else:
+            difference = (reference['grid_total_building_volume'] - aggregated_df['grid_total_building_volume']).abs()
+            if not reference['grid_id'].equals(aggregated_df['grid_id']) or difference.max() > 1e-6:
+                print(f"⚠️ Results with {workers} workers differ from the {worker_counts[0]} worker run")
+
+        rows.append({'workers': workers, 'seconds': seconds})
+
+    benchmark = pd.DataFrame(rows)
+    benchmark['speedup'] = benchmark['seconds'].iloc[0] / benchmark['seconds']
+
+    print("\n📊 Tiled aggregation speedup:")
+    for row in benchmark.itertuples():
+        print(f"   {row.workers} workers: {row.seconds:.1f}s ({row.speedup:.2f}x)")
+
+    return benchmark
+
+
+def aggregate_building_metrics_with_weights(grid_gdf, cache_dir=WEIGHTS_CACHE_DIR):
+    """
+    Same table as create_aggregated_building_metrics_table, aggregated in Python with the cached building x cell
+    weight matrix (see building_cell_weights), so the overlaps are only computed when the grid or buildings change
+    """
+
+    print("🔧 Aggregating building metrics with the building-cell weight matrix...")
+
+    building_gdf = fetch_building_metrics_with_geometry()
+
+    return aggregate_building_metrics(building_gdf, grid_gdf, cache_dir=cache_dir)
+
+
+def run_aggregated_metrics_pipeline(grid_path, output_dir, method='sql', grid=None, workers=4):
     """
     Create aggregated building metrics table and save results
+
+    Parameters:
+    - method: 'sql' (citydb.aggregated_building_metrics_30m in PostGIS), 'tiled' (the same table built block by
+              block on several connections, needs grid) or 'weights' (cached weight matrix, no table)
+    - grid: Optional RegularGrid of the grid file, for the grid arithmetic SQL without the grid upload
+    - workers: Connections used by the 'tiled' method
     """
 
     print("🚀 Starting Aggregated Building Metrics Pipeline...")
@@ -359,8 +838,15 @@ def run_aggregated_metrics_pipeline(grid_path, output_dir):
     grid_gdf = grid_gdf[["cell_id","geometry"]]
     grid_gdf = grid_gdf.rename(columns={"cell_id":"grid_id"})
 
-    # Step 2: Create aggregated metrics table in PostGIS
-    aggregated_df = create_aggregated_building_metrics_table(grid_gdf)
+    # Step 2: Create aggregated metrics table in PostGIS, or aggregate with the cached weight matrix
+    if method == 'weights':
+        aggregated_df = aggregate_building_metrics_with_weights(grid_gdf)
+    elif method == 'tiled':
+        if grid is None:
+            raise ValueError("The tiled aggregation needs the RegularGrid of the grid file (grid=...)")
+        aggregated_df = create_aggregated_building_metrics_table_tiled(grid_gdf, grid, workers=workers)
+    else:
+        aggregated_df = create_aggregated_building_metrics_table(grid_gdf, grid=grid)
 
     # Step 3: Join back to grid geometry for saving
     grid_result = grid_gdf.merge(aggregated_df, on='grid_id', how='left')
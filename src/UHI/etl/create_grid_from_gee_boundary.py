@@ -1,10 +1,13 @@
 from UHI.config import *
-from UHI.gee_init import gee_init
+from UHI.gee_init import gee_init, get_session
+from UHI.grid_engine import classify_grid_cells
+from UHI.raster_spectral.gee_dispatch import dispatch_batches
+from UHI.raster_spectral.fishnet_2024_summer import get_raster_projection
+from UHI.regular_grid import RegularGrid
 
 import ee
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import Polygon, shape
 #import matplotlib.pyplot as plt
 
 """
@@ -15,46 +18,90 @@ convert it
 """
 
 
-def gee_featurecollection_to_geodataframe(fc, crs='EPSG:25832'):
+def features_to_geodataframe(features, crs='EPSG:25832', source_crs='EPSG:4326'):
+    """
+    Convert a list of GeoJSON features (as returned by getInfo()) to a GeoDataFrame
+
+    Uses GeoDataFrame.from_features, which works on the feature dicts directly (no re-encoding to JSON). Features
+    without a geometry get a None geometry.
+
+    Parameters:
+    - features: List of GeoJSON feature dicts
+    - crs: Target coordinate reference system
+    - source_crs: CRS of the feature coordinates (GEE returns EPSG:4326)
+
+    Returns:
+    - GeoDataFrame
+    """
+
+    gdf = gpd.GeoDataFrame.from_features(features, crs=source_crs)
+
+    # Reproject to target CRS
+    if crs != source_crs:
+        gdf = gdf.to_crs(crs)
+
+    return gdf
+
+
+def gee_featurecollection_to_geodataframe(fc, crs='EPSG:25832', page_size=None, max_in_flight=1):
     """
     Convert GEE FeatureCollection to GeoDataFrame
 
     Parameters:
     - fc: Earth Engine FeatureCollection
     - crs: Target coordinate reference system
+    - page_size: Optional number of features per request. Large collections are then fetched in pages with
+                 fc.toList(page_size, offset) instead of one giant getInfo(), which runs into the payload limit.
+    - max_in_flight: Number of pages fetched concurrently
 
     Returns:
     - GeoDataFrame
     """
 
-    # Get the geometry and properties
-    fc_info = fc.getInfo()
+    if page_size is None:
+        # Get the geometry and properties
+        features = get_session().get_info(fc, 'featurecollection')['features']
 
-    geometries = []
-    properties_list = []
+    else:
+        n_features = get_session().get_info(fc.size(), 'featurecollection_size')
+        offsets = list(range(0, n_features, page_size))
+        print(f"Fetching {n_features} features in {len(offsets)} pages of {page_size}")
 
-    for feature in fc_info['features']:
-        # Convert GEE geometry to Shapely geometry
-        geom = shape(feature['geometry'])
-        geometries.append(geom)
+        pages = dispatch_batches(lambda offset: get_session().get_info(fc.toList(page_size, offset),
+                                                                       'featurecollection_page'), offsets,
+                                 max_in_flight=max_in_flight)
+        features = [feature for page in pages for feature in page]
 
-        # Get properties (attributes)
-        props = feature.get('properties', {})
-        properties_list.append(props)
+    return features_to_geodataframe(features, crs=crs)
 
-    # Create GeoDataFrame
-    gdf = gpd.GeoDataFrame(properties_list, geometry=geometries, crs="EPSG:4326")
 
-    # Reproject to target CRS
-    if crs != "EPSG:4326":
-        gdf = gdf.to_crs(crs)
 
-    return gdf
 
+def _pixel_aligned_grid(align_to, bounds, cell_size, crs):
+    """
+    RegularGrid over bounds snapped to the pixel lattice of an ee.Image or a crs_transform list
+    """
+
+    if isinstance(align_to, ee.Image):
+        projection = get_raster_projection(align_to)
+        if projection is None:
+            raise ValueError("Cannot align grid: image has no band information")
+        if projection['crs'] != crs:
+            raise ValueError(f"Cannot align grid in {crs} to a raster in {projection['crs']}")
+        crs_transform = projection['crs_transform']
+    else:
+        crs_transform = align_to
+
+    pixel_size = abs(float(crs_transform[0]))
+    pixels_per_cell = cell_size / pixel_size
 
+    if abs(pixels_per_cell - round(pixels_per_cell)) > 1e-9 or round(pixels_per_cell) < 1:
+        raise ValueError(f"Cell size {cell_size}m is not a whole number of {pixel_size}m pixels")
 
+    return RegularGrid.from_crs_transform(crs_transform, bounds, crs=crs, pixels_per_cell=round(pixels_per_cell))
 
-def create_grid_from_gee_boundary(boundary_asset_id, cell_size=30, crs='EPSG:25832'):
+
+def create_grid_from_gee_boundary(boundary_asset_id, cell_size=30, crs='EPSG:25832', clip_mode='overlay', align_to=None):
     """
     Create a 30x30m grid from GEE boundary asset
 
@@ -62,14 +109,24 @@ def create_grid_from_gee_boundary(boundary_asset_id, cell_size=30, crs='EPSG:258
     - boundary_asset_id: GEE asset ID for boundary
     - cell_size: Grid cell size in meters (default 30m)
     - crs: Coordinate reference system
+    - clip_mode: 'overlay' clips every candidate cell with gpd.overlay (original behaviour).
+                 'classify' splits cells into interior, edge and exterior, clips only the edge cells and adds
+                 cell_class and coverage_fraction columns (see grid_engine.classify_grid_cells)
+    - align_to: Optional ee.Image or crs_transform list to snap the grid to. The grid origin is snapped to the
+                pixel lattice of the raster and cell_size must be a whole number of pixels, so every centroid
+                falls on a pixel centre and the grid can be reused for every asset with the same transform.
 
     Returns:
     - GeoDataFrame with grid cells
     """
 
+    if clip_mode not in ('overlay', 'classify'):
+        raise ValueError(f"Unknown clip_mode: {clip_mode}")
+
     print(f"Loading boundary from GEE: {boundary_asset_id}")
 
-    # Load boundary from GEE
+    # Load boundary from GEE (ee objects can only be built once Earth Engine is initialised)
+    get_session().initialize()
     boundary_fc = ee.FeatureCollection(boundary_asset_id)
 
     # Convert to GeoDataFrame
@@ -86,37 +143,35 @@ def create_grid_from_gee_boundary(boundary_asset_id, cell_size=30, crs='EPSG:258
     print(f"  X: {minx:.0f} to {maxx:.0f} ({maxx-minx:.0f}m width)")
     print(f"  Y: {miny:.0f} to {maxy:.0f} ({maxy-miny:.0f}m height)")
 
-    # Create grid coordinates
-    x_coords = np.arange(minx, maxx + cell_size, cell_size)
-    y_coords = np.arange(miny, maxy + cell_size, cell_size)
-
-    print(f"Grid dimensions: {len(x_coords)-1} x {len(y_coords)-1} cells")
-    print(f"Total potential cells: {(len(x_coords)-1) * (len(y_coords)-1)}")
-
-    # Create grid polygons
-    grid_cells = []
-    cell_ids = []
-
-    for i, x in enumerate(x_coords[:-1]):
-        for j, y in enumerate(y_coords[:-1]):
-            # Create 30x30m cell
-            cell = Polygon([
-                (x, y),                      # Bottom-left
-                (x + cell_size, y),          # Bottom-right
-                (x + cell_size, y + cell_size),  # Top-right
-                (x, y + cell_size)           # Top-left
-            ])
-
-            grid_cells.append(cell)
-            cell_ids.append(f"cell_{i}_{j}")
-
-    # Create GeoDataFrame
-    grid_gdf = gpd.GeoDataFrame({
-        'cell_id': cell_ids,
-        'x_index': [i for i in range(len(x_coords)-1) for j in range(len(y_coords)-1)],
-        'y_index': [j for i in range(len(x_coords)-1) for j in range(len(y_coords)-1)],
-        'geometry': grid_cells
-    }, crs=crs)
+    if align_to is None:
+        # Create grid coordinates
+        x_coords = np.arange(minx, maxx + cell_size, cell_size)
+        y_coords = np.arange(miny, maxy + cell_size, cell_size)
+        regular_grid = RegularGrid(minx, miny, cell_size, len(x_coords) - 1, len(y_coords) - 1, crs=crs)
+
+    else:
+        regular_grid = _pixel_aligned_grid(align_to, bounds, cell_size, crs)
+        print(f"Grid snapped to raster pixel lattice: {regular_grid}")
+
+    # Dimensions of the grid that is actually built (snapped origin, nx and ny when aligned)
+    grid_minx, grid_miny, grid_maxx, grid_maxy = regular_grid.bounds
+    print(f"Grid dimensions: {regular_grid.nx} x {regular_grid.ny} cells")
+    print(f"Grid extent: X {grid_minx:.0f} to {grid_maxx:.0f}, Y {grid_miny:.0f} to {grid_maxy:.0f}")
+    print(f"Total potential cells: {regular_grid.n_cells}")
+
+    if clip_mode == 'classify':
+        # Only the cells on the boundary ring are clipped, interior cells keep their squares
+        print("Classifying grid cells against boundary...")
+        grid_clipped = classify_grid_cells(regular_grid, boundary_gdf.union_all())
+
+        n_edge = (grid_clipped['cell_class'] == 'edge').sum()
+        print(f"Cells within boundary: {len(grid_clipped)} ({len(grid_clipped) - n_edge} interior, {n_edge} edge, "
+              f"{regular_grid.n_cells - len(grid_clipped)} exterior)")
+
+        return grid_clipped, boundary_gdf
+
+    # Create grid polygons (cell_id, x_index, y_index, geometry) in one go from the grid parameters
+    grid_gdf = regular_grid.to_geodataframe()
 
 
     # Clip grid to boundary (only keep cells that intersect)
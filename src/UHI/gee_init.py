@@ -3,14 +3,186 @@ import sys
 from UHI.config import *
 
 import ee
+import json
 import subprocess
 import os
+import threading
+import time
+
+"""
+Earth Engine session handling.
+
+GEESession initialises Earth Engine once per process, when an entry point first needs it, with the cached credentials (ee.Authenticate()
+is only run when there are none), and keeps per-operation request metrics: number of calls, errors, bytes returned
+(where measured) and a latency histogram. Code that talks to Earth Engine goes through session.get_info(obj, operation) or
+session.call(operation, fn, ...), so session.report() shows which stages use up the quota and the time.
+
+get_session() returns the process-wide session, gee_init() is kept as a shortcut for get_session().initialize().
+"""
+
+
+GEE_PROJECT = 'uhigisproject'
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket takes everything slower
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class GEESession:
+    """
+    Lazily initialised Earth Engine session with request metrics
+
+    Parameters:
+    - measure_bytes: Record the JSON size of every get_info result. Off by default, it re-serialises every result
+                     (e.g. whole FeatureCollection pages) on the request path.
+    """
+
+    def __init__(self, project=GEE_PROJECT, ee_client=ee, measure_bytes=False):
+        self.project = project
+        self.ee_client = ee_client
+        self.measure_bytes = measure_bytes
+        self.initialized = False
+        self._init_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+
+    def initialize(self, force=False):
+        """Initialise Earth Engine (once), authenticating only if there are no usable cached credentials"""
+
+        if self.initialized and not force:
+            return
+
+        with self._init_lock:
+            if self.initialized and not force:
+                return
+
+            try:
+                self.ee_client.Initialize(project=self.project)
+            except Exception as e:
+                print(f"⚠️ No usable cached GEE credentials ({e}), authenticating...")
+                self.ee_client.Authenticate()
+                self.ee_client.Initialize(project=self.project)
+
+            self.initialized = True
+            print("GEE initialized successfully")
+
+    def record(self, operation, latency, nbytes=None, error=False):
+        """Add one request to the metrics of operation (nbytes None: size not measured)"""
+
+        with self._metrics_lock:
+            metrics = self._metrics.setdefault(operation, {
+                'calls': 0,
+                'errors': 0,
+                'bytes': 0,
+                'measured_calls': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+            })
+
+            metrics['calls'] += 1
+            metrics['errors'] += int(error)
+            if nbytes is not None:
+                metrics['bytes'] += int(nbytes)
+                metrics['measured_calls'] += 1
+            metrics['total_seconds'] += latency
+            metrics['max_seconds'] = max(metrics['max_seconds'], latency)
+
+            bucket = next((k for k, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+            metrics['histogram'][bucket] += 1
+
+    def call(self, operation, fn, *args, size_fn=None, **kwargs):
+        """
+        Run one Earth Engine request fn(*args, **kwargs) and record it under operation
+
+        Parameters:
+        - size_fn: Optional callable result -> size in bytes for the metrics
+        """
+
+        start_time = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(operation, time.perf_counter() - start_time, error=True)
+            raise
+
+        latency = time.perf_counter() - start_time
+        self.record(operation, latency, size_fn(result) if size_fn is not None else None)
+
+        return result
+
+    def get_info(self, obj, operation='getInfo', measure_bytes=None):
+        """
+        obj.getInfo(), recorded under operation
+
+        With measure_bytes (default: the session setting) the bytes are the size of the JSON result. Earth Engine has
+        to be initialised already (ee objects can't even be constructed before), so entry points call
+        get_session().initialize() before building any ee object.
+        """
+
+        measure_bytes = self.measure_bytes if measure_bytes is None else measure_bytes
+        size_fn = (lambda result: len(json.dumps(result, default=str))) if measure_bytes else None
+        return self.call(operation, obj.getInfo, size_fn=size_fn)
+
+    def metrics(self):
+        """
+        Copy of the metrics, {operation: {calls, errors, bytes, measured_calls, total_seconds, mean_seconds, max_seconds,
+        histogram}}. bytes only covers the measured_calls whose size was measured.
+        """
+
+        with self._metrics_lock:
+            metrics = {operation: dict(values, histogram=list(values['histogram']))
+                       for operation, values in self._metrics.items()}
+
+        for values in metrics.values():
+            values['mean_seconds'] = values['total_seconds'] / values['calls'] if values['calls'] else 0.0
+
+        return metrics
+
+    def reset_metrics(self):
+        with self._metrics_lock:
+            self._metrics = {}
+
+    def report(self):
+        """Print the metrics per operation, most time consuming first"""
+
+        metrics = self.metrics()
+        if not metrics:
+            print("No GEE requests recorded")
+            return metrics
+
+        labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+
+        print("GEE requests:")
+        for operation, values in sorted(metrics.items(), key=lambda item: -item[1]['total_seconds']):
+            size = f"{values['bytes'] / 1e6:.2f} MB" if values['measured_calls'] else "size not measured"
+            print(f"  {operation}: {values['calls']} calls ({values['errors']} errors), "
+                  f"{size}, {values['total_seconds']:.1f}s total, "
+                  f"{values['mean_seconds']:.2f}s mean, {values['max_seconds']:.2f}s max")
+            histogram = ", ".join(f"{label}: {count}" for label, count in zip(labels, values['histogram']) if count)
+            print(f"    latency: {histogram}")
+
+        return metrics
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(project=GEE_PROJECT):
+    """The process-wide GEESession (created on first use, not initialised until it is needed)"""
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = GEESession(project=project)
+
+    return _session
+
 
 def gee_init():
 
-    ee.Authenticate()
-    ee.Initialize(project='uhigisproject')
-    print("GEE initialized successfully")
+    get_session().initialize()
 
 
 
@@ -0,0 +1,452 @@
+# src/UHI/grid_engine.py
+
+from UHI.config import *
+from UHI.regular_grid import RegularGrid
+
+import multiprocessing
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box
+
+"""
+Vectorised grid engine.
+
+The original generate_grid in gridgen.py builds the cells one at a time in a nested Python loop and calls
+boundary.union_all() for every candidate cell, which means the whole boundary union is recomputed tens of thousands
+of times. Here all candidate cells are created in a single shapely.box call, the boundary is unioned and prepared
+once, and the cells are tested against it in bulk with an STRtree query.
+
+The cell ordering (x outer, y inner) and the grid_id numbering are the same as the loop, so the output can be used
+as a drop-in replacement for the existing grid files.
+"""
+
+
+def build_grid_cells(boundary_gdf, cell_size=100, crs=CRS):
+    """
+    Build a square grid over a boundary in one array operation.
+
+    Parameters:
+    - boundary_gdf: GeoDataFrame with the boundary polygon(s)
+    - cell_size: Size of the grid cells in meters
+    - crs: Projected CRS the grid is built in (default EPSG:25832)
+
+    Returns:
+    - GeoDataFrame with geometry and grid_id columns, containing only the cells that intersect the boundary
+    """
+
+    boundary_gdf = boundary_gdf.to_crs(crs)
+
+    # Every candidate cell, x outer / y inner to match the original loop order
+    regular_grid = RegularGrid.from_bounds(boundary_gdf.total_bounds, cell_size, crs=crs)
+    cells = regular_grid.cell_polygons(*regular_grid.all_indices())
+
+    # Union and prepare the boundary once, instead of once per cell
+    boundary_geom = boundary_gdf.union_all()
+    shapely.prepare(boundary_geom)
+
+    # Bulk intersects test through the spatial index
+    tree = shapely.STRtree(cells)
+    hits = np.sort(tree.query(boundary_geom, predicate="intersects"))
+
+    grid = gpd.GeoDataFrame({'geometry': cells[hits]}, crs=crs)
+    grid["grid_id"] = [f"cell_{i}" for i in range(len(grid))]
+
+    return grid
+
+
+def classify_grid_cells(regular_grid, boundary_geom):
+    """
+    Split the cells of a regular grid into interior, edge and exterior cells, and clip only the edge cells.
+
+    Instead of overlaying every candidate cell with the boundary, only the cells around the boundary ring are
+    tested and clipped, so the cost grows with the boundary length rather than the area:
+    - edge candidates are the 3x3 neighbourhoods of the ring vertices, after densifying the ring to cell_size
+      segments, confirmed with a bulk intersects test against the prepared ring
+    - every other cell is either fully inside or fully outside. Along each grid column these cells form runs
+      between edge cells, and only one centroid per run is tested against the boundary
+
+    Parameters:
+    - regular_grid: RegularGrid covering the boundary
+    - boundary_geom: (Multi)Polygon in the grid CRS, e.g. boundary_gdf.union_all()
+
+    Returns:
+    - GeoDataFrame with cell_id, x_index, y_index, cell_class ('interior' or 'edge'), coverage_fraction and
+      geometry. Exterior cells are dropped. Interior cells keep their full square, edge cells are clipped.
+    """
+
+    nx, ny = regular_grid.shape
+    cell_area = regular_grid.cell_size ** 2
+
+    shapely.prepare(boundary_geom)
+    ring = shapely.segmentize(shapely.boundary(boundary_geom), regular_grid.cell_size)
+    shapely.prepare(ring)
+
+    # Edge candidates: cells around each ring vertex
+    vertices = shapely.get_coordinates(ring)
+    vi = np.floor((vertices[:, 0] - regular_grid.origin_x) / regular_grid.cell_size).astype(np.int64)
+    vj = np.floor((vertices[:, 1] - regular_grid.origin_y) / regular_grid.cell_size).astype(np.int64)
+
+    offsets = np.array([(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+    ci = (vi[:, None] + offsets[:, 0]).ravel()
+    cj = (vj[:, None] + offsets[:, 1]).ravel()
+    valid = regular_grid.contains_index(ci, cj)
+    candidates = np.unique(regular_grid.flat_index(ci[valid], cj[valid]))
+
+    ci, cj = regular_grid.unflat_index(candidates)
+    crossed = shapely.intersects(ring, regular_grid.cell_polygons(ci, cj))
+    edge_flat = candidates[crossed]
+
+    # Runs of non-edge cells along each column (flat order is x outer / y inner) share the same class
+    is_edge = np.zeros(nx * ny, dtype=bool)
+    is_edge[edge_flat] = True
+
+    k = np.arange(nx * ny, dtype=np.int64)
+    run_start = np.ones(nx * ny, dtype=bool)
+    run_start[1:] = (is_edge[1:] != is_edge[:-1]) | (k[1:] % ny == 0)
+    run_id = np.cumsum(run_start) - 1
+    starts = k[run_start]
+
+    open_runs = ~is_edge[starts]
+    ri, rj = regular_grid.unflat_index(starts[open_runs])
+    run_inside = np.zeros(len(starts), dtype=bool)
+    run_inside[open_runs] = shapely.contains_xy(boundary_geom, *regular_grid.cell_centroid(ri, rj))
+
+    interior_flat = k[~is_edge & run_inside[run_id]]
+
+    # Clip only the edge cells
+    ei, ej = regular_grid.unflat_index(edge_flat)
+    clipped = shapely.intersection(regular_grid.cell_polygons(ei, ej), boundary_geom)
+    edge_coverage = shapely.area(clipped) / cell_area
+
+    # Cells that only touch the ring along their sides are really exterior (0) or interior (1)
+    touching_outside = edge_coverage <= 1e-9
+    touching_inside = edge_coverage >= 1 - 1e-9
+    interior_flat = np.sort(np.concatenate([interior_flat, edge_flat[touching_inside]]))
+    keep_edge = ~touching_outside & ~touching_inside
+    edge_flat = edge_flat[keep_edge]
+
+    ii, ij = regular_grid.unflat_index(interior_flat)
+    ei, ej = regular_grid.unflat_index(edge_flat)
+
+    flat = np.concatenate([interior_flat, edge_flat])
+    order = np.argsort(flat, kind="stable")
+
+    i = np.concatenate([ii, ei])[order]
+    j = np.concatenate([ij, ej])[order]
+    geometry = np.concatenate([regular_grid.cell_polygons(ii, ij), clipped[keep_edge]])[order]
+    cell_class = np.concatenate([np.full(len(ii), 'interior', dtype=object),
+                                 np.full(len(ei), 'edge', dtype=object)])[order]
+    coverage_fraction = np.concatenate([np.ones(len(ii)), edge_coverage[keep_edge]])[order]
+
+    return gpd.GeoDataFrame({
+        'cell_id': regular_grid.cell_ids(i, j),
+        'x_index': i,
+        'y_index': j,
+        'cell_class': cell_class,
+        'coverage_fraction': coverage_fraction,
+        'geometry': geometry
+    }, crs=regular_grid.crs)
+
+
+def _build_grid_cells_loop(boundary_gdf, cell_size=100, crs=CRS):
+    """
+    The original per-cell loop from gridgen.generate_grid, kept only as the baseline for benchmark_grid_engine
+    """
+
+    boundary = boundary_gdf.to_crs(crs)
+    minx, miny, maxx, maxy = boundary.total_bounds
+
+    grid_cells = []
+    for x0 in np.arange(minx, maxx, cell_size):
+        for y0 in np.arange(miny, maxy, cell_size):
+            x1, y1 = x0 + cell_size, y0 + cell_size
+            cell = box(x0, y0, x1, y1)
+            if cell.intersects(boundary.union_all()):
+                grid_cells.append(cell)
+
+    grid = gpd.GeoDataFrame({'geometry': grid_cells}, crs=crs)
+    grid["grid_id"] = [f"cell_{i}" for i in range(len(grid))]
+
+    return grid
+
+
+def benchmark_grid_engine(boundary_path=BOUNDARY_PATH, cell_sizes=(100, 30, 10), run_loop=True, measure_memory=False,
+                          tile_cells=512):
+    """
+    Benchmark the vectorised grid engine against the original per-cell loop
+
+    Parameters:
+    - boundary_path: Path to boundary shapefile or GeoPackage
+    - cell_sizes: Cell sizes (meters) to benchmark
+    - run_loop: Set to False to skip the original loop (it takes minutes at 10m)
+    - measure_memory: Also build every grid in memory and with write_grid_tiled (to a temporary GeoParquet
+                      directory), each in a fresh process, and report the peak RSS of both
+    - tile_cells: Tile edge length for the tiled run
+
+    Returns:
+    - DataFrame with one row per cell size (cell count, timings, speedup, whether the outputs are identical, and
+      with measure_memory in_memory_peak_rss_mb / tiled_peak_rss_mb)
+    """
+
+    boundary_gdf = gpd.read_file(boundary_path)
+
+    results = []
+
+    for cell_size in cell_sizes:
+        print(f"🔧 Benchmarking {cell_size}m grid...")
+
+        start = time.perf_counter()
+        grid = build_grid_cells(boundary_gdf, cell_size=cell_size)
+        vectorised_s = time.perf_counter() - start
+
+        row = {
+            'cell_size': cell_size,
+            'cells': len(grid),
+            'vectorised_s': vectorised_s,
+            'loop_s': np.nan,
+            'speedup': np.nan,
+            'identical': None
+        }
+
+        if run_loop:
+            start = time.perf_counter()
+            loop_grid = _build_grid_cells_loop(boundary_gdf, cell_size=cell_size)
+            row['loop_s'] = time.perf_counter() - start
+            row['speedup'] = row['loop_s'] / vectorised_s
+            row['identical'] = bool(
+                len(loop_grid) == len(grid)
+                and (loop_grid['grid_id'] == grid['grid_id']).all()
+                and loop_grid.geometry.geom_equals(grid.geometry).all()
+            )
+
+        print(f"   {row['cells']} cells | vectorised {vectorised_s:.2f}s | loop {row['loop_s']:.2f}s "
+              f"| speedup {row['speedup']:.1f}x | identical: {row['identical']}")
+
+        if measure_memory:
+            # Fresh processes, so each peak belongs to that run only and not to whatever ran before
+            _, row['in_memory_peak_rss_mb'] = run_in_fresh_process(_build_grid_cell_count, boundary_path, cell_size)
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tiled = write_grid_tiled(boundary_path, Path(tmp_dir) / "grid.parquet", cell_size=cell_size,
+                                         tile_cells=tile_cells)
+            row['tiled_peak_rss_mb'] = tiled['peak_rss_mb']
+
+            print(f"   peak RSS | in memory {_format_mb(row['in_memory_peak_rss_mb'])} "
+                  f"| tiled {_format_mb(row['tiled_peak_rss_mb'])}")
+
+        results.append(row)
+
+    return pd.DataFrame(results)
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, or None if it cannot be determined on this platform
+
+    This is the peak over the whole lifetime of the process, so it only describes a single run if the run had the
+    process to itself (see run_in_fresh_process).
+    """
+
+    # Linux: VmHWM belongs to the address space, so unlike ru_maxrss it is not inherited across fork + exec
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        memory_info = psutil.Process().memory_info()
+        # peak_wset is only available on Windows
+        return getattr(memory_info, "peak_wset", memory_info.rss) / 1024 ** 2
+    except ImportError:
+        return None
+
+
+def _format_mb(value):
+    return f"{value:.0f} MB" if value is not None else "n/a"
+
+
+def _measured_call(fn, args, kwargs):
+    return fn(*args, **kwargs), _peak_rss_mb()
+
+
+def run_in_fresh_process(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) in a new (spawned) Python process
+
+    Returns:
+    - (result, peak RSS of that process in MB or None). fn and its result must be picklable.
+    """
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_measured_call, fn, args, kwargs).result()
+
+
+def _build_grid_cell_count(boundary_path, cell_size):
+    """In-memory grid build for the memory benchmark, only the cell count goes back to the caller"""
+
+    return len(build_grid_cells(gpd.read_file(boundary_path), cell_size=cell_size))
+
+
+def iter_grid_tiles(boundary_gdf, cell_size=30, tile_cells=512, crs=CRS, clip_mode='intersects'):
+    """
+    Generate the grid tile by tile, so that only one tile of cells is held in memory at a time
+
+    Parameters:
+    - boundary_gdf: GeoDataFrame with the boundary polygon(s)
+    - cell_size: Size of the grid cells in meters
+    - tile_cells: Tile edge length in cells (a tile holds at most tile_cells x tile_cells cells)
+    - crs: Projected CRS the grid is built in
+    - clip_mode: 'intersects' keeps full squares that intersect the boundary (like generate_grid),
+                 'classify' clips edge cells and adds cell_class / coverage_fraction (like classify_grid_cells)
+
+    Yields:
+    - GeoDataFrame chunks with cell_id, x_index, y_index, (cell_class, coverage_fraction,) geometry. Cell ids use the
+      global "cell_{i}_{j}" indices of the whole grid, so chunks from different tiles never clash.
+    """
+
+    if clip_mode not in ('intersects', 'classify'):
+        raise ValueError(f"Unknown clip_mode: {clip_mode}")
+
+    boundary_gdf = boundary_gdf.to_crs(crs)
+    regular_grid = RegularGrid.from_bounds(boundary_gdf.total_bounds, cell_size, crs=crs)
+
+    boundary_geom = boundary_gdf.union_all()
+    shapely.prepare(boundary_geom)
+
+    for i0 in range(0, regular_grid.nx, tile_cells):
+        for j0 in range(0, regular_grid.ny, tile_cells):
+            tile_grid = regular_grid.window(i0, j0, tile_cells, tile_cells)
+            tile_box = shapely.box(*tile_grid.bounds)
+
+            if not boundary_geom.intersects(tile_box):
+                continue
+
+            if clip_mode == 'classify':
+                # The boundary clipped to the tile only adds ring segments along the tile edges, whose cells
+                # come out with coverage 1 and are relabelled interior
+                tile = classify_grid_cells(tile_grid, shapely.intersection(boundary_geom, tile_box))
+                if tile.empty:
+                    continue
+                i = tile['x_index'].to_numpy() + i0
+                j = tile['y_index'].to_numpy() + j0
+                tile['x_index'] = i
+                tile['y_index'] = j
+                tile['cell_id'] = regular_grid.cell_ids(i, j)
+
+            else:
+                li, lj = tile_grid.all_indices()
+                cells = tile_grid.cell_polygons(li, lj)
+                hits = shapely.intersects(boundary_geom, cells)
+                if not hits.any():
+                    continue
+                i = li[hits] + i0
+                j = lj[hits] + j0
+                tile = gpd.GeoDataFrame({
+                    'cell_id': regular_grid.cell_ids(i, j),
+                    'x_index': i,
+                    'y_index': j,
+                    'geometry': cells[hits]
+                }, crs=crs)
+
+            yield tile
+
+
+def write_grid_tiled(boundary_path, output_path, cell_size=30, tile_cells=512, crs=CRS, clip_mode='intersects',
+                     layer="grid", isolated=True):
+    """
+    Stream a grid to disk tile by tile in bounded memory, for regions too big to build as one GeoDataFrame
+    (e.g. the whole of Oberfranken)
+
+    Parameters:
+    - boundary_path: Path to boundary shapefile or GeoPackage
+    - output_path: .gpkg file (chunks are appended to one layer) or .parquet directory (one GeoParquet part file
+                   per chunk, readable with gpd.read_parquet(output_path))
+    - cell_size, tile_cells, crs, clip_mode: See iter_grid_tiles
+    - layer: GeoPackage layer name
+    - isolated: Run in a fresh process, so peak_rss_mb is the peak of this run. With isolated=False the grid is
+                written in this process and peak_rss_mb is None (the process peak would include earlier work).
+
+    Returns:
+    - Dict with run statistics (cells, tiles, seconds, cells_per_second, peak_rss_mb)
+    """
+
+    args = (boundary_path, output_path, cell_size, tile_cells, crs, clip_mode, layer)
+
+    if isolated:
+        stats, peak_rss_mb = run_in_fresh_process(_write_grid_tiles, *args)
+        stats['peak_rss_mb'] = peak_rss_mb
+    else:
+        stats = _write_grid_tiles(*args)
+        stats['peak_rss_mb'] = None
+
+    print(f"✅ Wrote {stats['cells']} cells in {stats['tiles']} tiles | {stats['seconds']:.1f}s | "
+          f"{stats['cells_per_second']:,.0f} cells/s | peak RSS {_format_mb(stats['peak_rss_mb'])}")
+
+    return stats
+
+
+def _write_grid_tiles(boundary_path, output_path, cell_size, tile_cells, crs, clip_mode, layer):
+    """Body of write_grid_tiled, run in this or a fresh process"""
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    parquet = output_path.suffix == ".parquet"
+
+    if parquet:
+        output_path.mkdir(exist_ok=True)
+        for old_part in output_path.glob("part-*.parquet"):
+            old_part.unlink()
+    elif output_path.exists():
+        output_path.unlink()
+
+    boundary_gdf = gpd.read_file(boundary_path)
+
+    print(f"🔧 Streaming {cell_size}m grid to {output_path} in tiles of {tile_cells}x{tile_cells} cells...")
+
+    start = time.perf_counter()
+    n_cells = 0
+    n_tiles = 0
+
+    for tile in iter_grid_tiles(boundary_gdf, cell_size=cell_size, tile_cells=tile_cells, crs=crs,
+                                clip_mode=clip_mode):
+        if parquet:
+            tile.to_parquet(output_path / f"part-{n_tiles:05d}.parquet", index=False)
+        else:
+            tile.to_file(output_path, layer=layer, driver="GPKG", mode="a" if n_tiles else "w")
+
+        n_cells += len(tile)
+        n_tiles += 1
+
+    seconds = time.perf_counter() - start
+
+    return {
+        'cells': n_cells,
+        'tiles': n_tiles,
+        'seconds': seconds,
+        'cells_per_second': n_cells / seconds if seconds > 0 else np.nan
+    }
+
+
+if __name__ == "__main__":
+
+    print(benchmark_grid_engine())
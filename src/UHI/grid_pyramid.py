@@ -0,0 +1,215 @@
+# src/UHI/grid_pyramid.py
+
+from UHI.config import *
+from UHI.regular_grid import RegularGrid
+
+import numpy as np
+import pandas as pd
+
+"""
+Multi-resolution grid pyramid.
+
+The 100m grid (GRID_PATH), the 30m GEE grid (GRID_30M_PATH) and the planned 10m Sentinel-2 grid are currently each
+built and aggregated from scratch. A GridPyramid nests regular grids that share one origin, with every coarser cell
+covering exactly factor x factor cells of the level below (e.g. 10m -> 30m -> 90m, or 10m -> 50m -> 100m).
+Parent/child index arrays are computed once, so metrics aggregated at the finest level can be rolled up to any coarser
+level by summing or weighted averaging arrays, without another overlay pass per resolution.
+
+30m and 100m cannot be nested (100 / 30 is not an integer), so a 100m-aligned pyramid has to start from 10m, 20m,
+25m or 50m cells.
+"""
+
+
+class GridPyramid:
+    """Nested RegularGrids with precomputed parent/child index arrays"""
+
+    def __init__(self, base_grid, factors=(3, 3)):
+        """
+        Parameters:
+        - base_grid: RegularGrid of the finest level
+        - factors: Integer refinement factor between each level and the next coarser one
+        """
+
+        self.factors = tuple(int(f) for f in factors)
+        if any(f < 2 for f in self.factors):
+            raise ValueError(f"Pyramid factors must be integers >= 2, got {factors}")
+
+        self.levels = [base_grid]
+        for factor in self.factors:
+            fine = self.levels[-1]
+            self.levels.append(RegularGrid(
+                fine.origin_x,
+                fine.origin_y,
+                fine.cell_size * factor,
+                -(-fine.nx // factor),  # ceil division, partial parents at the far edges
+                -(-fine.ny // factor),
+                crs=fine.crs
+            ))
+
+        # parents[level][k] is the flat index at level + 1 of cell k at level
+        self.parents = []
+        # children[level] = (order, offsets): the children at level - 1 of parent p are order[offsets[p]:offsets[p + 1]]
+        self.children_index = [None]
+
+        for level, factor in enumerate(self.factors):
+            fine = self.levels[level]
+            coarse = self.levels[level + 1]
+
+            i, j = fine.all_indices()
+            parent = coarse.flat_index(i // factor, j // factor)
+            self.parents.append(parent)
+
+            order = np.argsort(parent, kind="stable")
+            offsets = np.zeros(coarse.n_cells + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(parent, minlength=coarse.n_cells))
+            self.children_index.append((order, offsets))
+
+    @classmethod
+    def from_cell_sizes(cls, bounds, cell_sizes=(10, 30, 90), crs=CRS):
+        """
+        Build a pyramid over bounds = (minx, miny, maxx, maxy) from a list of cell sizes, finest first
+
+        Every cell size must be an integer multiple of the previous one.
+        """
+
+        cell_sizes = list(cell_sizes)
+        factors = []
+        for fine, coarse in zip(cell_sizes[:-1], cell_sizes[1:]):
+            factor = coarse / fine
+            if factor < 2 or abs(factor - round(factor)) > 1e-9:
+                raise ValueError(f"Cell size {coarse}m is not an integer multiple of {fine}m")
+            factors.append(int(round(factor)))
+
+        return cls(RegularGrid.from_bounds(bounds, cell_sizes[0], crs=crs), factors)
+
+    def __repr__(self):
+        return f"GridPyramid(cell_sizes={self.cell_sizes}, shapes={[g.shape for g in self.levels]})"
+
+    @property
+    def cell_sizes(self):
+        return [grid.cell_size for grid in self.levels]
+
+    def level_of(self, cell_size):
+        """Level number of a cell size"""
+
+        for level, grid in enumerate(self.levels):
+            if abs(grid.cell_size - cell_size) < 1e-9:
+                return level
+
+        raise ValueError(f"No {cell_size}m level in {self}")
+
+    def ancestor_index(self, level_from=0, level_to=None):
+        """Flat index at level_to of every cell at level_from (composes the parent arrays)"""
+
+        if level_to is None:
+            level_to = len(self.levels) - 1
+        if level_to < level_from:
+            raise ValueError("level_to must not be finer than level_from")
+
+        index = np.arange(self.levels[level_from].n_cells, dtype=np.int64)
+        for level in range(level_from, level_to):
+            index = self.parents[level][index]
+
+        return index
+
+    def children(self, level, k):
+        """Flat indices at level - 1 of the children of cell k at level"""
+
+        if level < 1:
+            raise ValueError("The finest level has no children")
+
+        order, offsets = self.children_index[level]
+        return order[offsets[k]:offsets[k + 1]]
+
+    def rollup(self, values, level_from=0, level_to=None, how='sum', weights=None):
+        """
+        Roll an array of per-cell values up to a coarser level
+
+        Parameters:
+        - values: Array with one value per cell at level_from (flat index order). NaN values are ignored.
+        - level_from, level_to: Source and target level (default: finest -> coarsest)
+        - how: 'sum' or 'mean' (weighted mean when weights are given, e.g. coverage_fraction or building area)
+        - weights: Optional array of weights for 'mean'
+
+        Returns:
+        - Array with one value per cell at level_to. Cells without any valid children are 0 for 'sum' and NaN for
+          'mean'.
+        """
+
+        if level_to is None:
+            level_to = len(self.levels) - 1
+
+        values = np.asarray(values, dtype=float)
+        index = self.ancestor_index(level_from, level_to)
+        n_out = self.levels[level_to].n_cells
+
+        valid = ~np.isnan(values)
+
+        if how == 'sum':
+            return np.bincount(index[valid], weights=values[valid], minlength=n_out)
+
+        if how == 'mean':
+            w = np.ones_like(values) if weights is None else np.asarray(weights, dtype=float)
+            valid &= ~np.isnan(w)
+            total = np.bincount(index[valid], weights=values[valid] * w[valid], minlength=n_out)
+            weight_sum = np.bincount(index[valid], weights=w[valid], minlength=n_out)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+        raise ValueError(f"Unknown rollup method: {how}")
+
+    def rollup_dataframe(self, df, sum_columns=(), mean_columns=(), weight_column=None, level_from=0, level_to=None):
+        """
+        Roll a per-cell table (e.g. aggregated building metrics or a fishnet) up to a coarser level
+
+        Parameters:
+        - df: DataFrame with a cell_id column ("cell_{i}_{j}" at level_from) and the metric columns
+        - sum_columns: Columns that are summed (areas, volumes, counts)
+        - mean_columns: Columns that are averaged (heights, spectral indices)
+        - weight_column: Optional weight column for the averages
+        - level_from, level_to: Source and target level (default: finest -> coarsest)
+
+        Returns:
+        - DataFrame with cell_id, x_index, y_index at level_to and the rolled-up columns, for every target cell
+          that has at least one source cell in df
+        """
+
+        if level_to is None:
+            level_to = len(self.levels) - 1
+
+        fine = self.levels[level_from]
+        coarse = self.levels[level_to]
+
+        i, j = RegularGrid.parse_cell_ids(df['cell_id'])
+        flat = fine.flat_index(i, j)
+        weights_in = None if weight_column is None else df[weight_column].to_numpy(dtype=float)
+
+        def _dense(column):
+            dense = np.full(fine.n_cells, np.nan)
+            dense[flat] = df[column].to_numpy(dtype=float)
+            return dense
+
+        dense_weights = None
+        if weights_in is not None:
+            dense_weights = np.full(fine.n_cells, np.nan)
+            dense_weights[flat] = weights_in
+
+        present = np.zeros(coarse.n_cells, dtype=bool)
+        present[self.ancestor_index(level_from, level_to)[flat]] = True
+        out_flat = np.flatnonzero(present)
+        out_i, out_j = coarse.unflat_index(out_flat)
+
+        result = pd.DataFrame({
+            'cell_id': coarse.cell_ids(out_i, out_j),
+            'x_index': out_i,
+            'y_index': out_j
+        })
+
+        for column in sum_columns:
+            result[column] = self.rollup(_dense(column), level_from, level_to, how='sum')[out_flat]
+
+        for column in mean_columns:
+            result[column] = self.rollup(_dense(column), level_from, level_to, how='mean',
+                                         weights=dense_weights)[out_flat]
+
+        return result
@@ -1,9 +1,8 @@
 # src/UHI/gridgen.py
 
 from UHI.pyqgis.pyqgis_init import *
+from UHI.grid_engine import build_grid_cells
 import geopandas as gpd
-from shapely.geometry import box
-import numpy as np
 
 def generate_grid(boundary_path, cell_size=100, output_path=None):
     """
@@ -20,27 +19,10 @@ def generate_grid(boundary_path, cell_size=100, output_path=None):
         GeoDataFrame: A grid clipped to the input boundary.
     """
 
-    # Load boundary and project to EPSG:25832
+    # Load boundary and build the grid in one vectorised pass (see UHI.grid_engine)
 
-    boundary = gpd.read_file(boundary_path).to_crs(epsg=25832)
-    total_bounds = boundary.total_bounds  # [minx, miny, maxx, maxy]
-    minx, miny, maxx, maxy = total_bounds
-
-
-    # Create grid cells
-
-    grid_cells = []
-    for x0 in np.arange(minx, maxx, cell_size):
-        for y0 in np.arange(miny, maxy, cell_size):
-            x1, y1 = x0 + cell_size, y0 + cell_size
-            cell = box(x0, y0, x1, y1)
-            if cell.intersects(boundary.union_all()):
-                grid_cells.append(cell)
-
-    grid = gpd.GeoDataFrame({'geometry': grid_cells}, crs='EPSG:25832')
-
-    # Optional: assign unique IDs
-    grid["grid_id"] = [f"cell_{i}" for i in range(len(grid))]
+    boundary = gpd.read_file(boundary_path)
+    grid = build_grid_cells(boundary, cell_size=cell_size, crs='EPSG:25832')
 
     # Save if desired
     if output_path:
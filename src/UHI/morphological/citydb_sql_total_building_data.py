@@ -1,29 +1,11 @@
-from UHI.config import *
-import subprocess
-import psycopg2
+from UHI.morphological.metric_pipeline import run_metric_pipeline
 
-def connect_to_3dcitydb():
+"""
+Building metrics table (citydb.building_metrics), with all the steps it needs.
 
+Runs the 'building_metrics' step of metric_pipeline, which skips it if its inputs haven't changed.
+"""
 
-    conn = psycopg2.connect(
-        dbname=f"{PGCITYDB}",
-        user=f"{PGADMIN}",
-        password=f"{PGADMIN_PASSWORD}",
-        host=f"{PGHOST}",  # or another host
-        port="5432"         # default PostgreSQL port
-    )
 
-    return conn
-
-conn = connect_to_3dcitydb()
-
-cur = conn.cursor()
-
-with open(f"{SQL_DIR}\\total_building_data_query.sql", "r", encoding="utf-8") as f:
-    sql = f.read()
-
-cur.execute(sql)
-
-conn.commit()
-
-cur.close()
\ No newline at end of file
+if __name__ == "__main__":
+    run_metric_pipeline(steps=['building_metrics'])
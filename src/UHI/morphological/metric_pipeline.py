@@ -0,0 +1,286 @@
+from UHI.config import *
+
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import psycopg2
+
+"""
+Dependency-aware, incremental pipeline for the per-building metric tables in the 3DCityDB.
+
+The metric tables used to be built by five separate scripts (citydb_sql_calculate_floor_area.py etc.), each running
+one .sql file with a plain CREATE TABLE, by hand and in the right order. run_metric_pipeline knows the dependency
+graph
+
+    floor_area, roof_area, height -> volume -> building_metrics
+
+and runs every step whose dependencies are done, independent steps concurrently, each on its own connection. A step
+drops its table (DROP TABLE IF EXISTS) and recreates it in one transaction, so a failed step leaves the previous table
+in place.
+
+Steps are skipped when nothing they depend on has changed. The fingerprint of a step is a hash of
+- its SQL text
+- the pg_stat_user_tables insert / update / delete counters and the relfilenode (changes on TRUNCATE) of its source
+  tables in the citydb schema
+- the fingerprints of its upstream steps
+and is stored in citydb.metric_pipeline_state after each successful run. A step only runs again if its fingerprint
+differs from the stored one or its table is missing. Statistics resets (pg_stat_reset) make every step run again,
+which is safe, just slower.
+
+The counters are updated asynchronously: a backend reports its changes when it goes idle, at most about once a
+second. Before reading them the pipeline flushes its own pending statistics (pg_stat_force_next_flush, PostgreSQL
+15+) and drops its cached statistics snapshot (pg_stat_clear_snapshot), but a load committed by another session a
+moment earlier may not be counted yet. Its step is then skipped on stale counters and only rebuilt on the next run.
+Run with force=True right after a data load, or call SELECT pg_stat_force_next_flush() at the end of the loading
+session.
+"""
+
+
+SCHEMA = "citydb"
+STATE_TABLE = f"{SCHEMA}.metric_pipeline_state"
+
+METRIC_STEPS = {
+    'floor_area': {
+        'sql': "calculate_floor_area_query.sql",
+        'table': "floor_area_per_building",
+        'sources': ["feature", "property"],
+        'depends_on': []
+    },
+    'roof_area': {
+        'sql': "calculate_roof_area_query.sql",
+        'table': "roof_area_per_building",
+        'sources': ["feature", "property"],
+        'depends_on': []
+    },
+    'height': {
+        'sql': "calculate_height_query.sql",
+        'table': "height_per_building",
+        'sources': ["feature", "property"],
+        'depends_on': []
+    },
+    'volume': {
+        'sql': "calculate_volume_query.sql",
+        'table': "volume_per_building",
+        'sources': [],
+        'depends_on': ['floor_area', 'height']
+    },
+    'building_metrics': {
+        'sql': "total_building_data_query.sql",
+        'table': "building_metrics",
+        'sources': [],
+        'depends_on': ['volume', 'roof_area']
+    }
+}
+
+
+def connect_to_3dcitydb():
+
+    conn = psycopg2.connect(
+        dbname=f"{PGCITYDB}",
+        user=f"{PGADMIN}",
+        password=f"{PGADMIN_PASSWORD}",
+        host=f"{PGHOST}",
+        port=f"{PGPORT}"
+    )
+
+    return conn
+
+
+def read_step_sql(step):
+    with open(SQL_DIR / METRIC_STEPS[step]['sql'], "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _with_dependencies(steps):
+    """steps plus everything upstream of them, in a valid execution order"""
+
+    ordered = []
+
+    def _visit(step, path=()):
+        if step in path:
+            raise ValueError(f"Dependency cycle: {' -> '.join(path + (step,))}")
+        if step in ordered:
+            return
+        for upstream in METRIC_STEPS[step]['depends_on']:
+            _visit(upstream, path + (step,))
+        ordered.append(step)
+
+    for step in steps:
+        if step not in METRIC_STEPS:
+            raise ValueError(f"Unknown step '{step}' (steps: {list(METRIC_STEPS)})")
+        _visit(step)
+
+    return ordered
+
+
+def _ensure_state_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            step text PRIMARY KEY,
+            table_name text NOT NULL,
+            fingerprint text NOT NULL,
+            seconds double precision,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        );
+        """)
+
+
+def _stored_state(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT step, fingerprint FROM {STATE_TABLE}")
+        return dict(cur.fetchall())
+
+
+def _table_exists(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.{table}",))
+        return cur.fetchone()[0]
+
+
+def _source_counters(conn, tables):
+    """Change counters of the source tables, {table: [relfilenode, inserts, updates, deletes]} (None if missing)"""
+
+    if not tables:
+        return {}
+
+    with conn.cursor() as cur:
+        # Don't read counters older than what this session has reported, or from a cached snapshot
+        if conn.server_version >= 150000:
+            cur.execute("SELECT pg_stat_force_next_flush()")
+        cur.execute("SELECT pg_stat_clear_snapshot()")
+
+        cur.execute("""
+        SELECT relname, pg_relation_filenode(relid), n_tup_ins, n_tup_upd, n_tup_del
+        FROM pg_stat_user_tables
+        WHERE schemaname = %s AND relname = ANY(%s)
+        """, (SCHEMA, list(tables)))
+        counters = {row[0]: list(row[1:]) for row in cur.fetchall()}
+
+    return {table: counters.get(table) for table in sorted(tables)}
+
+
+def step_fingerprint(conn, step, sql, upstream_fingerprints):
+    """Hash of the SQL text, the source table counters and the upstream fingerprints of a step"""
+
+    payload = {
+        'sql': sql,
+        'sources': _source_counters(conn, METRIC_STEPS[step]['sources']),
+        'upstream': {name: upstream_fingerprints.get(name) for name in METRIC_STEPS[step]['depends_on']}
+    }
+
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _run_step(step, sql, fingerprint):
+    """Drop and rebuild the table of a step on its own connection, and record its fingerprint"""
+
+    table = METRIC_STEPS[step]['table']
+    start_time = time.perf_counter()
+
+    conn = connect_to_3dcitydb()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA}, public")
+            cur.execute(f"DROP TABLE IF EXISTS {SCHEMA}.{table}")
+            cur.execute(sql)
+
+            seconds = time.perf_counter() - start_time
+            cur.execute(f"""
+            INSERT INTO {STATE_TABLE} (step, table_name, fingerprint, seconds, updated_at)
+            VALUES (%s, %s, %s, %s, now())
+            ON CONFLICT (step) DO UPDATE
+            SET table_name = EXCLUDED.table_name, fingerprint = EXCLUDED.fingerprint,
+                seconds = EXCLUDED.seconds, updated_at = EXCLUDED.updated_at
+            """, (step, table, fingerprint, seconds))
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return seconds
+
+
+def run_metric_pipeline(steps=None, with_dependencies=True, force=False, workers=3):
+    """
+    Build the per-building metric tables, skipping the steps whose inputs haven't changed
+
+    Parameters:
+    - steps: Steps to build (default: all of METRIC_STEPS)
+    - with_dependencies: Also bring the upstream steps up to date (they are still skipped if unchanged)
+    - force: Rebuild the steps even if their fingerprint is unchanged
+    - workers: Maximum number of steps (and connections) running at the same time
+
+    Returns:
+    - {step: 'built' | 'skipped'}
+    """
+
+    steps = list(steps or METRIC_STEPS)
+    steps = _with_dependencies(steps) if with_dependencies else steps
+    sql_text = {step: read_step_sql(step) for step in steps}
+
+    # Only reads state and statistics, autocommit so it doesn't sit idle in a transaction while the steps run
+    conn = connect_to_3dcitydb()
+    conn.autocommit = True
+    _ensure_state_table(conn)
+    stored = _stored_state(conn)
+
+    print(f"🔧 Metric pipeline: {', '.join(steps)} (up to {workers} steps at a time)")
+
+    fingerprints = dict(stored)
+    status = {}
+    pending = list(steps)
+    running = {}
+    start_time = time.perf_counter()
+
+    def _ready(step):
+        return all(upstream in status or upstream not in steps for upstream in METRIC_STEPS[step]['depends_on'])
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for step in [step for step in pending if _ready(step)]:
+                    pending.remove(step)
+
+                    fingerprint = step_fingerprint(conn, step, sql_text[step], fingerprints)
+                    table = METRIC_STEPS[step]['table']
+
+                    if not force and stored.get(step) == fingerprint and _table_exists(conn, table):
+                        fingerprints[step] = fingerprint
+                        status[step] = 'skipped'
+                        print(f"✓ {step}: {SCHEMA}.{table} is up to date")
+                        continue
+
+                    print(f"🔧 {step}: building {SCHEMA}.{table}...")
+                    running[executor.submit(_run_step, step, sql_text[step], fingerprint)] = (step, fingerprint)
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, fingerprint = running.pop(future)
+                    seconds = future.result()
+                    fingerprints[step] = fingerprint
+                    status[step] = 'built'
+                    print(f"✅ {step}: {SCHEMA}.{METRIC_STEPS[step]['table']} built in {seconds:.1f}s")
+
+    finally:
+        conn.close()
+
+    built = [step for step, state in status.items() if state == 'built']
+    print(f"🎉 Metric pipeline finished in {time.perf_counter() - start_time:.1f}s "
+          f"({len(built)} built, {len(status) - len(built)} skipped)")
+
+    return status
+
+
+if __name__ == "__main__":
+    run_metric_pipeline()
@@ -0,0 +1,274 @@
+from UHI.config import *
+
+import datetime
+import os
+import re
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+"""
+Local seasonal median composites with cloud masking.
+
+The seasonal assets (Landsat_2021_Winter_Coburg_EPSG25832_Masked etc.) are GEE median composites of the scenes with
+CLOUD_COVER < 20. composite_season builds the same kind of composite from a directory of downloaded scenes:
+
+- scenes are found by their file names (Landsat Collection 2 Level-2 and Sentinel-2 L2A) and filtered by date
+- clouds are masked per pixel from the QA band, decoded vectorised: QA_PIXEL bits (fill, dilated cloud, cirrus,
+  cloud, cloud shadow, optionally snow) for Landsat, SCL classes for Sentinel-2
+- the per-pixel median over the unmasked scenes is computed tile by tile on a process pool, so memory depends on the
+  tile size and number of scenes, not on the raster size
+- every input is read through a WarpedVRT on one target grid, so 20m bands and SCL line up with the 10m bands
+
+The composite keeps the original band names as band descriptions (in DN, not scaled), so it can be fed straight into
+compute_spectral_indices (see index_band_paths) and compute_lst, whose outputs are what the fishnet sampler reads.
+"""
+
+
+# Landsat 8/9 Collection 2 Level-2, e.g. LC08_L2SP_193025_20240715_20240722_02_T1_SR_B4.TIF
+LANDSAT_PATTERN = re.compile(r"^(L[CO]0[89]_L2SP_\d{6}_(\d{8})_\d{8}_\d{2}_(?:T1|T2|RT))_(.+)\.tif$", re.IGNORECASE)
+
+# Sentinel-2 L2A, e.g. T32UPA_20240715T102031_B04_10m.jp2 or T32UPA_20240715T102031_SCL_20m.tif
+SENTINEL2_PATTERN = re.compile(r"^(T\d{2}[A-Z]{3}_(\d{8})T\d{6})_(B\d{2}|B8A|SCL)(?:_\d{2}m)?\.(?:jp2|tif)$",
+                               re.IGNORECASE)
+
+SENSORS = {
+    'landsat': {
+        'pattern': LANDSAT_PATTERN,
+        'qa_band': 'QA_PIXEL',
+        'bands': ['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'ST_B10']
+    },
+    'sentinel2': {
+        'pattern': SENTINEL2_PATTERN,
+        'qa_band': 'SCL',
+        'bands': ['B02', 'B03', 'B04', 'B08', 'B11']
+    }
+}
+
+# QA_PIXEL bits: 0 fill, 1 dilated cloud, 2 cirrus, 3 cloud, 4 cloud shadow, 5 snow
+LANDSAT_MASK_BITS = (0, 1, 2, 3, 4)
+LANDSAT_SNOW_BIT = 5
+
+# SCL classes: 0 no data, 1 saturated/defective, 3 cloud shadow, 8/9 cloud medium/high probability, 10 thin cirrus,
+# 11 snow
+SENTINEL2_MASK_CLASSES = (0, 1, 3, 8, 9, 10)
+SENTINEL2_SNOW_CLASS = 11
+
+# Composite band -> band name used by the spectral index expressions
+INDEX_BANDS = {
+    'landsat': {'blue': 'SR_B2', 'green': 'SR_B3', 'red': 'SR_B4', 'nir': 'SR_B5', 'swir1': 'SR_B6'},
+    'sentinel2': {'blue': 'B02', 'green': 'B03', 'red': 'B04', 'nir': 'B08', 'swir1': 'B11'}
+}
+
+
+def find_scenes(scene_dir, sensor='landsat', start_date=None, end_date=None):
+    """
+    Group the band files in scene_dir (recursively) into scenes
+
+    Parameters:
+    - scene_dir: Directory with the downloaded scenes
+    - sensor: 'landsat' or 'sentinel2'
+    - start_date, end_date: Optional date window (inclusive), as datetime.date or "YYYY-MM-DD"
+
+    Returns:
+    - List of {'scene_id', 'date', 'bands': {band name: path}} sorted by date
+    """
+
+    pattern = SENSORS[sensor]['pattern']
+    start_date = datetime.date.fromisoformat(str(start_date)) if start_date is not None else None
+    end_date = datetime.date.fromisoformat(str(end_date)) if end_date is not None else None
+
+    scenes = {}
+    for path in Path(scene_dir).rglob("*"):
+        match = pattern.match(path.name)
+        if match is None:
+            continue
+
+        scene_id, date_string, band = match.group(1), match.group(2), match.group(3).upper()
+        date = datetime.datetime.strptime(date_string, "%Y%m%d").date()
+
+        if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+            continue
+
+        scene = scenes.setdefault(scene_id, {'scene_id': scene_id, 'date': date, 'bands': {}})
+        scene['bands'][band] = str(path)
+
+    return sorted(scenes.values(), key=lambda scene: (scene['date'], scene['scene_id']))
+
+
+def cloud_mask(qa, sensor='landsat', mask_snow=False):
+    """
+    Boolean mask of the pixels to drop, decoded from a QA_PIXEL (bit flags) or SCL (classes) array
+    """
+
+    qa = np.asarray(qa)
+
+    if sensor == 'landsat':
+        bits = LANDSAT_MASK_BITS + ((LANDSAT_SNOW_BIT,) if mask_snow else ())
+        flags = sum(1 << bit for bit in bits)
+        return (qa.astype(np.uint16) & flags) != 0
+
+    if sensor == 'sentinel2':
+        classes = SENTINEL2_MASK_CLASSES + ((SENTINEL2_SNOW_CLASS,) if mask_snow else ())
+        return np.isin(qa, classes)
+
+    raise ValueError(f"Unknown sensor: {sensor}")
+
+
+def _composite_tile(task):
+    """
+    Worker: masked median of one window over all scenes
+
+    task = (window tuple, scenes, bands, qa band, sensor, mask_snow, target grid (crs, transform, width, height))
+    """
+
+    (col_off, row_off, width, height), scenes, bands, qa_band, sensor, mask_snow, target = task
+    window = Window(col_off, row_off, width, height)
+    crs, transform, target_width, target_height = target
+
+    stack = np.full((len(scenes), len(bands), height, width), np.nan, dtype=np.float32)
+
+    def _read(path, resampling):
+        with rasterio.open(path) as src:
+            with WarpedVRT(src, crs=crs, transform=transform, width=target_width, height=target_height,
+                           resampling=resampling) as vrt:
+                return vrt.read(1, window=window, masked=True)
+
+    for scene_pos, scene in enumerate(scenes):
+        qa = _read(scene['bands'][qa_band], Resampling.nearest)
+        # Pixels outside the scene footprint count as masked too
+        drop = cloud_mask(np.ma.getdata(qa), sensor=sensor, mask_snow=mask_snow) | np.ma.getmaskarray(qa)
+
+        if drop.all():
+            continue
+
+        for band_pos, band in enumerate(bands):
+            data = _read(scene['bands'][band], Resampling.nearest)
+            values = np.ma.getdata(data).astype(np.float32)
+            values[drop | np.ma.getmaskarray(data)] = np.nan
+            stack[scene_pos, band_pos] = values
+
+    with warnings.catch_warnings():
+        # All-NaN pixels (no clear scene) are expected and stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(stack, axis=0)
+
+    # A scene counts for a pixel if it has a value in any band, not only in the first one
+    valid_scenes = np.count_nonzero(~np.isnan(stack).all(axis=1), axis=0).astype(np.float32)
+
+    return col_off, row_off, width, height, np.concatenate([median, valid_scenes[None]], axis=0)
+
+
+def composite_season(scene_dir, output_path, sensor='landsat', start_date=None, end_date=None, bands=None,
+                     mask_snow=False, reference_band=None, tile_size=512, workers=None):
+    """
+    Per-pixel cloud-masked median composite of all scenes in a date window
+
+    Parameters:
+    - scene_dir: Directory with the downloaded scenes
+    - output_path: Output COG (one band per input band plus a valid_scenes band, float32 with NaN). valid_scenes
+                   is the number of scenes with a clear value in at least one band at that pixel
+    - sensor: 'landsat' or 'sentinel2'
+    - start_date, end_date: Season window, e.g. "2024-06-01", "2024-08-31"
+    - bands: Bands to composite (default: the bands the index / LST code needs)
+    - mask_snow: Also mask snow (off by default, winter composites need it)
+    - reference_band: Band whose grid (of the first scene) is the output grid (default: the first band, 10m for
+                      Sentinel-2). All scenes must be in one CRS.
+    - tile_size: Tile edge length in pixels (memory per worker ~ scenes x bands x tile_size^2 x 4 bytes)
+    - workers: Number of worker processes (default: os.cpu_count(), 1 runs in this process)
+
+    Returns:
+    - Dict with scenes, pixels, seconds and megapixels_per_second
+    """
+
+    bands = list(bands or SENSORS[sensor]['bands'])
+    qa_band = SENSORS[sensor]['qa_band']
+
+    scenes = find_scenes(scene_dir, sensor=sensor, start_date=start_date, end_date=end_date)
+    complete = [scene for scene in scenes if all(band in scene['bands'] for band in bands + [qa_band])]
+
+    for scene in scenes:
+        if scene not in complete:
+            missing = [band for band in bands + [qa_band] if band not in scene['bands']]
+            print(f"⚠️ Skipping {scene['scene_id']}, missing bands: {missing}")
+
+    if not complete:
+        raise ValueError(f"No complete {sensor} scenes in {scene_dir} between {start_date} and {end_date}")
+
+    with rasterio.open(complete[0]['bands'][reference_band or bands[0]]) as ref:
+        target = (ref.crs, ref.transform, ref.width, ref.height)
+
+    crs, transform, width, height = target
+    windows = [(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+               for row_off in range(0, height, tile_size)
+               for col_off in range(0, width, tile_size)]
+    tasks = [(window, complete, bands, qa_band, sensor, mask_snow, target) for window in windows]
+
+    workers = workers or os.cpu_count() or 1
+    print(f"🔧 Compositing {len(complete)} {sensor} scenes ({complete[0]['date']} - {complete[-1]['date']}), "
+          f"{width}x{height} pixels in {len(windows)} tiles on {workers} workers")
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    start_time = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as tmp_dir:
+        tmp_path = Path(tmp_dir) / "composite.tif"
+        profile = {
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'count': len(bands) + 1,
+            'dtype': 'float32',
+            'crs': crs,
+            'transform': transform,
+            'nodata': np.nan,
+            'tiled': True,
+            'blockxsize': 512,
+            'blockysize': 512
+        }
+
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for band_number, band in enumerate(bands + ['valid_scenes'], start=1):
+                dst.set_band_description(band_number, band)
+
+            def _write(tile):
+                col_off, row_off, tile_width, tile_height, out = tile
+                dst.write(out, window=Window(col_off, row_off, tile_width, tile_height))
+
+            if workers <= 1:
+                for task in tasks:
+                    _write(_composite_tile(task))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for tile in executor.map(_composite_tile, tasks):
+                        _write(tile)
+
+        rasterio.shutil.copy(tmp_path, output_path, driver='COG', compress='DEFLATE', predictor=3,
+                             overview_resampling='average')
+
+    seconds = time.perf_counter() - start_time
+    stats = {
+        'scenes': [scene['scene_id'] for scene in complete],
+        'pixels': width * height,
+        'seconds': round(seconds, 3),
+        'megapixels_per_second': round(width * height / 1e6 / seconds, 2) if seconds > 0 else None
+    }
+
+    print(f"✅ Wrote {output_path} in {seconds:.1f}s")
+
+    return stats
+
+
+def index_band_paths(composite_path, sensor='sentinel2'):
+    """band_paths for compute_spectral_indices from a composite written by composite_season"""
+
+    return {name: (str(composite_path), band) for name, band in INDEX_BANDS[sensor].items()}
@@ -1,9 +1,14 @@
 import sys
 
 from UHI.config import *
-from UHI.gee_init import gee_init
+from UHI.gee_init import gee_init, get_session
+from UHI.raster_spectral.gee_dispatch import AdaptiveBatchSizer, dispatch_adaptive, dispatch_batches
+from UHI.raster_spectral.sampling_checkpoint import SamplingCheckpoint, grid_hash, image_fingerprint, missing_batches
+from UHI.regular_grid import RegularGrid
 
 import datetime
+import json
+import time
 import geopandas as gpd
 import numpy as np
 import pandas as pd
@@ -21,7 +26,75 @@ In this way, it achieves the conversion of raster band data to decimal values fo
 # TODO Add logic to push local Postgres raster fishnet
 
 
-def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path, _to_file_driver="GPKG", scale=30, _batch_size=200):
+# Value used to unmask stacked bands, so a masked pixel in one band doesn't drop the point for all the other bands
+STACK_NODATA = -9999
+
+
+def stack_gee_rasters(gee_raster_dict, ee_client=ee):
+    """
+    Stack all rasters into one multi-band image, with each band renamed to its raster name
+
+    Masked pixels are filled with STACK_NODATA, which is turned back into NaN when the batch results are read.
+    Each raster in the dict must be a single band image (e.g. sentinel_asset.select([0], ['NDVI'])).
+    """
+
+    return ee_client.Image.cat([
+        gee_image.rename(raster_name).unmask(STACK_NODATA)
+        for raster_name, gee_image in gee_raster_dict.items()
+    ])
+
+
+def _sample_batch(gee_image, batch_coords, batch_start, scale, tile_scale=1, ee_client=ee):
+    """
+    Sample one batch of centroids and return the sampled features (cell_id = position of the point in the grid)
+    """
+
+    # Create batch points
+    batch_points = ee_client.FeatureCollection([
+        ee_client.Feature(ee_client.Geometry(
+    {'type': 'Point', 'coordinates': coord},
+            proj='EPSG:25832'                           ### MUST EXPLICITLY SET 25832 PROJECTION BECAUSE
+        ), {'cell_id': batch_start + i})        # ee methods always work in WGS84 unless instructed otherwise
+        for i, coord in enumerate(batch_coords)
+    ])
+
+    sampled = gee_image.sampleRegions(
+        collection=batch_points,
+        scale=scale,
+        geometries=False,
+        tileScale=tile_scale
+    )
+
+    return get_session().get_info(sampled, 'sampleRegions')['features']
+
+
+def _assign_batch_values(sampled_list, values, stacked=False):
+    """
+    Write the sampled features of one batch into values ({column: list of values}, indexed by cell_id)
+    """
+
+    for feature in sampled_list:
+        cell_idx = feature['properties']['cell_id']
+
+        if stacked:
+            # One property per stacked band, named after the raster
+            for column, column_values in values.items():
+                value = feature['properties'].get(column)
+                column_values[cell_idx] = np.nan if value is None or value == STACK_NODATA else value
+
+        else:
+            # Get the raster value (first property that's not cell_id)
+            raster_props = {k: v for k, v in feature['properties'].items() if k != 'cell_id'}
+            if raster_props:
+                value = list(raster_props.values())[0]
+                column_values = next(iter(values.values()))
+                column_values[cell_idx] = value if value is not None else np.nan
+
+
+def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path, _to_file_driver="GPKG", scale=30, _batch_size=200,
+                                    grid=None, stack_bands=False, max_in_flight=1, requests_per_second=None, max_retries=3,
+                                    ee_client=ee, checkpoint_dir=None, adaptive_batching=False,
+                                    backend=None):
     """
     Simple function to sample GEE rasters at grid centroids
 
@@ -30,11 +103,34 @@ def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path
     gee_raster_dict: dictionary with raster names and their GEE image objects
                     e.g., {'LST': ee.Image('your/lst/asset'), 'NDVI': ee.Image('your/ndvi/asset')}
     output_path: where to save the result
+    grid: optional RegularGrid the grid file was built from. When given, centroids are computed from the cell_id
+          indices with integer arithmetic instead of from the cell geometries. For cells clipped at the boundary
+          this is the centre of the full square cell rather than of the clipped polygon.
+    stack_bands: if True, all rasters (also from different assets) are stacked into one multi-band image, so each
+                 batch is sampled with a single request and all columns are filled from one response, instead of
+                 one round trip per raster and batch
+    max_in_flight: number of batches sampled concurrently (1 = one after another)
+    requests_per_second: optional limit on the rate requests are sent to GEE
+    max_retries: retries per batch for transient errors (throttling, timeouts), with exponential backoff
+    ee_client: the ee module, or a FakeEEClient (tests/fake_ee.py) to run the sampler offline
+    checkpoint_dir: optional directory where every completed batch is stored, keyed by (asset, band, grid hash,
+                    scale). A re-run with the same directory only fetches the missing batches. If a raster fails,
+                    the cells of its completed batches keep their values and only the rest are NaN.
+    adaptive_batching: if True, _batch_size is only the starting size. Batches grow while responses stay fast and
+                       under the payload limit, and shrink (or tileScale is raised) on "too many", payload and memory
+                       errors. The chosen sizes and per-batch latencies are saved in the run metadata (.json next to
+                       the output file, and result_gdf.attrs['sampling_metadata'])
+    backend: optional raster backend, e.g. raster_backends.LocalRasterBackend(). The values of gee_raster_dict are
+             then local GeoTIFF/COG exports (path or (path, band)) instead of GEE images, and are read with windowed
+             reads at the pixel each centroid falls in, without any GEE requests (the GEE options above are ignored)
 
     Returns:
     GeoDataFrame with sampled values
     """
 
+    if backend is None and ee_client is ee:
+        get_session().initialize()
+
     # Load existing grid
     print(f"Loading grid from: {grid_file_path}")
     grid_gdf = gpd.read_file(grid_file_path)
@@ -46,36 +142,44 @@ def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path
 
     print(f"Loaded grid with {len(grid_gdf)} cells")
 
-    # Calculate centroids
-    print("Calculating centroids...")
+    if grid is not None:
+        # Centroids straight from the grid parameters, no geometry work
+        print("Calculating centroids from grid indices...")
+        x_index, y_index = RegularGrid.parse_cell_ids(grid_gdf['cell_id'])
+        centroid_x, centroid_y = grid.cell_centroid(x_index, y_index)
+        coords = np.column_stack([centroid_x, centroid_y]).tolist()
+
+    else:
+        # Calculate centroids
+        print("Calculating centroids...")
 
-    # Calculate centroids in the original CRS (which should be projected)
-    grid_gdf['centroid_projected'] = grid_gdf.geometry.centroid
+        # Calculate centroids in the original CRS (which should be projected)
+        grid_gdf['centroid_projected'] = grid_gdf.geometry.centroid
 
-    # Convert to WGS84 for GEE
+        # Convert to WGS84 for GEE
 
-    if grid_gdf.crs == 'EPSG:4326':
+        if grid_gdf.crs == 'EPSG:4326':
 
-        centroids_utm = grid_gdf.copy()
+            centroids_utm = grid_gdf.copy()
 
-        #centroids_wgs84 = grid_gdf.to_crs('EPSG:4326')
-        # Transform the projected centroids to WGS84
-        # centroid_gdf = gpd.GeoDataFrame(
-        #     geometry=grid_gdf['centroid_projected'],
-        #     crs=grid_gdf.crs
-        # ).to_crs('EPSG:4326')
-        # centroids_wgs84['centroid'] = centroid_gdf.geometry
-    else:
-        centroids_utm = grid_gdf.to_crs('EPSG:25832')
+            #centroids_wgs84 = grid_gdf.to_crs('EPSG:4326')
+            # Transform the projected centroids to WGS84
+            # centroid_gdf = gpd.GeoDataFrame(
+            #     geometry=grid_gdf['centroid_projected'],
+            #     crs=grid_gdf.crs
+            # ).to_crs('EPSG:4326')
+            # centroids_wgs84['centroid'] = centroid_gdf.geometry
+        else:
+            centroids_utm = grid_gdf.to_crs('EPSG:25832')
 
-    centroids_utm['centroid'] = centroids_utm.geometry.centroid
+        centroids_utm['centroid'] = centroids_utm.geometry.centroid
 
-        # centroids_wgs84 = grid_gdf.copy()
-        # centroids_wgs84['centroid'] = centroids_wgs84.geometry.centroid
+            # centroids_wgs84 = grid_gdf.copy()
+            # centroids_wgs84['centroid'] = centroids_wgs84.geometry.centroid
 
 
-    # Convert centroids to GEE points
-    coords = [[point.x, point.y] for point in centroids_utm['centroid']]
+        # Convert centroids to GEE points
+        coords = [[point.x, point.y] for point in centroids_utm['centroid']]
 
 
     # Sample each raster
@@ -92,91 +196,137 @@ def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path
 
 
 
-    for raster_name, gee_image in gee_raster_dict.items():
-        print(f"Sampling {raster_name}...")
-
-        try:
-
-            values = [np.nan] * len(grid_gdf)
+    grid_fingerprint = grid_hash(coords) if checkpoint_dir is not None else None
+    failed_jobs = []
 
+    run_metadata = {
+        'grid_file': str(grid_file_path),
+        'cells': len(coords),
+        'backend': 'gee' if backend is None else backend.name,
+        'scale': scale,
+        'batch_size': batch_size,
+        'adaptive_batching': adaptive_batching,
+        'max_in_flight': max_in_flight,
+        'stack_bands': stack_bands,
+        'rasters': {}
+    }
 
-            valid_count = len([v for v in values if not np.isnan(v)])
-            running_total = valid_count + batch_size
+    if backend is not None:
+        # Local rasters: windowed reads, no requests and no batching
+        print(f"Sampling {len(gee_raster_dict)} rasters with {backend}...")
+        start_time = time.perf_counter()
+        local_values = backend.sample(gee_raster_dict, coords)
+
+        for column, column_values in local_values.items():
+            result_gdf[column] = column_values
+            run_metadata['rasters'][column] = {'source': str(gee_raster_dict[column]),
+                                               'missing_cells': int(np.isnan(column_values).sum())}
+
+        run_metadata['seconds'] = round(time.perf_counter() - start_time, 3)
+        print(f"✓ Sampled {len(coords)} points in {run_metadata['seconds']}s")
+        sampling_jobs = {}
+
+    elif stack_bands:
+        # One multi-band image, so every batch is only sampled once for all rasters
+        sampling_jobs = {'+'.join(gee_raster_dict): (stack_gee_rasters(gee_raster_dict, ee_client=ee_client),
+                                                     list(gee_raster_dict))}
+    else:
+        sampling_jobs = {raster_name: (gee_image, [raster_name]) for raster_name, gee_image in gee_raster_dict.items()}
 
-            # Process points in batches
-            for batch_start in range(0, len(coords), batch_size):
-                batch_end = min(batch_start + batch_size, len(coords))
-                batch_coords = coords[batch_start:batch_end]
+    for job_name, (gee_image, column_names) in sampling_jobs.items():
+        print(f"Sampling {job_name}...")
 
-                print(f"  - Processing batch {batch_start//batch_size + 1}/{(len(coords)-1)//batch_size + 1} ({len(batch_coords)} points)")
+        values = {column: [np.nan] * len(grid_gdf) for column in column_names}
+        done = np.zeros(len(coords), dtype=bool)
+        checkpoint = None
 
-                ##
-                # print(f"Grid CRS: {grid_gdf.crs}")
-                # print(f"Sample coordinates (first 3): {coords[:3]}")
-                # print(f"Coordinate bounds:")
-                # print(f"  X: [{min(c[0] for c in coords):.1f}, {max(c[0] for c in coords):.1f}]")
-                # print(f"  Y: [{min(c[1] for c in coords):.1f}, {max(c[1] for c in coords):.1f}]")
+        if checkpoint_dir is not None:
+            # Load the batches a previous run already completed
+            checkpoint = SamplingCheckpoint(checkpoint_dir, image_fingerprint(gee_image, job_name),
+                                            '+'.join(column_names), grid_fingerprint, scale)
+            for batch_start, batch_end, sampled_list in checkpoint.load_batches():
+                _assign_batch_values(sampled_list, values, stacked=stack_bands)
+                done[batch_start:batch_end] = True
 
+            if done.any():
+                print(f"  - Resuming from checkpoint: {done.sum()}/{len(done)} cells already sampled")
 
-                # Create batch points
-                batch_points = ee.FeatureCollection([
-                    ee.Feature(ee.Geometry(
-                {'type': 'Point', 'coordinates': coord},
-                        proj='EPSG:25832'                           ### MUST EXPLICITLY SET 25832 PROJECTION BECAUSE
-                    ), {'cell_id': batch_start + i})        # ee methods always work in WGS84 unless instructed otherwise
-                    for i, coord in enumerate(batch_coords)
-                ])
+        job_metadata = {'columns': column_names, 'cells_from_checkpoint': int(done.sum())}
+        run_metadata['rasters'][job_name] = job_metadata
 
-                ## Debug the points
-                # print(f"    Created {batch_points.size().getInfo()} points")
-                # print(f"    First point info: {batch_points.first().getInfo()}")
+        def _store_batch(batch_start, batch_end, sampled_list):
+            if checkpoint is not None:
+                checkpoint.save_batch(batch_start, batch_end, sampled_list)
 
-                ## Check if points are valid
-                # try:
-                #     bounds = batch_points.geometry().bounds().getInfo()
-                #     print(f"    Batch bounds: {bounds}")
-                # except Exception as e:
-                #     print(f"    Error getting batch bounds: {e}")
+            # Assign straight away (batches cover disjoint cells), so completed batches survive a later failure
+            _assign_batch_values(sampled_list, values, stacked=stack_bands)
+            done[batch_start:batch_end] = True
 
+        try:
 
-                # Sample the batch
-                sampled = gee_image.sampleRegions(
-                    collection=batch_points,
-                    scale=scale,
-                    geometries=False,
-                    tileScale=1
-                )
+            if adaptive_batching:
+                # Batch sizes (and tileScale) are chosen on the fly from the responses
+                sizer = AdaptiveBatchSizer(initial_size=batch_size)
+                job_metadata['adaptive_batching'] = sizer.metadata()
 
+                print(f"  - Dispatching {(~done).sum()} points in adaptive batches, starting at {batch_size} "
+                      f"({max_in_flight} in flight)")
 
-                # Get batch results
-                sampled_list = sampled.getInfo()['features']
-                print(f"    Batch returned {len(sampled_list)} features")
+                def _run_adaptive_batch(batch_start, batch_end, tile_scale):
+                    sampled_list = _sample_batch(gee_image, coords[batch_start:batch_end], batch_start, scale,
+                                                 tile_scale=tile_scale, ee_client=ee_client)
+                    _store_batch(batch_start, batch_end, sampled_list)
+                    return len(json.dumps(sampled_list))
 
-                # Extract values and assign for this batch
+                try:
+                    dispatch_adaptive(_run_adaptive_batch, missing_batches(done, max(1, len(coords))), sizer,
+                                      max_in_flight=max_in_flight, requests_per_second=requests_per_second,
+                                      max_retries=max_retries)
+                finally:
+                    job_metadata['adaptive_batching'] = sizer.metadata()
 
-                for feature in sampled_list:
-                    cell_idx = feature['properties']['cell_id']
-                    # Get the raster value (first property that's not cell_id)
-                    raster_props = {k: v for k, v in feature['properties'].items() if k != 'cell_id'}
-                    if raster_props:
-                        value = list(raster_props.values())[0]
-                        values[cell_idx] = value if value is not None else np.nan
+            else:
+                # Process the missing points in batches, with up to max_in_flight batches in flight
+                batches = missing_batches(done, batch_size)
+                batch_log = []
+                job_metadata['batches'] = batch_log
+
+                print(f"  - Dispatching {len(batches)} batches of up to {batch_size} points "
+                      f"({max_in_flight} in flight)")
+
+                def _run_batch(batch):
+                    batch_start, batch_end = batch
+                    start_time = time.perf_counter()
+                    sampled_list = _sample_batch(gee_image, coords[batch_start:batch_end], batch_start, scale,
+                                                 ee_client=ee_client)
+                    batch_log.append({'batch_start': batch_start, 'size': batch_end - batch_start,
+                                      'latency_s': round(time.perf_counter() - start_time, 3)})
+                    _store_batch(batch_start, batch_end, sampled_list)
+
+                dispatch_batches(_run_batch, batches, max_in_flight=max_in_flight,
+                                 requests_per_second=requests_per_second, max_retries=max_retries)
 
+        except Exception as e:
+            print(f"✗ Error sampling {job_name}: {e}")
+            print(f"  {(~done).sum()}/{len(done)} cells were not sampled"
+                  + (", re-run with the same checkpoint_dir to resume" if checkpoint is not None else ""))
+            failed_jobs.append(job_name)
+            job_metadata['error'] = str(e)
 
-                print(f"    Running total: {running_total} valid values so far")
+        job_metadata['missing_cells'] = int((~done).sum())
 
-            result_gdf[raster_name] = values
-            print(f"✓ Successfully sampled {raster_name}")
+        for column in column_names:
+            result_gdf[column] = values[column]
+            print(f"✓ Sampled {column}")
 
-            valid_data = [v for v in values if not np.isnan(v)]
-            print(f"✓ {raster_name}: {len(valid_data)} valid values")
+            valid_data = [v for v in values[column] if not np.isnan(v)]
+            print(f"✓ {column}: {len(valid_data)} valid values")
             if valid_data:
                 print(f"  Sample values: {valid_data[:5]}")  # Show first 5 values
                 print(f"  Range: {min(valid_data):.3f} to {max(valid_data):.3f}")
 
-        except Exception as e:
-            print(f"✗ Error sampling {raster_name}: {e}")
-            result_gdf[raster_name] = np.nan
+    if failed_jobs:
+        print(f"⚠️ Incomplete rasters: {', '.join(failed_jobs)}")
 
     # Save result with timestamp
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -187,12 +337,39 @@ def sample_gee_rasters_at_centroids(grid_file_path, gee_raster_dict, output_path
 
     result_gdf.to_file(str(_output_path), driver=_to_file_driver)
 
+    # Run metadata (batch sizes, latencies, failures) next to the output
+    run_metadata['failed_rasters'] = failed_jobs
+    result_gdf.attrs['sampling_metadata'] = run_metadata
+    _output_path.with_suffix(".json").write_text(json.dumps(run_metadata, indent=2), encoding="utf-8")
+
     #output_path = output_path.replace('.gpkg', f'_{timestamp}.gpkg')
 
     print(f"Saved result to: {str(_output_path)}")
 
     return result_gdf
 
+def get_raster_projection(gee_image):
+    """
+    Get the projection of the first band of a GEE image
+
+    Returns:
+    dict with crs, crs_transform ([xScale, xShear, xTranslation, yShear, yScale, yTranslation]) and dimensions,
+    or None if the image has no band information
+    """
+
+    img_info = get_session().get_info(gee_image, 'image_info')
+
+    if 'bands' not in img_info or len(img_info['bands']) == 0:
+        return None
+
+    band = img_info['bands'][0]
+
+    return {
+        'crs': band.get('crs', 'Unknown'),
+        'crs_transform': band.get('crs_transform', 'Unknown'),
+        'dimensions': band.get('dimensions', 'Unknown')
+    }
+
 def check_raster_crs(gee_raster_dict):
     """Check the CRS of all GEE rasters"""
 
@@ -201,19 +378,14 @@ def check_raster_crs(gee_raster_dict):
 
     for raster_name, gee_image in gee_raster_dict.items():
         try:
-            # Get image info
-            img_info = gee_image.getInfo()
-
-            # Extract CRS from the first band
-            if 'bands' in img_info and len(img_info['bands']) > 0:
-                crs = img_info['bands'][0].get('crs', 'Unknown')
-                crs_transform = img_info['bands'][0].get('crs_transform', 'Unknown')
-                dimensions = img_info['bands'][0].get('dimensions', 'Unknown')
+            # Get projection of the first band
+            projection = get_raster_projection(gee_image)
 
+            if projection is not None:
                 print(f"{raster_name}:")
-                print(f"  CRS: {crs}")
-                print(f"  Transform: {crs_transform}")
-                print(f"  Dimensions: {dimensions}")
+                print(f"  CRS: {projection['crs']}")
+                print(f"  Transform: {projection['crs_transform']}")
+                print(f"  Dimensions: {projection['dimensions']}")
                 print()
             else:
                 print(f"{raster_name}: No band information available")
@@ -233,6 +405,7 @@ def sample_summer_2024():
 
     # Your multi-band GEE assets
     # For summer 2024, you would use the appropriate Sentinel and Landsat assets
+    get_session().initialize()
     sentinel_asset = ee.Image('users/christopherscott925/raster/Sentinel2_2024_Summer_Coburg_EPSG25832')
     landsat_asset = ee.Image('users/christopherscott925/raster/Landsat_2024_Summer_Coburg_EPSG25832')
 
@@ -280,6 +453,7 @@ def sample_winter_2021(grid_path, scale=30):
 
 
     # Using the asset from your screenshot
+    get_session().initialize()
     sentinel_asset = ee.Image('users/christopherscott925/raster_masked/Sentinel2_2021_Winter_Coburg_EPSG25832_Masked')
     landsat_asset = ee.Image('users/christopherscott925/raster_masked/Landsat_2021_Winter_Coburg_EPSG25832_Masked')
 
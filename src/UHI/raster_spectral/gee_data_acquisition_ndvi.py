@@ -5,13 +5,15 @@ Saves CSV files for each time period
 import sys
 
 from UHI.config import *
-from UHI.gee_init import gee_init
+from UHI.gee_init import gee_init, get_session
+from UHI.raster_spectral.gee_pixels import fetch_pixels
 
 import ee
 import geemap
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import rasterio
 from shapely.geometry import Point
 import matplotlib.pyplot as plt
 
@@ -20,7 +22,8 @@ def initialise_gee():
     gee_init()
 
 
-def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000):
+def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000, backend=None, method='sample',
+                                   fetch_block=None, region_bounds=None):
 
     """
     Load a GEE asset with pre-calculated indices and convert to GeoDataFrame
@@ -29,19 +32,31 @@ def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000)
     - asset_id: Path to your GEE asset
     - sample_scale: Pixel size for sampling (meters)
     - max_pixels: Maximum number of pixels to sample (for memory management)
+    - backend: Optional raster_backends.LocalRasterBackend. asset_id is then the path of a local GeoTIFF/COG export
+               of the asset, sampled at its native resolution (sample_scale is ignored) without any GEE requests
+    - method: 'sample' (random sample of max_pixels pixels as JSON features) or 'pixels' (every pixel at
+              sample_scale, fetched as NumPy blocks with gee_pixels.fetch_pixels, max_pixels is ignored)
+    - fetch_block: Optional block fetcher for method='pixels' (default: ee.data.computePixels)
+    - region_bounds: Optional (minx, miny, maxx, maxy) in EPSG:25832 for method='pixels' (default: the image
+                     footprint)
     """
 
+    if backend is not None:
+        return _load_local_raster_to_geodataframe(asset_id, backend, max_pixels=max_pixels)
+
     print(f"Loading asset: {asset_id}")
 
-    # 1. Load the image from GEE
+    # 1. Load the image from GEE (ee objects can only be built once Earth Engine is initialised)
+    session = get_session()
+    session.initialize()
     image = ee.Image(asset_id)
 
     # 2. Print image info
-    print("Image bands:", image.bandNames().getInfo())
-    print("Image projection:", image.projection().getInfo())
+    band_names = session.get_info(image.bandNames(), 'band_names')
+    print("Image bands:", band_names)
+    print("Image projection:", session.get_info(image.projection(), 'projection'))
 
     # 3. Check what type of asset this is based on available bands
-    band_names = image.bandNames().getInfo()
 
     if 'LST_Celsius' in band_names:
         # This is a Landsat asset with LST
@@ -68,6 +83,30 @@ def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000)
     else:
         raise ValueError(f"Cannot determine asset type from band names: {band_names}")
 
+    if method == 'pixels':
+        if region_bounds is None:
+            ring = session.get_info(image.geometry().bounds(1, 'EPSG:25832'), 'image_bounds')['coordinates'][0]
+            xs, ys = zip(*ring)
+            region_bounds = (min(xs), min(ys), max(xs), max(ys))
+
+        df = fetch_pixels(image, bands_to_sample, region_bounds, sample_scale, crs='EPSG:25832',
+                          fetch_block=fetch_block)
+
+        print(f"Created DataFrame with {len(df)} valid pixels")
+        for band in bands_to_sample:
+            print(f"{band} range: {df[band].min():.3f} to {df[band].max():.3f}")
+
+        # Coordinates are already in EPSG:25832, vectorised point construction
+        gdf = gpd.GeoDataFrame(df.drop(columns=['x', 'y']), geometry=gpd.points_from_xy(df['x'], df['y']),
+                               crs='EPSG:25832')
+
+        print(f"GeoDataFrame created with CRS: {gdf.crs}")
+
+        return gdf
+
+    elif method != 'sample':
+        raise ValueError(f"Unknown method: {method}")
+
     # 4. Get the image geometry for sampling
     geometry = image.geometry()
 
@@ -79,10 +118,10 @@ def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000)
         geometries=True  # Include coordinates
     )
 
-    print(f"Sampling {sample.size().getInfo()} pixels...")
+    print(f"Sampling {session.get_info(sample.size(), 'sample_size')} pixels...")
 
     # 6. Convert to Python data structure
-    sample_data = sample.getInfo()
+    sample_data = session.get_info(sample, 'sample')
 
     # 7. Extract coordinates and values
     rows = []
@@ -128,6 +167,46 @@ def load_gee_asset_to_geodataframe(asset_id, sample_scale=30, max_pixels=100000)
 
     return gdf
 
+def _load_local_raster_to_geodataframe(raster_path, backend, max_pixels=100000):
+
+    """
+    Local counterpart of load_gee_asset_to_geodataframe for a GeoTIFF/COG export with band descriptions
+    """
+
+    print(f"Loading local raster: {raster_path}")
+
+    x, y, band_values = backend.sample_pixels(raster_path, max_pixels=max_pixels)
+
+    # Same band selection as for the GEE assets
+    if 'LST_Celsius' in band_values:
+        print("Detected Landsat raster with LST")
+        bands_to_sample = ['LST_Celsius']
+
+    elif 'NDVI' in band_values:
+        print("Detected Sentinel-2 raster with pre-calculated indices")
+        bands_to_sample = [band for band in ['NDVI', 'NDBI', 'MNDWI', 'EVI', 'NDMI'] if band in band_values]
+        print(f"Available indices: {bands_to_sample}")
+
+    else:
+        raise ValueError(f"Cannot determine raster type from band descriptions: {list(band_values)}")
+
+    df = pd.DataFrame({band: band_values[band] for band in bands_to_sample})
+
+    print(f"Created DataFrame with {len(df)} valid pixels")
+
+    for band in bands_to_sample:
+        print(f"{band} range: {df[band].min():.3f} to {df[band].max():.3f}")
+
+    with rasterio.open(raster_path) as src:
+        raster_crs = src.crs
+
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(x, y), crs=raster_crs)
+    gdf = gdf.to_crs('EPSG:25832')
+
+    print(f"GeoDataFrame created with CRS: {gdf.crs}")
+
+    return gdf
+
 def save_and_visualize_gdf(gdf, output_path, value_column='NDVI'):
 
     """
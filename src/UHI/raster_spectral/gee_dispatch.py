@@ -0,0 +1,387 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import requests
+
+"""
+Concurrent dispatch of GEE requests.
+
+sample_gee_rasters_at_centroids used to run its batches strictly one after another with a blocking getInfo(), so
+almost all of its wall time was spent waiting on the network. dispatch_batches keeps up to max_in_flight batches
+running on a thread pool, spaces requests out to a requests-per-second limit, retries transient errors (throttling,
+timeouts, 5xx) with exponential backoff and returns the results in batch order.
+
+dispatch_adaptive does the same with batch sizes chosen on the fly by an AdaptiveBatchSizer, which grows batches
+while responses stay fast and small, and shrinks them or raises tileScale on payload, "too many" and memory errors.
+
+Nothing here depends on the ee package, so it can be exercised offline against FakeEEClient
+(tests/fake_ee.py).
+"""
+
+
+# Fragments of error messages that are worth retrying (throttling, quota, timeouts, server errors)
+TRANSIENT_ERROR_MESSAGES = (
+    "too many concurrent aggregations",
+    "too many requests",
+    "rate limit",
+    "quota exceeded",
+    "computation timed out",
+    "deadline exceeded",
+    "service unavailable",
+    "internal error",
+    "backend error",
+    "connection reset",
+    "connection aborted",
+)
+
+# HTTP status codes worth retrying, matched in messages as whole words only (so e.g. band 'B500' doesn't match)
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+TRANSIENT_STATUS_PATTERN = re.compile(r"\b(429|50[0234])\b")
+
+# Network errors of the HTTP fetchers (gee_pixels, gee_tile_download), they don't subclass the builtin ones
+TRANSIENT_REQUESTS_ERRORS = (
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def is_transient_error(error):
+    """True if an exception looks like throttling or a temporary server/network problem"""
+
+    if isinstance(error, (ConnectionError, TimeoutError) + TRANSIENT_REQUESTS_ERRORS):
+        return True
+
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+
+    message = str(error).lower()
+    return any(fragment in message for fragment in TRANSIENT_ERROR_MESSAGES) \
+        or TRANSIENT_STATUS_PATTERN.search(message) is not None
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls at least 1 / requests_per_second apart"""
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def call_with_retry(fn, *args, max_retries=5, base_delay=1.0, max_delay=60.0, rate_limiter=None, label=""):
+    """
+    Call fn(*args), retrying transient errors with exponential backoff and jitter
+
+    Parameters:
+    - fn: Callable doing one request (e.g. one sampleRegions(...).getInfo())
+    - max_retries: Number of retries after the first attempt
+    - base_delay, max_delay: Backoff is base_delay * 2 ** attempt, capped at max_delay, plus up to 50% jitter
+    - rate_limiter: Optional RateLimiter, waited on before every attempt
+    - label: Name used in the log messages
+
+    Returns:
+    - Whatever fn returns. Non-transient errors, and transient errors after the last retry, are raised.
+    """
+
+    attempt = 0
+
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        try:
+            return fn(*args)
+
+        except Exception as e:
+            if attempt >= max_retries or not is_transient_error(e):
+                raise
+
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            delay += random.uniform(0, delay / 2)
+            attempt += 1
+
+            print(f"    ⚠️ {label} transient error ({e}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def dispatch_batches(batch_fn, batches, max_in_flight=4, requests_per_second=None, max_retries=5, base_delay=1.0,
+                     max_delay=60.0):
+    """
+    Run batch_fn over all batches with up to max_in_flight requests in flight
+
+    Parameters:
+    - batch_fn: Callable taking one batch and returning its result
+    - batches: List of batches (e.g. (batch_start, batch_coords) tuples)
+    - max_in_flight: Number of concurrent requests (1 runs the batches sequentially)
+    - requests_per_second: Optional limit on the rate new requests (including retries) are started
+    - max_retries, base_delay, max_delay: See call_with_retry
+
+    Returns:
+    - List of results in the same order as batches. The first error that is not recovered by the retries is
+      raised once the batches already in flight have finished.
+    """
+
+    rate_limiter = RateLimiter(requests_per_second)
+    n_batches = len(batches)
+    results = [None] * n_batches
+
+    def _run(batch_idx):
+        return call_with_retry(batch_fn, batches[batch_idx], max_retries=max_retries, base_delay=base_delay,
+                               max_delay=max_delay, rate_limiter=rate_limiter,
+                               label=f"Batch {batch_idx + 1}/{n_batches}")
+
+    if max_in_flight <= 1:
+        for batch_idx in range(n_batches):
+            results[batch_idx] = _run(batch_idx)
+            print(f"  - Batch {batch_idx + 1}/{n_batches} done")
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {executor.submit(_run, batch_idx): batch_idx for batch_idx in range(n_batches)}
+
+        done = 0
+        error = None
+        for future in as_completed(futures):
+            batch_idx = futures[future]
+            try:
+                results[batch_idx] = future.result()
+                done += 1
+                print(f"  - Batch {batch_idx + 1}/{n_batches} done ({done}/{n_batches})")
+            except Exception as e:
+                if error is None:
+                    error = e
+                    # Don't start the batches that are still queued
+                    for pending in futures:
+                        pending.cancel()
+
+        if error is not None:
+            raise error
+
+    return results
+
+
+# Errors that mean the batch itself was too big (shrink the batch) ...
+BATCH_TOO_LARGE_MESSAGES = (
+    "payload size exceeds",
+    "request size",
+    "too many pixels",
+    "too many elements",
+    "accumulating over",
+)
+
+# ... and errors that mean the computation ran out of memory (raise tileScale)
+OUT_OF_MEMORY_MESSAGES = (
+    "memory limit exceeded",
+    "out of memory",
+)
+
+
+class AdaptiveBatchSizer:
+    """
+    Chooses the sampleRegions batch size (and tileScale) from the responses seen so far
+
+    - after a success that was faster than target_latency and well under the payload limit, the batch size grows
+      by growth (up to max_size)
+    - after a slow response, or one close to the payload limit, it shrinks by half
+    - after a payload / "too many" error it shrinks by half and the batch is retried
+    - after a memory error tileScale is doubled (up to max_tile_scale, then the batch size shrinks instead)
+
+    Every batch is recorded in history, which ends up in the run metadata.
+    """
+
+    def __init__(self, initial_size=200, min_size=25, max_size=5000, target_latency=5.0, growth=1.5,
+                 max_payload_bytes=10485760, request_bytes_per_point=250, initial_tile_scale=1, max_tile_scale=16):
+        self.batch_size = int(initial_size)
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.target_latency = target_latency
+        self.growth = growth
+        self.max_payload_bytes = max_payload_bytes
+        self.request_bytes_per_point = request_bytes_per_point
+        self.tile_scale = initial_tile_scale
+        self.max_tile_scale = max_tile_scale
+
+        self.history = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def handles(error):
+        """True if the error is one the sizer reacts to (instead of a plain retry)"""
+
+        message = str(error).lower()
+        return any(fragment in message for fragment in BATCH_TOO_LARGE_MESSAGES + OUT_OF_MEMORY_MESSAGES)
+
+    def _shrink(self):
+        self.batch_size = max(self.min_size, self.batch_size // 2)
+
+    def record_success(self, batch_start, size, latency, response_bytes, tile_scale):
+        with self._lock:
+            self.history.append({
+                'batch_start': batch_start,
+                'size': size,
+                'tile_scale': tile_scale,
+                'latency_s': round(latency, 3),
+                'response_bytes': response_bytes,
+                'status': 'ok'
+            })
+
+            # Only adapt on full-size batches, the last batch of a run is usually smaller
+            if size < self.batch_size:
+                return
+
+            payload = max(response_bytes, size * self.request_bytes_per_point)
+
+            if latency > 2 * self.target_latency or payload > 0.8 * self.max_payload_bytes:
+                self._shrink()
+            elif latency < self.target_latency and payload * self.growth < 0.5 * self.max_payload_bytes:
+                self.batch_size = min(self.max_size, int(self.batch_size * self.growth))
+
+    def record_error(self, batch_start, size, error, tile_scale):
+        """
+        Adapt to a payload / "too many" / memory error
+
+        Returns:
+        - True if the batch should be retried with the new settings, False if there is nothing left to adapt
+        """
+
+        with self._lock:
+            self.history.append({
+                'batch_start': batch_start,
+                'size': size,
+                'tile_scale': tile_scale,
+                'error': str(error)[:200],
+                'status': 'error'
+            })
+
+            message = str(error).lower()
+            out_of_memory = any(fragment in message for fragment in OUT_OF_MEMORY_MESSAGES)
+
+            if out_of_memory and self.tile_scale < self.max_tile_scale:
+                self.tile_scale = min(self.max_tile_scale, self.tile_scale * 2)
+                return True
+
+            if size > self.min_size:
+                # Never grow back to a size that failed
+                self.max_size = max(self.min_size, min(self.max_size, size - 1))
+                # Shrink relative to the failed batch, other batches may have grown in the meantime
+                self.batch_size = max(self.min_size, min(self.batch_size, size) // 2)
+                return True
+
+            return False
+
+    def metadata(self):
+        """Chosen sizes and per-batch latencies for the run metadata"""
+
+        ok = [h for h in self.history if h['status'] == 'ok']
+
+        return {
+            'final_batch_size': self.batch_size,
+            'final_tile_scale': self.tile_scale,
+            'batch_sizes': [h['size'] for h in ok],
+            'mean_latency_s': round(sum(h['latency_s'] for h in ok) / len(ok), 3) if ok else None,
+            'errors': sum(1 for h in self.history if h['status'] == 'error'),
+            'batches': self.history
+        }
+
+
+def dispatch_adaptive(batch_fn, ranges, sizer, max_in_flight=1, requests_per_second=None, max_retries=5,
+                      base_delay=1.0, max_delay=60.0):
+    """
+    Run batch_fn over cell ranges, cutting them into batches whose size is chosen by an AdaptiveBatchSizer
+
+    Parameters:
+    - batch_fn: Callable (batch_start, batch_end, tile_scale) -> response size in bytes
+    - ranges: List of (start, end) runs of contiguous cells to sample
+    - sizer: AdaptiveBatchSizer
+    - max_in_flight, requests_per_second, max_retries, base_delay, max_delay: See dispatch_batches
+
+    The first error that can't be recovered (by adapting or by the transient retries) is raised once the batches
+    already in flight have finished.
+    """
+
+    rate_limiter = RateLimiter(requests_per_second)
+    pending = deque((int(start), int(end)) for start, end in ranges)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def _take():
+        with lock:
+            if stop.is_set() or not pending:
+                return None
+            start, end = pending.popleft()
+            size = sizer.batch_size
+            if end - start > size:
+                pending.appendleft((start + size, end))
+                end = start + size
+            return start, end, sizer.tile_scale
+
+    def _worker():
+        while True:
+            batch = _take()
+            if batch is None:
+                return
+
+            batch_start, batch_end, tile_scale = batch
+            attempt = 0
+
+            while True:
+                rate_limiter.wait()
+                start_time = time.perf_counter()
+
+                try:
+                    response_bytes = batch_fn(batch_start, batch_end, tile_scale)
+                    sizer.record_success(batch_start, batch_end - batch_start, time.perf_counter() - start_time,
+                                         response_bytes, tile_scale)
+                    print(f"  - Cells {batch_start}-{batch_end} done (next batch size {sizer.batch_size}, "
+                          f"tileScale {sizer.tile_scale})")
+                    break
+
+                except Exception as e:
+                    if sizer.handles(e):
+                        if not sizer.record_error(batch_start, batch_end - batch_start, e, tile_scale):
+                            stop.set()
+                            raise
+                        print(f"    ⚠️ Cells {batch_start}-{batch_end}: {e} -> batch size {sizer.batch_size}, "
+                              f"tileScale {sizer.tile_scale}")
+                        # Put the range back, it is re-cut with the new batch size
+                        with lock:
+                            pending.appendleft((batch_start, batch_end))
+                        break
+
+                    if attempt >= max_retries or not is_transient_error(e):
+                        stop.set()
+                        raise
+
+                    delay = min(max_delay, base_delay * 2 ** attempt)
+                    delay += random.uniform(0, delay / 2)
+                    attempt += 1
+                    print(f"    ⚠️ Cells {batch_start}-{batch_end} transient error ({e}), "
+                          f"retry {attempt}/{max_retries} in {delay:.1f}s")
+                    time.sleep(delay)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = [executor.submit(_worker) for _ in range(max(1, max_in_flight))]
+        wait(futures)
+
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            raise error
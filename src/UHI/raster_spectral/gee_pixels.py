@@ -0,0 +1,199 @@
+from UHI.config import *
+from UHI.gee_init import get_session
+from UHI.raster_spectral.gee_dispatch import dispatch_batches
+from UHI.regular_grid import RegularGrid
+
+import io
+
+import ee
+import numpy as np
+import pandas as pd
+import requests
+
+"""
+Array-native pixel fetch from GEE.
+
+load_gee_asset_to_geodataframe gets its pixels from sample(...).getInfo(): every pixel comes back as a JSON feature,
+is turned into a dict and then into a shapely Point, which is why it is capped at max_pixels=100000. fetch_pixels
+instead requests the area as blocks of pixels in NUMPY_NDARRAY format (ee.data.computePixels), and builds the pixel
+centre coordinates from each block's transform with array arithmetic, so the whole city can be fetched at full
+resolution.
+
+Blocks are fetched by a fetch_block callable, so the transport can be swapped:
+- ComputePixelsFetcher: ee.data.computePixels (also works with FakeEEClient from tests/fake_ee.py)
+- HTTPNPYFetcher: plain HTTP GET of .npy tiles, e.g. from FakeNPYTileServer (tests/fake_ee.py) for offline tests
+
+Blocks are dispatched with dispatch_batches, so they are fetched concurrently, rate limited and retried like the
+sampleRegions batches.
+"""
+
+
+# Value masked pixels are unmasked to, rows where any band has this value are dropped
+PIXEL_NODATA = -9999
+
+# computePixels refuses requests over 48 MB or 32768 pixels per side; 512 x 512 x 8 bytes is 2 MB per band
+DEFAULT_BLOCK_SIZE = 512
+
+
+def pixel_blocks(bounds, scale, crs=CRS, align_to=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Split an area into blocks of pixels
+
+    Parameters:
+    - bounds: (minx, miny, maxx, maxy) in crs
+    - scale: Pixel size
+    - crs: CRS of the pixel grid
+    - align_to: Optional crs_transform of the asset, so the blocks follow its pixel lattice (default: a lattice of
+                multiples of scale). scale must then be a whole number of asset pixels.
+    - block_size: Maximum block edge length in pixels
+
+    Returns:
+    - (pixel grid as a RegularGrid, list of blocks). Each block is a RegularGrid window of the pixel grid.
+    """
+
+    crs_transform = align_to if align_to is not None else [scale, 0, 0, 0, -scale, 0]
+    pixel_size = abs(float(crs_transform[0]))
+    pixels_per_cell = scale / pixel_size
+
+    if abs(pixels_per_cell - round(pixels_per_cell)) > 1e-9 or round(pixels_per_cell) < 1:
+        raise ValueError(f"Scale {scale} is not a whole number of {pixel_size} pixels")
+
+    pixel_grid = RegularGrid.from_crs_transform(crs_transform, bounds, crs=crs,
+                                                pixels_per_cell=round(pixels_per_cell))
+
+    blocks = [pixel_grid.window(i0, j0, block_size, block_size)
+              for j0 in range(0, pixel_grid.ny, block_size)
+              for i0 in range(0, pixel_grid.nx, block_size)]
+
+    return pixel_grid, blocks
+
+
+def block_request(block):
+    """Grid part of a computePixels request for a block (north-up, top-left corner as translation)"""
+
+    x_scale, _, translate_x, _, y_scale, translate_y = block.crs_transform
+
+    return {
+        'dimensions': {'width': block.nx, 'height': block.ny},
+        'affineTransform': {
+            'scaleX': x_scale,
+            'shearX': 0,
+            'translateX': translate_x,
+            'shearY': 0,
+            'scaleY': y_scale,
+            'translateY': translate_y
+        },
+        'crsCode': str(block.crs)
+    }
+
+
+class ComputePixelsFetcher:
+    """Fetches blocks with ee.data.computePixels as NUMPY_NDARRAY"""
+
+    def __init__(self, ee_client=ee):
+        self.ee_client = ee_client
+
+    def __call__(self, expression, bands, block):
+        session = get_session()
+        if self.ee_client is ee:
+            session.initialize()
+
+        result = session.call('computePixels', self.ee_client.data.computePixels, {
+            'expression': expression,
+            'fileFormat': 'NUMPY_NDARRAY',
+            'bandIds': list(bands),
+            'grid': block_request(block)
+        }, size_fn=lambda array: array.nbytes)
+
+        # Structured array with one field per band -> (band, row, col)
+        return np.stack([np.asarray(result[band], dtype=float) for band in bands])
+
+
+class HTTPNPYFetcher:
+    """
+    Fetches blocks as .npy payloads over HTTP
+
+    The server gets the block as query parameters (x0, y0 = top-left corner, width, height, scale, crs, bands) and
+    answers with a (band, row, col) array saved with np.save.
+    """
+
+    def __init__(self, base_url, timeout=60, session=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def __call__(self, expression, bands, block):
+        x_scale, _, translate_x, _, _, translate_y = block.crs_transform
+
+        response = self.session.get(f"{self.base_url}/pixels", params={
+            'x0': translate_x,
+            'y0': translate_y,
+            'width': block.nx,
+            'height': block.ny,
+            'scale': x_scale,
+            'crs': str(block.crs),
+            'bands': ",".join(bands)
+        }, timeout=self.timeout)
+        response.raise_for_status()
+
+        return np.load(io.BytesIO(response.content), allow_pickle=False).astype(float)
+
+
+def block_to_frame(block, array, bands):
+    """
+    (band, row, col) array of a block -> DataFrame of x, y (pixel centres) and one column per band, without the
+    pixels that are masked in any band
+    """
+
+    rows, cols = np.indices((block.ny, block.nx))
+    # Array rows run north to south, grid j from south to north
+    x, y = block.cell_centroid(cols.ravel(), block.ny - 1 - rows.ravel())
+
+    values = array.reshape(len(bands), -1)
+    valid = np.all((values != PIXEL_NODATA) & ~np.isnan(values), axis=0)
+
+    frame = pd.DataFrame({'x': x[valid], 'y': y[valid]})
+    for band_pos, band in enumerate(bands):
+        frame[band] = values[band_pos, valid]
+
+    return frame
+
+
+def fetch_pixels(image, bands, bounds, scale, crs=CRS, fetch_block=None, align_to=None,
+                 block_size=DEFAULT_BLOCK_SIZE, max_in_flight=4, requests_per_second=None, max_retries=3):
+    """
+    Fetch every pixel of an image within bounds as arrays
+
+    Parameters:
+    - image: ee.Image
+    - bands: Bands to fetch
+    - bounds: (minx, miny, maxx, maxy) in crs
+    - scale: Pixel size in crs units
+    - fetch_block: Callable (expression, bands, block) -> (band, row, col) array (default: ComputePixelsFetcher())
+    - align_to, block_size: See pixel_blocks
+    - max_in_flight, requests_per_second, max_retries: See gee_dispatch.dispatch_batches
+
+    Returns:
+    - DataFrame with x, y (pixel centres in crs) and one column per band, for the pixels that are valid in all bands
+    """
+
+    bands = list(bands)
+    if fetch_block is None:
+        get_session().initialize()
+    fetch_block = fetch_block or ComputePixelsFetcher()
+    expression = image.select(bands).unmask(PIXEL_NODATA)
+
+    pixel_grid, blocks = pixel_blocks(bounds, scale, crs=crs, align_to=align_to, block_size=block_size)
+    print(f"Fetching {pixel_grid.nx}x{pixel_grid.ny} pixels of {bands} in {len(blocks)} blocks...")
+
+    def _fetch(block):
+        return block_to_frame(block, fetch_block(expression, bands, block), bands)
+
+    frames = dispatch_batches(_fetch, blocks, max_in_flight=max_in_flight, requests_per_second=requests_per_second,
+                              max_retries=max_retries)
+
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=['x', 'y'] + bands)
+
+    return pd.concat(frames, ignore_index=True)
@@ -3,7 +3,7 @@ import UHI.gee_init
 
 import ee
 
-from UHI.gee_init import gee_init
+from UHI.gee_init import gee_init, get_session
 
 # Export to Google Drive
 # task = ee.batch.Export.image.toDrive(
@@ -18,19 +18,28 @@ from UHI.gee_init import gee_init
 # )
 # task.start()
 
-gee_init()
+def list_raster_assets(folder_path='users/christopherscott925/raster_masked'):
+    """List the assets in a GEE folder (initialises GEE on first use, not at import)"""
 
-folder_path = 'users/christopherscott925/raster_masked'
+    gee_init()
 
-asset_list = ee.data.listAssets({'parent': folder_path})
+    asset_list = get_session().call('listAssets', ee.data.listAssets, {'parent': folder_path})
 
-print(f"Found {len(asset_list['assets'])} assets in the folder")
+    print(f"Found {len(asset_list['assets'])} assets in the folder")
 
-print(f"The following assets were found in {'/'.join(asset_list['assets'][0]['name'].split('/')[:-1])}:\n")
+    if asset_list['assets']:
+        print(f"The following assets were found in {'/'.join(asset_list['assets'][0]['name'].split('/')[:-1])}:\n")
 
-for asset in asset_list['assets']:
+    for asset in asset_list['assets']:
 
-    print(asset['name'].split('/')[-1])
+        print(asset['name'].split('/')[-1])
+
+    return asset_list['assets']
+
+
+if __name__ == "__main__":
+
+    list_raster_assets()
 
 
 # test = asset_list['assets']
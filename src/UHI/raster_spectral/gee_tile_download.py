@@ -0,0 +1,254 @@
+from UHI.config import *
+from UHI.gee_init import get_session
+from UHI.raster_spectral.gee_dispatch import dispatch_batches
+from UHI.raster_spectral.gee_pixels import pixel_blocks
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+import requests
+from rasterio.errors import RasterioIOError
+from rasterio.merge import merge
+
+"""
+Tiled download of GEE images to a local COG.
+
+gee_raster_download.py only lists the assets, and Export.image.toDrive goes through Drive and a manual download.
+download_gee_image splits the area into tiles (on the pixel lattice of the asset, see gee_pixels.pixel_blocks), gets
+a getDownloadURL for each tile and downloads the tiles concurrently, with retries for transient errors. Every tile is
+verified (readable GeoTIFF with the expected size, band count and transform) before it counts as done, and a
+manifest.json in the tile directory records the finished tiles, so an interrupted download resumes with the missing
+tiles only. Finally the tiles are mosaicked into one COG with overviews.
+
+The tile URLs come from a url_fn(block) callable, so the download can run against FakeNPYTileServer
+(tests/fake_ee.py, its /download endpoint serves GeoTIFF tiles) instead of Earth Engine.
+"""
+
+
+# getDownloadURL refuses requests over 32 MB; 1024 x 1024 x 5 float32 bands is 20 MB
+DEFAULT_TILE_PIXELS = 1024
+
+MANIFEST_FILE = "manifest.json"
+
+
+class IncompleteTileError(Exception):
+    """A downloaded tile that is not a readable GeoTIFF matching the requested block"""
+
+
+def gee_download_url_fn(image, bands, file_format='GEO_TIFF'):
+    """url_fn using image.getDownloadURL for each block"""
+
+    def _url(block):
+        return get_session().call('getDownloadURL', image.select(bands).getDownloadURL, {
+            'bands': list(bands),
+            'crs': str(block.crs),
+            'crs_transform': block.crs_transform,
+            'dimensions': f"{block.nx}x{block.ny}",
+            'format': file_format
+        })
+
+    return _url
+
+
+def _tile_name(block, pixel_grid):
+    col = int(round((block.origin_x - pixel_grid.origin_x) / block.cell_size))
+    row = int(round((pixel_grid.bounds[3] - block.bounds[3]) / block.cell_size))
+    return f"tile_r{row:06d}_c{col:06d}.tif"
+
+
+def verify_tile(path, block, n_bands, tolerance=1e-6):
+    """Raise IncompleteTileError unless path is a GeoTIFF with the size, band count and transform of block"""
+
+    try:
+        with rasterio.open(path) as src:
+            if (src.width, src.height) != (block.nx, block.ny):
+                raise IncompleteTileError(f"{path.name}: {src.width}x{src.height} pixels, "
+                                          f"expected {block.nx}x{block.ny}")
+            if src.count != n_bands:
+                raise IncompleteTileError(f"{path.name}: {src.count} bands, expected {n_bands}")
+            if not np.allclose(tuple(src.transform)[:6], block.crs_transform, atol=tolerance * block.cell_size):
+                raise IncompleteTileError(f"{path.name}: transform {tuple(src.transform)[:6]}, "
+                                          f"expected {block.crs_transform}")
+            # Read the last row, a truncated file fails here
+            src.read(window=((src.height - 1, src.height), (0, src.width)))
+
+    except RasterioIOError as e:
+        raise IncompleteTileError(f"{path.name}: {e}")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """Finished tiles of a download, in manifest.json of the tile directory"""
+
+    def __init__(self, tile_dir, params):
+        self.path = Path(tile_dir) / MANIFEST_FILE
+        self._lock = threading.Lock()
+
+        manifest = json.loads(self.path.read_text(encoding="utf-8")) if self.path.exists() else None
+        if manifest is not None and manifest.get('params') != params:
+            print(f"⚠️ {self.path} belongs to a different download, starting over")
+            manifest = None
+
+        self.manifest = manifest or {'params': params, 'tiles': {}}
+
+    def is_done(self, name, tile_path):
+        entry = self.manifest['tiles'].get(name)
+        return entry is not None and tile_path.exists() and tile_path.stat().st_size == entry['bytes']
+
+    def mark_done(self, name, tile_path):
+        with self._lock:
+            self.manifest['tiles'][name] = {'bytes': tile_path.stat().st_size, 'sha256': _sha256(tile_path)}
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self.manifest, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+
+
+def download_tile(url_fn, block, tile_path, n_bands, session=None, timeout=300, verify_attempts=3):
+    """
+    Download one tile to tile_path (via a .part file) and verify it
+
+    A tile that fails verification (truncated or wrong size) is downloaded again, up to verify_attempts times.
+    HTTP and connection errors are raised, so the dispatcher can retry the transient ones.
+    """
+
+    session = session or requests
+    part_path = tile_path.with_suffix(".part")
+
+    for attempt in range(1, verify_attempts + 1):
+        response = session.get(url_fn(block), stream=True, timeout=timeout)
+        response.raise_for_status()
+
+        with open(part_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+
+        try:
+            verify_tile(part_path, block, n_bands)
+        except IncompleteTileError as e:
+            print(f"    ⚠️ {e} (attempt {attempt}/{verify_attempts})")
+            part_path.unlink(missing_ok=True)
+            if attempt == verify_attempts:
+                raise
+            continue
+
+        os.replace(part_path, tile_path)
+        return tile_path
+
+
+def mosaic_tiles(tile_paths, output_path, overview_resampling='average'):
+    """Mosaic tiles into one COG with overviews"""
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f"{output_path.stem}_mosaic.tmp.tif")
+
+    with rasterio.open(tile_paths[0]) as first:
+        descriptions = first.descriptions
+
+    merge([str(path) for path in tile_paths], dst_path=str(tmp_path),
+          dst_kwds={'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'BIGTIFF': 'IF_SAFER'})
+
+    with rasterio.open(tmp_path, 'r+') as dst:
+        for band, description in enumerate(descriptions, start=1):
+            if description:
+                dst.set_band_description(band, description)
+
+    try:
+        rasterio.shutil.copy(tmp_path, output_path, driver='COG', compress='DEFLATE', overviews='AUTO',
+                             overview_resampling=overview_resampling)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return output_path
+
+
+def download_gee_image(image, bands, bounds, scale, output_path, tile_dir=None, crs=CRS, align_to=None,
+                       tile_pixels=DEFAULT_TILE_PIXELS, url_fn=None, max_in_flight=4, requests_per_second=None,
+                       max_retries=5, keep_tiles=True):
+    """
+    Download an image in tiles and mosaic it into a local COG
+
+    Parameters:
+    - image: ee.Image (only used by the default url_fn)
+    - bands: Bands to download
+    - bounds: (minx, miny, maxx, maxy) in crs, e.g. the boundary bounds
+    - scale: Pixel size
+    - output_path: Output COG
+    - tile_dir: Directory for the tiles and the manifest (default: "<output stem>_tiles" next to the output). Re-run
+                with the same tile_dir to resume.
+    - align_to: Optional crs_transform of the asset, so the tiles follow its pixel lattice
+    - tile_pixels: Tile edge length in pixels
+    - url_fn: Optional callable (block) -> download URL (default: image.getDownloadURL)
+    - max_in_flight, requests_per_second, max_retries: See gee_dispatch.dispatch_batches
+    - keep_tiles: Keep the tiles after the mosaic (needed to resume or re-mosaic)
+
+    Returns:
+    - Dict with tiles, downloaded, resumed, bytes, seconds and the output path
+    """
+
+    bands = list(bands)
+    if url_fn is None:
+        get_session().initialize()
+    output_path = Path(output_path)
+    tile_dir = Path(tile_dir) if tile_dir is not None else output_path.with_name(f"{output_path.stem}_tiles")
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    url_fn = url_fn or gee_download_url_fn(image, bands)
+
+    pixel_grid, blocks = pixel_blocks(bounds, scale, crs=crs, align_to=align_to, block_size=tile_pixels)
+    tiles = [(block, tile_dir / _tile_name(block, pixel_grid)) for block in blocks]
+
+    manifest = DownloadManifest(tile_dir, {'bands': bands, 'grid': pixel_grid.params(), 'tile_pixels': tile_pixels})
+    todo = [(block, tile_path) for block, tile_path in tiles if not manifest.is_done(tile_path.name, tile_path)]
+
+    print(f"🔧 Downloading {pixel_grid.nx}x{pixel_grid.ny} pixels of {bands} in {len(tiles)} tiles "
+          f"({len(tiles) - len(todo)} already done)")
+
+    start_time = time.perf_counter()
+    session = requests.Session()
+
+    def _download(tile):
+        block, tile_path = tile
+        download_tile(url_fn, block, tile_path, len(bands), session=session)
+        manifest.mark_done(tile_path.name, tile_path)
+        return tile_path.stat().st_size
+
+    downloaded_bytes = dispatch_batches(_download, todo, max_in_flight=max_in_flight,
+                                        requests_per_second=requests_per_second, max_retries=max_retries)
+
+    # Everything must be there (and still match the manifest) before mosaicking
+    missing = [tile_path.name for _, tile_path in tiles if not manifest.is_done(tile_path.name, tile_path)]
+    if missing:
+        raise IncompleteTileError(f"{len(missing)} tiles are missing: {missing[:5]}")
+
+    print(f"✓ All {len(tiles)} tiles downloaded, mosaicking...")
+    mosaic_tiles([tile_path for _, tile_path in tiles], output_path)
+
+    if not keep_tiles:
+        for _, tile_path in tiles:
+            tile_path.unlink(missing_ok=True)
+        (tile_dir / MANIFEST_FILE).unlink(missing_ok=True)
+
+    seconds = time.perf_counter() - start_time
+    print(f"✅ Wrote {output_path} in {seconds:.1f}s")
+
+    return {
+        'output_path': str(output_path),
+        'tiles': len(tiles),
+        'downloaded': len(todo),
+        'resumed': len(tiles) - len(todo),
+        'bytes': int(sum(downloaded_bytes)),
+        'seconds': round(seconds, 3)
+    }
@@ -0,0 +1,190 @@
+from UHI.config import *
+from UHI.raster_spectral.raster_backends import _band_index, _parse_source
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+"""
+Local Landsat LST from Collection 2 Level-2 ST_B10.
+
+The LST_Celsius band of the Landsat assets is computed in GEE with
+landsat_median.select('ST_B10').multiply(0.00341802).add(149.0).subtract(273.15). compute_lst does the same scaling
+locally, window by window, so the band can be regenerated for any season from downloaded ST_B10 rasters.
+
+Optionally the temperature is corrected with an NDVI based emissivity (e.g. the Sentinel-2 NDVI from
+compute_spectral_indices, averaged to the 30m Landsat pixels on the fly with a WarpedVRT):
+
+    Pv = ((NDVI - NDVI_SOIL) / (NDVI_VEGETATION - NDVI_SOIL)) ** 2, clipped to 0..1
+    e = 0.004 * Pv + 0.986
+    LST = T / (1 + (WAVELENGTH * T / RHO) * ln(e))
+
+Note that the Level-2 ST product is already emissivity corrected (with ASTER GED), so the NDVI correction treats it
+as a brightness temperature. It is meant to reproduce NDVI-emissivity workflows, not to improve on ST_B10.
+
+compute_lst_scenes runs compute_lst for several scenes (separate files or the bands of one stack) on a process pool.
+"""
+
+
+# Collection 2 Level-2 surface temperature scaling (DN -> Kelvin)
+ST_SCALE = 0.00341802
+ST_OFFSET = 149.0
+ST_FILL = 0
+KELVIN_OFFSET = 273.15
+
+# NDVI emissivity model
+NDVI_SOIL = 0.2
+NDVI_VEGETATION = 0.5
+WAVELENGTH = 10.895  # µm, effective wavelength of Landsat 8/9 band 10
+RHO = 14388.0        # h * c / sigma, in µm K
+
+
+def ndvi_emissivity(ndvi):
+    """Land surface emissivity from NDVI via the proportion of vegetation"""
+
+    pv = np.clip((ndvi - NDVI_SOIL) / (NDVI_VEGETATION - NDVI_SOIL), 0, 1) ** 2
+    return 0.004 * pv + 0.986
+
+
+def st_to_celsius(dn, ndvi=None):
+    """
+    ST_B10 digital numbers -> LST in °C (vectorised, NaN for fill values and masked pixels)
+
+    Parameters:
+    - dn: ST_B10 array, may be a masked array (masked pixels are nodata)
+    - ndvi: Optional NDVI array on the same pixels, for the emissivity correction. Where it is NaN or masked (outside
+            the NDVI footprint, cloud-masked, nodata) the uncorrected temperature is kept.
+    """
+
+    dn_mask = np.ma.getmaskarray(dn)
+    dn = np.ma.getdata(dn)
+    kelvin = dn.astype(np.float64) * ST_SCALE + ST_OFFSET
+    kelvin = np.where((dn == ST_FILL) | dn_mask, np.nan, kelvin)
+
+    if ndvi is not None:
+        ndvi_mask = np.ma.getmaskarray(ndvi)
+        ndvi = np.ma.getdata(ndvi).astype(np.float64)
+        has_ndvi = ~ndvi_mask & ~np.isnan(ndvi)
+
+        emissivity = ndvi_emissivity(np.where(has_ndvi, ndvi, NDVI_VEGETATION))
+        corrected = kelvin / (1 + (WAVELENGTH * kelvin / RHO) * np.log(emissivity))
+        kelvin = np.where(has_ndvi, corrected, kelvin)
+
+    return (kelvin - KELVIN_OFFSET).astype(np.float32)
+
+
+def compute_lst(st_b10_path, output_path, ndvi_path=None, window_rows=1024):
+    """
+    Convert an ST_B10 raster to an LST_Celsius GeoTIFF, window by window
+
+    Parameters:
+    - st_b10_path: ST_B10 raster, path or (path, band) for one band of a multi-scene stack
+    - output_path: Output GeoTIFF (single float32 band described as LST_Celsius)
+    - ndvi_path: Optional NDVI raster, path or (path, band) (e.g. (indices_cog, 'NDVI')). It is averaged onto the
+                 ST_B10 pixel grid (any CRS / resolution) and used for the emissivity correction.
+    - window_rows: Raster rows processed per window
+
+    Returns:
+    - Path of the written raster
+    """
+
+    st_path, st_band = _parse_source(st_b10_path)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with rasterio.open(st_path) as src:
+        st_index = _band_index(src, st_band)
+
+        profile = src.profile.copy()
+        profile.update(count=1, dtype='float32', nodata=np.nan, compress='deflate', tiled=True, blockxsize=256,
+                       blockysize=256)
+
+        ndvi_src = ndvi_vrt = None
+        if ndvi_path is not None:
+            ndvi_file, ndvi_band = _parse_source(ndvi_path)
+            ndvi_src = rasterio.open(ndvi_file)
+            ndvi_index = _band_index(ndvi_src, ndvi_band)
+            # NDVI resampled to the 30m Landsat grid, only the windows that are read are warped
+            ndvi_vrt = WarpedVRT(ndvi_src, crs=src.crs, transform=src.transform, width=src.width,
+                                 height=src.height, resampling=Resampling.average, nodata=np.nan)
+
+        try:
+            with rasterio.open(output_path, 'w', **profile) as dst:
+                dst.set_band_description(1, 'LST_Celsius')
+
+                for row_off in range(0, src.height, window_rows):
+                    window = Window(0, row_off, src.width, min(window_rows, src.height - row_off))
+
+                    # Masked reads, so the declared nodata of both rasters is honoured and not only ST_FILL
+                    dn = src.read(st_index, window=window, masked=True)
+                    ndvi = None
+                    if ndvi_vrt is not None:
+                        ndvi = ndvi_vrt.read(ndvi_index, window=window, masked=True)
+
+                    dst.write(st_to_celsius(dn, ndvi), 1, window=window)
+
+        finally:
+            if ndvi_vrt is not None:
+                ndvi_vrt.close()
+                ndvi_src.close()
+
+    return output_path
+
+
+def _compute_lst_task(task):
+    st_b10_path, output_path, ndvi_path, window_rows = task
+    start_time = time.perf_counter()
+    compute_lst(st_b10_path, output_path, ndvi_path=ndvi_path, window_rows=window_rows)
+    return output_path, time.perf_counter() - start_time
+
+
+def compute_lst_scenes(scenes, output_dir, ndvi_path=None, workers=None, window_rows=1024):
+    """
+    LST for several Landsat scenes in parallel
+
+    Parameters:
+    - scenes: {scene name: path or (path, band)} of ST_B10 rasters, e.g. the bands of a multi-scene stack
+    - output_dir: Directory for the "{scene name}_LST_Celsius.tif" outputs
+    - ndvi_path: Optional NDVI raster for the emissivity correction (shared by all scenes)
+    - workers: Number of worker processes (default: os.cpu_count(), 1 runs in this process)
+
+    Returns:
+    - {scene name: output path}
+    """
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = {name: (source, output_dir / f"{name}_LST_Celsius.tif", ndvi_path, window_rows)
+             for name, source in scenes.items()}
+
+    if not tasks:
+        return {}
+
+    workers = workers or os.cpu_count() or 1
+    print(f"🔧 Computing LST for {len(tasks)} scenes on {min(workers, len(tasks))} workers"
+          + (" with NDVI emissivity correction" if ndvi_path is not None else ""))
+
+    outputs = {}
+
+    if workers <= 1:
+        results = map(_compute_lst_task, tasks.values())
+    else:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+        results = executor.map(_compute_lst_task, tasks.values())
+
+    try:
+        for name, (output_path, seconds) in zip(tasks, results):
+            outputs[name] = output_path
+            print(f"✓ {name}: {output_path} ({seconds:.1f}s)")
+    finally:
+        if workers > 1:
+            executor.shutdown()
+
+    return outputs
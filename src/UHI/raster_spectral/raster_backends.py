@@ -0,0 +1,212 @@
+from UHI.config import *
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window
+
+"""
+Raster backends for the fishnet sampler.
+
+sample_gee_rasters_at_centroids sends every batch of centroids to Earth Engine, which costs minutes of round trips per
+run and doesn't work at all without network access. LocalRasterBackend reads the same rasters from local GeoTIFF/COG
+exports instead: the centroids are turned into pixel (row, col) indices with one vectorised inverse affine transform,
+and the raster is read in windows of strip_rows rows, each window covering only the columns that hold points, so a
+full 30m fishnet is sampled in seconds and only the needed part of a large raster is ever in memory.
+
+Rasters are given as a path, or as (path, band) where band is a 1-based band index or a band description, e.g.
+
+    backend = LocalRasterBackend()
+    sample_gee_rasters_at_centroids(GRID_30M_PATH, {'NDVI': (s2_path, 'NDVI'), 'LST': lst_path}, output_path,
+                                    backend=backend)
+
+Unlike sampleRegions(scale=...), no resampling is done: every point gets the value of the pixel it falls in, at the
+native resolution of the export. Export at the sampling scale (e.g. 30m) to get the same values as from GEE.
+"""
+
+
+def _parse_source(source):
+    """path or (path, band) -> (path, band), band None meaning band 1"""
+
+    if isinstance(source, (tuple, list)):
+        return str(source[0]), source[1]
+
+    return str(source), None
+
+
+def _band_index(src, band):
+    """1-based band index of a band number or band description"""
+
+    if band is None:
+        return 1
+
+    if isinstance(band, (int, np.integer)):
+        if not 1 <= band <= src.count:
+            raise ValueError(f"{src.name} has {src.count} bands, band {band} does not exist")
+        return int(band)
+
+    descriptions = list(src.descriptions)
+    if band in descriptions:
+        return descriptions.index(band) + 1
+
+    raise ValueError(f"Band '{band}' not found in {src.name} (bands: {descriptions})")
+
+
+class LocalRasterBackend:
+    """
+    Samples local GeoTIFF/COG rasters at point coordinates with windowed reads
+
+    Parameters:
+    - strip_rows: Number of raster rows read per window (bounds memory for large rasters)
+    - points_crs: CRS of the sampling coordinates. Points are reprojected if a raster has a different CRS.
+    """
+
+    name = 'local'
+
+    def __init__(self, strip_rows=1024, points_crs=CRS):
+        self.strip_rows = int(strip_rows)
+        self.points_crs = points_crs
+
+    def __repr__(self):
+        return f"LocalRasterBackend(strip_rows={self.strip_rows}, points_crs={self.points_crs})"
+
+    def pixel_indices(self, src, x, y):
+        """
+        Vectorised point -> (row, col) lookup in an open raster
+
+        Returns:
+        - (row, col) integer arrays and a boolean mask of the points that fall inside the raster
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        if src.crs is not None and self.points_crs is not None and src.crs != self.points_crs:
+            x, y = warp_transform(self.points_crs, src.crs, x, y)
+            x = np.asarray(x, dtype=float)
+            y = np.asarray(y, dtype=float)
+
+        # Inverse affine transform for all points at once (same as src.index, but without a Python loop)
+        col_f, row_f = ~src.transform * (x, y)
+        row = np.floor(row_f).astype(np.int64)
+        col = np.floor(col_f).astype(np.int64)
+
+        inside = (row >= 0) & (row < src.height) & (col >= 0) & (col < src.width)
+
+        return row, col, inside
+
+    def sample(self, raster_dict, coords):
+        """
+        Sample rasters at point coordinates
+
+        Parameters:
+        - raster_dict: {column: path or (path, band)}. Columns that share a file are read together.
+        - coords: Sequence of (x, y) in points_crs (e.g. the grid centroids)
+
+        Returns:
+        - {column: float array with one value per point}, NaN for nodata, masked pixels and points outside the raster
+        """
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        values = {column: np.full(len(coords), np.nan) for column in raster_dict}
+
+        # Group the columns by file, so every window is read once for all bands of that file
+        by_path = {}
+        for column, source in raster_dict.items():
+            path, band = _parse_source(source)
+            by_path.setdefault(path, []).append((column, band))
+
+        for path, columns in by_path.items():
+            with rasterio.open(path) as src:
+                band_indexes = [_band_index(src, band) for _, band in columns]
+                row, col, inside = self.pixel_indices(src, coords[:, 0], coords[:, 1])
+
+                point_idx = np.flatnonzero(inside)
+                if len(point_idx) == 0:
+                    print(f"⚠️ No points fall inside {path}")
+                    continue
+
+                # Sort the points by row, so each strip is one contiguous slice of point_idx
+                point_idx = point_idx[np.argsort(row[point_idx], kind="stable")]
+                point_rows = row[point_idx]
+
+                for strip_start in range(int(point_rows[0]), int(point_rows[-1]) + 1, self.strip_rows):
+                    lo, hi = np.searchsorted(point_rows, [strip_start, strip_start + self.strip_rows])
+                    if lo == hi:
+                        continue
+
+                    strip_idx = point_idx[lo:hi]
+                    col_min = int(col[strip_idx].min())
+                    col_max = int(col[strip_idx].max())
+                    window = Window(col_min, strip_start, col_max - col_min + 1,
+                                    min(self.strip_rows, src.height - strip_start))
+
+                    data = src.read(band_indexes, window=window, masked=True)
+                    pixels = data[:, row[strip_idx] - strip_start, col[strip_idx] - col_min]
+                    pixels = np.ma.filled(pixels.astype(float), np.nan)
+
+                    for band_pos, (column, _) in enumerate(columns):
+                        values[column][strip_idx] = pixels[band_pos]
+
+            for column, _ in columns:
+                print(f"✓ {column}: {np.count_nonzero(~np.isnan(values[column]))}/{len(coords)} points sampled from {path}")
+
+        return values
+
+    def sample_pixels(self, path, bands=None, max_pixels=100000, seed=0):
+        """
+        Random sample of valid pixels of a local raster (local counterpart of image.sample(numPixels=...))
+
+        Parameters:
+        - path: Raster file
+        - bands: Band numbers or descriptions to read (default: all bands)
+        - max_pixels: Maximum number of pixels returned
+        - seed: Random seed
+
+        Returns:
+        - (x, y, {band name: values}) of the pixel centres, in the raster CRS, without pixels that are nodata in
+          any band
+
+        The raster is read in windows of strip_rows rows. Every valid pixel gets a random key and only the max_pixels
+        pixels with the smallest keys are kept, so the sample is uniform over all valid pixels while memory is bounded
+        by one strip plus the sample.
+        """
+
+        with rasterio.open(path) as src:
+            if bands is None:
+                bands = [description or f"band_{b}" for b, description in enumerate(src.descriptions, start=1)]
+                band_indexes = list(range(1, src.count + 1))
+            else:
+                band_indexes = [_band_index(src, band) for band in bands]
+
+            rng = np.random.default_rng(seed)
+            keys = np.empty(0)
+            rows = np.empty(0, dtype=np.int64)
+            cols = np.empty(0, dtype=np.int64)
+            pixels = np.empty((len(band_indexes), 0))
+
+            for strip_start in range(0, src.height, self.strip_rows):
+                window = Window(0, strip_start, src.width, min(self.strip_rows, src.height - strip_start))
+                data = src.read(band_indexes, window=window, masked=True)
+                strip_rows, strip_cols = np.nonzero(~np.ma.getmaskarray(data).any(axis=0))
+
+                if len(strip_rows) == 0:
+                    continue
+
+                keys = np.concatenate([keys, rng.random(len(strip_rows))])
+                rows = np.concatenate([rows, strip_rows + strip_start])
+                cols = np.concatenate([cols, strip_cols])
+                pixels = np.concatenate([pixels, np.ma.getdata(data)[:, strip_rows, strip_cols].astype(float)], axis=1)
+
+                if len(keys) > max_pixels:
+                    keep = np.argpartition(keys, max_pixels)[:max_pixels]
+                    keys, rows, cols, pixels = keys[keep], rows[keep], cols[keep], pixels[:, keep]
+
+            # Back to raster order
+            order = np.lexsort((cols, rows))
+            rows, cols, pixels = rows[order], cols[order], pixels[:, order]
+
+            x, y = src.transform * (cols + 0.5, rows + 0.5)
+            band_values = {str(band): pixels[b] for b, band in enumerate(bands)}
+
+        return np.asarray(x), np.asarray(y), band_values
@@ -0,0 +1,279 @@
+from UHI.config import *
+from UHI.raster_spectral.raster_backends import _band_index, _parse_source
+from UHI.regular_grid import RegularGrid
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+"""
+Multi-season raster cube on disk.
+
+Each season (summer 2024, winter 2021, ...) currently lives in its own GEE asset, fishnet GPKG or PostGIS table, and a
+multi-year analysis has to reopen and resample every one of them. A RasterCube stores all seasons on one RegularGrid
+(one pixel per grid cell), as a directory with
+
+- meta.json: grid parameters, band names, dtype and the ordered list of seasons
+- one .npy file per season, shape (band, y, x), rows north-up as in grid.crs_transform
+
+The .npy files are opened with np.load(mmap_mode='r'), so a season slice is a zero-copy view of the file, and a
+per-cell time series only touches one small block in each file. Appending a season writes one new file and updates
+meta.json, existing seasons are never rewritten. The file is filled under a temporary name and the season is only
+registered in meta.json once all of its bands are written, so a failed append leaves no half-filled season behind.
+
+Cells are addressed with the grid indices (i, j) / cell_id of the fishnet, the row in the arrays is ny - 1 - j.
+"""
+
+
+META_FILE = "meta.json"
+
+
+class RasterCube:
+    """time x band x y x x cube of seasons on one RegularGrid, stored as memory-mapped .npy files"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        meta = json.loads((self.path / META_FILE).read_text(encoding="utf-8"))
+        grid = meta['grid']
+        self.grid = RegularGrid(grid['origin_x'], grid['origin_y'], grid['cell_size'], grid['nx'], grid['ny'],
+                                crs=grid['crs'])
+        self.bands = list(meta['bands'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.seasons = list(meta['seasons'])
+        self._arrays = {}
+
+    @classmethod
+    def create(cls, path, grid, bands, dtype='float32'):
+        """
+        Create an empty cube
+
+        Parameters:
+        - path: Cube directory (must not contain a cube yet)
+        - grid: RegularGrid of the cube (e.g. the project 30m grid)
+        - bands: Band names, e.g. ['NDVI', 'NDBI', 'MNDWI', 'EVI', 'NDMI', 'LST_Celsius']
+        - dtype: Data type of all bands (floating point, missing values are NaN)
+        """
+
+        path = Path(path)
+        if (path / META_FILE).exists():
+            raise FileExistsError(f"There is already a raster cube in {path}")
+
+        path.mkdir(parents=True, exist_ok=True)
+        cls._write_meta(path, {
+            'grid': grid.params(),
+            'bands': list(bands),
+            'dtype': np.dtype(dtype).name,
+            'seasons': []
+        })
+
+        return cls(path)
+
+    @staticmethod
+    def _write_meta(path, meta):
+        tmp_path = path / (META_FILE + ".tmp")
+        tmp_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+        os.replace(tmp_path, path / META_FILE)
+
+    def __repr__(self):
+        return f"RasterCube({self.path}, seasons={self.seasons}, bands={self.bands}, grid={self.grid})"
+
+    @property
+    def shape(self):
+        """(time, band, y, x)"""
+
+        return len(self.seasons), len(self.bands), self.grid.ny, self.grid.nx
+
+    def _season_file(self, season):
+        return self.path / f"{season}.npy"
+
+    def _new_season(self, season):
+        """Validate a new season label and create its NaN-filled file under a temporary name"""
+
+        if not isinstance(season, str) or not season or season == "." or ".." in season \
+                or any(separator in season for separator in ("/", "\\", os.sep, os.altsep) if separator):
+            raise ValueError(f"Invalid season label {season!r}, it is used as a file name")
+
+        if season in self.seasons:
+            raise ValueError(f"Season {season} is already in the cube, seasons are never rewritten")
+
+        tmp_path = self.path / f"{season}.npy.tmp"
+        shape = (len(self.bands), self.grid.ny, self.grid.nx)
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=shape)
+        array[:] = np.nan
+
+        return tmp_path, array
+
+    def _register_season(self, season, tmp_path):
+        """Move a completely written (and closed) season file into place and add the season to meta.json"""
+
+        os.replace(tmp_path, self._season_file(season))
+
+        self.seasons.append(season)
+        self._write_meta(self.path, {
+            'grid': self.grid.params(),
+            'bands': self.bands,
+            'dtype': self.dtype.name,
+            'seasons': self.seasons
+        })
+
+        return np.load(self._season_file(season), mmap_mode='r+')
+
+    def _band_position(self, band):
+        return band if isinstance(band, (int, np.integer)) else self.bands.index(band)
+
+    # Writing
+
+    def append_season(self, season, data=None):
+        """
+        Add a season, either from an array or as an empty (NaN) slice to be filled in place
+
+        Parameters:
+        - season: Season label, e.g. "summer_2024" (also the file name, no path separators or "..")
+        - data: Optional (band, y, x) array, rows north-up
+
+        Returns:
+        - Writable memmap of the new season
+        """
+
+        shape = (len(self.bands), self.grid.ny, self.grid.nx)
+        if data is not None and np.shape(data) != shape:
+            raise ValueError(f"Season data must have shape {shape}, got {np.shape(data)}")
+
+        tmp_path, array = self._new_season(season)
+        complete = False
+        try:
+            if data is not None:
+                array[:] = data
+            array.flush()
+            complete = True
+        finally:
+            # Close the memmap before the file is renamed or removed (required on Windows)
+            del array
+            if not complete:
+                tmp_path.unlink(missing_ok=True)
+
+        return self._register_season(season, tmp_path)
+
+    def append_season_from_rasters(self, season, sources, resampling=Resampling.average, window_rows=1024):
+        """
+        Add a season from local rasters, resampled onto the cube grid
+
+        Parameters:
+        - season: Season label
+        - sources: {cube band: path or (path, band)}, e.g. {'NDVI': (indices_cog, 'NDVI'), 'LST_Celsius': lst_tif}.
+                   Cube bands that are not given stay NaN.
+        - resampling: Resampling onto the grid (average, so e.g. 10m pixels are averaged into 30m cells)
+        - window_rows: Grid rows written per window
+
+        Returns:
+        - Writable memmap of the new season
+        """
+
+        unknown = set(sources) - set(self.bands)
+        if unknown:
+            raise ValueError(f"Bands {sorted(unknown)} are not in the cube ({self.bands})")
+
+        tmp_path, array = self._new_season(season)
+        complete = False
+        transform = rasterio.Affine(*self.grid.crs_transform)
+
+        try:
+            for band, source in sources.items():
+                path, source_band = _parse_source(source)
+                band_position = self._band_position(band)
+
+                with rasterio.open(path) as src:
+                    source_index = _band_index(src, source_band)
+                    with WarpedVRT(src, crs=self.grid.crs, transform=transform, width=self.grid.nx,
+                                   height=self.grid.ny, resampling=resampling) as vrt:
+                        for row_off in range(0, self.grid.ny, window_rows):
+                            window = Window(0, row_off, self.grid.nx, min(window_rows, self.grid.ny - row_off))
+                            data = vrt.read(source_index, window=window, masked=True)
+                            array[band_position, row_off:row_off + window.height] = np.ma.filled(
+                                data.astype(self.dtype), np.nan)
+
+                print(f"✓ {season} / {band} from {path}")
+
+            array.flush()
+            complete = True
+
+        finally:
+            # Close the memmap before the file is renamed or removed (required on Windows)
+            del array
+            if not complete:
+                # Nothing is registered yet, drop the partial file so the season can be appended again
+                tmp_path.unlink(missing_ok=True)
+
+        return self._register_season(season, tmp_path)
+
+    # Reading
+
+    def season(self, season):
+        """Read-only (band, y, x) memmap of one season (zero-copy)"""
+
+        if season not in self._arrays:
+            if season not in self.seasons:
+                raise KeyError(f"Season {season} is not in the cube ({self.seasons})")
+            self._arrays[season] = np.load(self._season_file(season), mmap_mode='r')
+
+        return self._arrays[season]
+
+    def band(self, season, band):
+        """Read-only (y, x) view of one band of one season"""
+
+        return self.season(season)[self._band_position(band)]
+
+    def cell_series(self, i, j, bands=None):
+        """
+        Time series of cells
+
+        Parameters:
+        - i, j: Grid indices (scalars or arrays)
+        - bands: Band names (default: all bands)
+
+        Returns:
+        - Array of shape (time, band) for a single cell, or (time, band, cell) for arrays of cells
+        """
+
+        bands = self.bands if bands is None else list(bands)
+        positions = [self._band_position(band) for band in bands]
+
+        scalar = np.ndim(i) == 0
+        i = np.atleast_1d(np.asarray(i, dtype=np.int64))
+        j = np.atleast_1d(np.asarray(j, dtype=np.int64))
+        rows = self.grid.ny - 1 - j
+
+        if not self.seasons:
+            series = np.empty((0, len(positions), len(i)), dtype=self.dtype)
+        else:
+            # Index the cells first, so only those pixels are read from each file
+            series = np.stack([self.season(season)[:, rows, i][positions] for season in self.seasons])
+
+        return series[:, :, 0] if scalar else series
+
+    def season_to_dataframe(self, season, bands=None, drop_empty=True):
+        """
+        One season as a fishnet-like table (cell_id, x_index, y_index and one column per band)
+
+        Parameters:
+        - drop_empty: Drop the cells that are NaN in every band
+        """
+
+        bands = self.bands if bands is None else list(bands)
+        i, j = self.grid.all_indices()
+        rows = self.grid.ny - 1 - j
+
+        values = {band: np.asarray(self.band(season, band))[rows, i] for band in bands}
+        df = pd.DataFrame({'cell_id': self.grid.cell_ids(i, j), 'x_index': i, 'y_index': j, **values})
+
+        if drop_empty:
+            df = df.dropna(subset=bands, how='all').reset_index(drop=True)
+
+        return df
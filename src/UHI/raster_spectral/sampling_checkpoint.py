@@ -0,0 +1,110 @@
+from UHI.config import *
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+"""
+On-disk checkpoints for fishnet sampling runs.
+
+Every batch returned by GEE is written to its own JSON file as soon as it arrives, in a directory keyed by
+(asset, band, grid hash, scale). A re-run of sample_gee_rasters_at_centroids with the same checkpoint_dir loads the
+completed batches and only requests the cells that are still missing, so a run that dies on batch 140 of 200, or a
+raster that failed, resumes where it stopped instead of starting over.
+
+Batch files are named after the cell range they cover (batch_<start>_<end>.json), so a resumed run may use a
+different batch size.
+"""
+
+
+def grid_hash(coords):
+    """Fingerprint of the sampling points (centroid coordinates, in cell_id order)"""
+
+    coords = np.ascontiguousarray(np.asarray(coords, dtype=np.float64))
+    return hashlib.sha1(coords.tobytes()).hexdigest()[:16]
+
+
+def image_fingerprint(gee_image, fallback):
+    """
+    Fingerprint of a GEE image: the serialised expression (asset id plus select/rename/unmask steps), or fallback
+    if the image can't be serialised
+    """
+
+    try:
+        serialised = gee_image.serialize()
+    except Exception:
+        serialised = str(fallback)
+
+    return hashlib.sha1(serialised.encode("utf-8")).hexdigest()[:16]
+
+
+class SamplingCheckpoint:
+    """Completed sampling batches of one (asset, band, grid, scale) combination"""
+
+    def __init__(self, checkpoint_dir, asset_id, band, grid_hash, scale):
+        self.key_fields = {
+            'asset_id': asset_id,
+            'band': band,
+            'grid_hash': grid_hash,
+            'scale': scale
+        }
+
+        key = hashlib.sha1(json.dumps(self.key_fields, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.directory = Path(checkpoint_dir) / key
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        meta_path = self.directory / "checkpoint.json"
+        if not meta_path.exists():
+            meta_path.write_text(json.dumps(self.key_fields, indent=2), encoding="utf-8")
+
+    def _batch_path(self, batch_start, batch_end):
+        return self.directory / f"batch_{batch_start:09d}_{batch_end:09d}.json"
+
+    def save_batch(self, batch_start, batch_end, sampled_list):
+        """Persist one completed batch (written to a temp file first, so a crash never leaves half a batch)"""
+
+        path = self._batch_path(batch_start, batch_end)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(sampled_list), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def load_batches(self):
+        """
+        Returns:
+        - List of (batch_start, batch_end, sampled_list) for every completed batch
+        """
+
+        batches = []
+        for path in sorted(self.directory.glob("batch_*.json")):
+            _, batch_start, batch_end = path.stem.split("_")
+            sampled_list = json.loads(path.read_text(encoding="utf-8"))
+            batches.append((int(batch_start), int(batch_end), sampled_list))
+
+        return batches
+
+
+def missing_batches(done, batch_size):
+    """
+    Split the cells that are not yet done into batches of contiguous cells
+
+    Returns:
+    - List of (batch_start, batch_end) ranges of at most batch_size cells
+    """
+
+    missing = np.flatnonzero(~np.asarray(done))
+    if len(missing) == 0:
+        return []
+
+    # Contiguous runs of missing cells
+    breaks = np.flatnonzero(np.diff(missing) > 1) + 1
+    run_starts = missing[np.concatenate([[0], breaks])]
+    run_ends = missing[np.concatenate([breaks - 1, [len(missing) - 1]])] + 1
+
+    ranges = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        for batch_start in range(int(run_start), int(run_end), batch_size):
+            ranges.append((batch_start, min(batch_start + batch_size, int(run_end))))
+
+    return ranges
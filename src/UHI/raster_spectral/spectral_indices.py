@@ -0,0 +1,234 @@
+from UHI.config import *
+from UHI.raster_spectral.raster_backends import _band_index, _parse_source
+
+import ast
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+
+"""
+Local spectral index engine.
+
+The Sentinel-2 indices sampled by the fishnet code are precomputed inside GEE assets
+(users/.../Sentinel2_2024_Summer_Coburg_EPSG25832, bands 0-4 = NDVI, NDBI, MNDWI, EVI, NDMI), so a new city or a
+changed formula needs a round trip through GEE. compute_spectral_indices builds the same 5-band raster locally from
+the raw band rasters:
+
+- all index expressions are evaluated in one fused pass per tile, every input band is read and scaled once and
+  shared by all indices
+- tiles are processed on a process pool, each worker opens the inputs itself and only reads its own window
+- the result is written as a multi-band float32 COG in INDEX_ORDER, with the index names as band descriptions, so it
+  can be sampled with LocalRasterBackend / zonal_stats by name or with the same band numbers as the GEE asset
+
+Index formulas are plain expressions over the band names (blue, green, red, nir, swir1 by default) and can be changed
+or extended with the expressions parameter, e.g. {'NDRE': '(nir - rededge) / (nir + rededge)'}.
+"""
+
+
+# Band order of the GEE Sentinel-2 assets, and of the COG written here
+INDEX_ORDER = ('NDVI', 'NDBI', 'MNDWI', 'EVI', 'NDMI')
+
+INDEX_EXPRESSIONS = {
+    'NDVI': '(nir - red) / (nir + red)',
+    'NDBI': '(swir1 - nir) / (swir1 + nir)',
+    'MNDWI': '(green - swir1) / (green + swir1)',
+    'EVI': '2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1)',
+    'NDMI': '(nir - swir1) / (nir + swir1)'
+}
+
+# Sentinel-2 L2A bands used by the default expressions
+SENTINEL2_BANDS = {
+    'blue': 'B2',
+    'green': 'B3',
+    'red': 'B4',
+    'nir': 'B8',
+    'swir1': 'B11'
+}
+
+
+def _expression_bands(expression):
+    """Names used in an index expression"""
+
+    return {node.id for node in ast.walk(ast.parse(expression, mode='eval')) if isinstance(node, ast.Name)} - {'np'}
+
+
+def _compute_tile(task):
+    """
+    Worker: read one window of all needed bands and evaluate every index expression on it
+
+    task = (window tuple, {band name: (path, band)}, [(index name, expression)], scale, offset)
+    """
+
+    (col_off, row_off, width, height), band_sources, expressions, scale, offset = task
+    window = Window(col_off, row_off, width, height)
+
+    bands = {}
+    valid = np.ones((height, width), dtype=bool)
+
+    for name, (path, band) in band_sources.items():
+        with rasterio.open(path) as src:
+            data = src.read(_band_index(src, band), window=window, masked=True)
+        valid &= ~np.ma.getmaskarray(data)
+        bands[name] = np.ma.getdata(data).astype(np.float32) * np.float32(scale) + np.float32(offset)
+
+    out = np.full((len(expressions), height, width), np.nan, dtype=np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for position, (_, expression) in enumerate(expressions):
+            result = eval(expression, {'__builtins__': {}, 'np': np}, bands)
+            out[position] = np.where(valid & np.isfinite(result), result, np.nan)
+
+    return col_off, row_off, width, height, out
+
+
+def _tile_windows(width, height, tile_size):
+    return [(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+            for row_off in range(0, height, tile_size)
+            for col_off in range(0, width, tile_size)]
+
+
+def compute_spectral_indices(band_paths, output_path, indices=INDEX_ORDER, expressions=None, tile_size=1024,
+                             workers=None, reflectance_scale=1e-4, reflectance_offset=0.0):
+    """
+    Compute spectral indices from raw band rasters and write them as a multi-band COG
+
+    Parameters:
+    - band_paths: {band name: path or (path, band)}, e.g. {'red': 'T32UPA_B04_10m.tif', 'nir': ...} or bands of one
+                  stacked file. All inputs must share one grid (same CRS, transform and size, e.g. B11 resampled to
+                  10m).
+    - output_path: Output COG
+    - indices: Index names, in output band order (default: the band order of the GEE assets)
+    - expressions: Optional {index name: expression} overriding / extending INDEX_EXPRESSIONS
+    - tile_size: Tile edge length in pixels
+    - workers: Number of worker processes (default: os.cpu_count(), 1 runs in this process)
+    - reflectance_scale, reflectance_offset: DN -> reflectance (Sentinel-2 L2A: 1e-4, and an offset of -0.1 for
+                                              processing baseline 04.00+ if not already removed)
+
+    Returns:
+    - Dict with pixels, seconds and megapixels_per_second
+    """
+
+    all_expressions = dict(INDEX_EXPRESSIONS)
+    all_expressions.update(expressions or {})
+
+    missing = [index for index in indices if index not in all_expressions]
+    if missing:
+        raise ValueError(f"No expression for indices {missing}")
+
+    index_expressions = [(index, all_expressions[index]) for index in indices]
+    needed = set().union(*(_expression_bands(expression) for _, expression in index_expressions))
+
+    band_sources = {}
+    for name in sorted(needed):
+        if name not in band_paths:
+            raise ValueError(f"Band '{name}' is needed by the index expressions but not in band_paths")
+        band_sources[name] = _parse_source(band_paths[name])
+
+    # All inputs must be on one pixel grid
+    profiles = {}
+    for name, (path, _) in band_sources.items():
+        with rasterio.open(path) as src:
+            profiles[name] = (src.crs, tuple(src.transform)[:6], src.width, src.height)
+
+    reference_name = next(iter(profiles))
+    reference = profiles[reference_name]
+    for name, profile in profiles.items():
+        if profile != reference:
+            raise ValueError(f"Band '{name}' is not on the same grid as '{reference_name}': {profile} vs {reference}")
+
+    crs, transform, width, height = reference
+    windows = _tile_windows(width, height, tile_size)
+    tasks = [(window, band_sources, index_expressions, reflectance_scale, reflectance_offset) for window in windows]
+
+    workers = workers or os.cpu_count() or 1
+    print(f"🔧 Computing {', '.join(indices)} for {width}x{height} pixels in {len(windows)} tiles on {workers} workers")
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    start_time = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as tmp_dir:
+        tmp_path = Path(tmp_dir) / "indices.tif"
+        profile = {
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'count': len(indices),
+            'dtype': 'float32',
+            'crs': crs,
+            'transform': rasterio.Affine(*transform),
+            'nodata': np.nan,
+            'tiled': True,
+            'blockxsize': 512,
+            'blockysize': 512
+        }
+
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for band, index in enumerate(indices, start=1):
+                dst.set_band_description(band, index)
+
+            def _write(tile):
+                col_off, row_off, tile_width, tile_height, out = tile
+                dst.write(out, window=Window(col_off, row_off, tile_width, tile_height))
+
+            if workers <= 1:
+                for task in tasks:
+                    _write(_compute_tile(task))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for tile in executor.map(_compute_tile, tasks):
+                        _write(tile)
+
+        compute_seconds = time.perf_counter() - start_time
+
+        # The COG driver can only copy an existing dataset (it adds the overviews and reorders the tiles)
+        rasterio.shutil.copy(tmp_path, output_path, driver='COG', compress='DEFLATE', predictor=3,
+                             overview_resampling='average')
+
+    seconds = time.perf_counter() - start_time
+    pixels = width * height
+
+    stats = {
+        'pixels': pixels,
+        'tiles': len(windows),
+        'workers': workers,
+        'compute_seconds': round(compute_seconds, 3),
+        'seconds': round(seconds, 3),
+        'megapixels_per_second': round(pixels / 1e6 / compute_seconds, 2) if compute_seconds > 0 else None
+    }
+
+    print(f"✅ Wrote {output_path} ({stats['megapixels_per_second']} MP/s, {seconds:.1f}s including COG conversion)")
+
+    return stats
+
+
+def benchmark_spectral_indices(band_paths, output_dir, workers=(1, 2, 4), tile_sizes=(512, 1024), **kwargs):
+    """
+    Throughput of compute_spectral_indices for different worker counts and tile sizes
+
+    Returns:
+    - DataFrame with workers, tile_size, seconds and megapixels_per_second (index computation only, without the COG
+      conversion)
+    """
+
+    output_dir = Path(output_dir)
+    rows = []
+
+    for n_workers in workers:
+        for tile_size in tile_sizes:
+            stats = compute_spectral_indices(band_paths, output_dir / f"indices_w{n_workers}_t{tile_size}.tif",
+                                             tile_size=tile_size, workers=n_workers, **kwargs)
+            rows.append({'workers': n_workers, 'tile_size': tile_size, **stats})
+
+    results = pd.DataFrame(rows)
+    print(results[['workers', 'tile_size', 'compute_seconds', 'megapixels_per_second']].to_string(index=False))
+
+    return results
@@ -0,0 +1,346 @@
+from UHI.config import *
+
+import datetime
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window, bounds as window_bounds, transform as window_transform
+import shapely
+
+"""
+Zonal statistics of local rasters per grid cell.
+
+sample_gee_rasters_at_centroids takes a single pixel at each cell centroid, which for 10m Sentinel-2 indices on a 30m
+grid ignores eight of the nine pixels in a cell. zonal_stats_by_cell labels every pixel with the cell it falls in
+(pixel centre inside the cell, as in rasterize) and reduces all pixels per cell at once with bincount / reduceat:
+mean, median, std, min, max and the number of valid pixels.
+
+The raster is streamed in windows of about window_rows rows, and only the per-cell accumulators are kept between
+windows, so memory doesn't depend on the raster size. The median needs the values themselves, but only until a cell
+is finished: once a cell lies entirely above the bottom edge of the window (no later window can add pixels to it) its
+median is computed and its values are dropped. With a RegularGrid the windows are cut at cell row boundaries, so every
+cell is finished in the window that reads it. With a grid GeoDataFrame only the cells straddling a window edge carry
+their values over to the next window.
+
+Cell labels come from:
+- a RegularGrid: straight from the pixel centre coordinates with point_to_cell, nothing is rasterized
+- a grid GeoDataFrame (e.g. a grid clipped to the boundary): the cell polygons overlapping each window are rasterized
+  into a window of cell positions, so every pixel is labelled exactly once
+"""
+
+
+ZONAL_STATS = ('mean', 'median', 'std', 'min', 'max', 'count')
+
+
+def _band_names(src, bands):
+    """Band indexes and output names (band description, or band_{index})"""
+
+    if bands is None:
+        band_indexes = list(range(1, src.count + 1))
+    else:
+        band_indexes = []
+        descriptions = list(src.descriptions)
+        for band in bands:
+            if isinstance(band, (int, np.integer)):
+                band_indexes.append(int(band))
+            elif band in descriptions:
+                band_indexes.append(descriptions.index(band) + 1)
+            else:
+                raise ValueError(f"Band '{band}' not found in {src.name} (bands: {descriptions})")
+
+    names = [src.descriptions[b - 1] or f"band_{b}" for b in band_indexes]
+
+    return band_indexes, names
+
+
+def _cell_row_windows(regular_grid, src, window_rows):
+    """
+    (row_off, height) of raster windows of about window_rows rows, cut where the pixel centres move to another cell
+    row of the grid, so that no cell row is split between two windows
+    """
+
+    # Cell row (j) of every raster row, from the y of its pixel centres
+    _, y = src.transform * (np.full(src.height, 0.5), np.arange(src.height) + 0.5)
+    j = np.floor((np.asarray(y) - regular_grid.origin_y) / regular_grid.cell_size)
+    cuts = np.flatnonzero(np.diff(j) != 0) + 1
+
+    windows = []
+    row_off = 0
+    while row_off < src.height:
+        target = row_off + window_rows
+        if target >= src.height:
+            end = src.height
+        else:
+            # Last cell row boundary within the window, or the first one after it if a cell row is taller
+            before = cuts[(cuts > row_off) & (cuts <= target)]
+            after = cuts[cuts > target]
+            end = int(before[-1]) if len(before) else (int(after[0]) if len(after) else src.height)
+        windows.append((row_off, end - row_off))
+        row_off = end
+
+    return windows
+
+
+def _window_labels_from_grid(regular_grid, src, window):
+    """Flat cell index of every pixel in the window (-1 outside the grid), from the pixel centre coordinates"""
+
+    rows = np.arange(window.row_off, window.row_off + window.height) + 0.5
+    cols = np.arange(window.col_off, window.col_off + window.width) + 0.5
+    col_grid, row_grid = np.meshgrid(cols, rows)
+    x, y = src.transform * (col_grid, row_grid)
+
+    i, j = regular_grid.point_to_cell(x, y)
+
+    return np.where(i >= 0, regular_grid.flat_index(i, j), -1)
+
+
+def _window_labels_from_polygons(cells_gdf, src, window):
+    """Position in cells_gdf of every pixel in the window (-1 outside all cells), by rasterizing the overlapping cells"""
+
+    hits = cells_gdf.sindex.query(shapely.box(*window_bounds(window, src.transform)), predicate="intersects")
+
+    if len(hits) == 0:
+        return np.full((int(window.height), int(window.width)), -1, dtype=np.int64)
+
+    labels = rasterize(
+        zip(cells_gdf.geometry.values[hits], hits + 1),
+        out_shape=(int(window.height), int(window.width)),
+        transform=window_transform(window, src.transform),
+        fill=0,
+        dtype="int32"
+    )
+
+    return labels.astype(np.int64) - 1
+
+
+class _CellAccumulator:
+    """
+    Running count / sum / sum of squares / min / max per cell for one band
+
+    With keep_values the values of unfinished cells are kept as well, flush() turns the values of finished cells into
+    their median and drops them.
+    """
+
+    def __init__(self, n_cells, keep_values=False):
+        self.n_cells = n_cells
+        self.count = np.zeros(n_cells, dtype=np.int64)
+        self.total = np.zeros(n_cells)
+        self.total_sq = np.zeros(n_cells)
+        self.minimum = np.full(n_cells, np.inf)
+        self.maximum = np.full(n_cells, -np.inf)
+        self.keep_values = keep_values
+        self.medians = np.full(n_cells, np.nan)
+        self.pending_labels = np.empty(0, dtype=np.int64)
+        self.pending_values = np.empty(0)
+
+    def add(self, labels, values):
+        if len(labels) == 0:
+            return
+
+        self.count += np.bincount(labels, minlength=self.n_cells)
+        self.total += np.bincount(labels, weights=values, minlength=self.n_cells)
+        self.total_sq += np.bincount(labels, weights=values * values, minlength=self.n_cells)
+
+        # min / max per label with one sort and reduceat
+        order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[order]
+        sorted_values = values[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        unique_labels = sorted_labels[starts]
+
+        self.minimum[unique_labels] = np.minimum(self.minimum[unique_labels],
+                                                 np.minimum.reduceat(sorted_values, starts))
+        self.maximum[unique_labels] = np.maximum(self.maximum[unique_labels],
+                                                 np.maximum.reduceat(sorted_values, starts))
+
+        if self.keep_values:
+            self.pending_labels = np.concatenate([self.pending_labels, labels])
+            self.pending_values = np.concatenate([self.pending_values, values])
+
+    def flush(self, finished=None):
+        """Compute the median of the finished cells (boolean mask over the cells, None for all) and drop their values"""
+
+        if len(self.pending_labels) == 0:
+            return
+
+        done = np.ones(len(self.pending_labels), dtype=bool) if finished is None else finished[self.pending_labels]
+        if not done.any():
+            return
+
+        labels = self.pending_labels[done]
+        values = self.pending_values[done]
+        self.pending_labels = self.pending_labels[~done]
+        self.pending_values = self.pending_values[~done]
+
+        # Sort by cell, then by value: the median of a cell is the middle of its run
+        order = np.lexsort((values, labels))
+        sorted_labels = labels[order]
+        sorted_values = values[order]
+        start = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        n = np.diff(np.r_[start, len(sorted_labels)])
+
+        self.medians[sorted_labels[start]] = (sorted_values[start + (n - 1) // 2] + sorted_values[start + n // 2]) / 2
+
+    def median(self):
+        self.flush()
+        return self.medians.copy()
+
+    def results(self, stats):
+        has_values = self.count > 0
+        out = {}
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(has_values, self.total / np.maximum(self.count, 1), np.nan)
+
+            for stat in stats:
+                if stat == 'mean':
+                    out[stat] = mean
+                elif stat == 'std':
+                    variance = self.total_sq / np.maximum(self.count, 1) - mean * mean
+                    out[stat] = np.where(has_values, np.sqrt(np.clip(variance, 0, None)), np.nan)
+                elif stat == 'min':
+                    out[stat] = np.where(has_values, self.minimum, np.nan)
+                elif stat == 'max':
+                    out[stat] = np.where(has_values, self.maximum, np.nan)
+                elif stat == 'count':
+                    out[stat] = self.count.copy()
+                elif stat == 'median':
+                    out[stat] = self.median()
+
+        return out
+
+
+def zonal_stats_by_cell(raster_path, grid, bands=None, stats=ZONAL_STATS, window_rows=1024):
+    """
+    Zonal statistics of every band of a local raster, for every grid cell
+
+    Parameters:
+    - raster_path: GeoTIFF/COG
+    - grid: RegularGrid (cells labelled analytically) or grid GeoDataFrame with cell_id (cells rasterized per window)
+    - bands: Band numbers or descriptions (default: all bands)
+    - stats: Any of 'mean', 'median', 'std', 'min', 'max', 'count' (default: all)
+    - window_rows: Raster rows read per window (with a RegularGrid rounded to whole cell rows)
+
+    Returns:
+    - DataFrame with cell_id and one "{band}_{stat}" column per band and statistic. With a RegularGrid every cell of
+      the grid is returned (in flat index order), with a GeoDataFrame the rows follow the GeoDataFrame.
+    """
+
+    unknown = set(stats) - set(ZONAL_STATS)
+    if unknown:
+        raise ValueError(f"Unknown zonal statistics: {sorted(unknown)}")
+
+    regular = not isinstance(grid, gpd.GeoDataFrame)
+
+    with rasterio.open(raster_path) as src:
+        band_indexes, band_names = _band_names(src, bands)
+
+        if regular:
+            if src.crs is not None and src.crs != grid.crs:
+                raise ValueError(f"Raster CRS {src.crs} does not match the grid CRS {grid.crs}, pass the grid "
+                                 f"GeoDataFrame instead to reproject the cells")
+            n_cells = grid.n_cells
+            i, j = grid.all_indices()
+            cell_ids = grid.cell_ids(i, j)
+            cell_miny = grid.cell_bounds(i, j)[1]
+            windows = _cell_row_windows(grid, src, window_rows)
+        else:
+            cells_gdf = grid if grid.crs == src.crs else grid.to_crs(src.crs)
+            cells_gdf = cells_gdf.reset_index(drop=True)
+            n_cells = len(cells_gdf)
+            cell_ids = cells_gdf['cell_id'].to_numpy()
+            cell_miny = cells_gdf.bounds['miny'].to_numpy()
+            windows = [(row_off, min(window_rows, src.height - row_off))
+                       for row_off in range(0, src.height, window_rows)]
+
+        keep_values = 'median' in stats
+        accumulators = [_CellAccumulator(n_cells, keep_values=keep_values) for _ in band_indexes]
+        # Only north-up rasters read the cells from north to south, otherwise the medians are computed at the end
+        north_up = src.transform.e < 0 and src.transform.b == 0 and src.transform.d == 0
+
+        for row_off, height in windows:
+            window = Window(0, row_off, src.width, height)
+
+            if regular:
+                labels = _window_labels_from_grid(grid, src, window)
+            else:
+                labels = _window_labels_from_polygons(cells_gdf, src, window)
+
+            in_cell = labels >= 0
+            if not in_cell.any():
+                continue
+
+            data = src.read(band_indexes, window=window, masked=True)
+            valid_mask = ~np.ma.getmaskarray(data)
+            data = np.ma.getdata(data).astype(float)
+
+            for band_pos, accumulator in enumerate(accumulators):
+                valid = in_cell & valid_mask[band_pos] & ~np.isnan(data[band_pos])
+                accumulator.add(labels[valid], data[band_pos][valid])
+
+            if keep_values and north_up:
+                # Cells entirely above the first pixel centre of the next window get no more pixels
+                next_y = src.transform.f + (row_off + height + 0.5) * src.transform.e
+                finished = cell_miny > next_y - 0.01 * src.transform.e
+                for accumulator in accumulators:
+                    accumulator.flush(finished)
+
+    result = pd.DataFrame({'cell_id': cell_ids})
+    for band_name, accumulator in zip(band_names, accumulators):
+        for stat, values in accumulator.results(stats).items():
+            result[f"{band_name}_{stat}"] = values
+
+    return result
+
+
+def compute_grid_zonal_stats(grid_file_path, raster_paths, output_path=None, grid=None, stats=ZONAL_STATS,
+                             window_rows=1024):
+    """
+    Zonal statistics of several local rasters for a grid file (the per-cell counterpart of
+    sample_gee_rasters_at_centroids with a LocalRasterBackend)
+
+    Parameters:
+    - grid_file_path: Grid GPKG with cell_id
+    - raster_paths: {prefix: path or (path, bands)}. Columns are named "{prefix}_{band}_{stat}".
+    - output_path: Optional output file, saved with a timestamp like the centroid sampler
+    - grid: Optional RegularGrid the grid file was built from. Pixels are then labelled analytically instead of by
+            rasterizing the cells (pixels of cells clipped at the boundary count for the full square cell).
+    - stats, window_rows: See zonal_stats_by_cell
+
+    Returns:
+    - Grid GeoDataFrame with the statistics columns
+    """
+
+    print(f"Loading grid from: {grid_file_path}")
+    grid_gdf = gpd.read_file(grid_file_path)[["cell_id", "geometry"]]
+    print(f"Loaded grid with {len(grid_gdf)} cells")
+
+    result_gdf = grid_gdf.copy()
+
+    for prefix, source in raster_paths.items():
+        path, bands = (source[0], source[1]) if isinstance(source, (tuple, list)) else (source, None)
+
+        print(f"Computing zonal statistics for {prefix} ({path})...")
+        start_time = time.perf_counter()
+
+        cell_stats = zonal_stats_by_cell(path, grid if grid is not None else grid_gdf, bands=bands, stats=stats,
+                                         window_rows=window_rows)
+        cell_stats = cell_stats.rename(columns={c: f"{prefix}_{c}" for c in cell_stats.columns if c != 'cell_id'})
+
+        result_gdf = result_gdf.merge(cell_stats, on='cell_id', how='left')
+        print(f"✓ {prefix}: {len(cell_stats.columns) - 1} columns in {time.perf_counter() - start_time:.1f}s")
+
+    if output_path is not None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        _output_path = output_path.with_stem(f"{output_path.stem}_{timestamp}")
+
+        result_gdf.to_file(str(_output_path), driver="GPKG")
+        print(f"Saved result to: {str(_output_path)}")
+
+    return result_gdf
@@ -0,0 +1,295 @@
+# src/UHI/regular_grid.py
+
+from UHI.config import *
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+"""
+Analytic description of a regular square grid.
+
+Both generate_grid and create_grid_from_gee_boundary define their grid by an origin (lower-left corner of the
+boundary extent), a cell size and a number of columns/rows, but everything downstream treats the result as arbitrary
+polygons. RegularGrid keeps only those parameters, so that point -> cell, cell -> bounds/centroid and bbox -> cell
+range lookups are plain integer arithmetic, and polygons are only built when they are actually needed.
+
+Index conventions (the same as create_grid_from_gee_boundary):
+- i is the column (x) index, counted from the origin towards east
+- j is the row (y) index, counted from the origin towards north
+- cells are ordered x outer / y inner, so the flat index of a cell is i * ny + j
+- cell ids are "cell_{i}_{j}"
+"""
+
+
+class RegularGrid:
+    """Regular square grid described by origin, cell size, shape (nx, ny) and CRS"""
+
+    def __init__(self, origin_x, origin_y, cell_size, nx, ny, crs=CRS):
+        self.origin_x = float(origin_x)
+        self.origin_y = float(origin_y)
+        self.cell_size = float(cell_size)
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.crs = crs
+
+    @classmethod
+    def from_bounds(cls, bounds, cell_size, crs=CRS):
+        """
+        Grid covering bounds = (minx, miny, maxx, maxy), with the origin at (minx, miny)
+
+        The number of cells matches np.arange(minx, maxx, cell_size), i.e. the loop bounds used by generate_grid.
+        """
+
+        minx, miny, maxx, maxy = bounds
+        nx = len(np.arange(minx, maxx, cell_size))
+        ny = len(np.arange(miny, maxy, cell_size))
+
+        return cls(minx, miny, cell_size, nx, ny, crs=crs)
+
+    @classmethod
+    def from_crs_transform(cls, crs_transform, bounds, crs=CRS, pixels_per_cell=1):
+        """
+        Grid covering bounds whose cell edges lie on the pixel lattice of a raster
+
+        Parameters:
+        - crs_transform: GEE style [xScale, xShear, xTranslation, yShear, yScale, yTranslation] of the raster
+                         (as printed by check_raster_crs, the same order as an affine.Affine)
+        - bounds: (minx, miny, maxx, maxy) to cover, in the raster CRS
+        - crs: CRS of the raster
+        - pixels_per_cell: Cell edge length in pixels (1 gives one cell per pixel)
+
+        The origin is snapped down to a multiple of the cell size from the raster origin, so any two grids built from
+        the same transform and cell size share one lattice, whatever their bounds.
+        """
+
+        x_scale, x_shear, x_translation, y_shear, y_scale, y_translation = [float(v) for v in crs_transform[:6]]
+
+        if x_shear != 0 or y_shear != 0:
+            raise ValueError(f"Cannot align a grid to a sheared/rotated transform: {crs_transform}")
+        if abs(abs(x_scale) - abs(y_scale)) > 1e-9:
+            raise ValueError(f"Cannot align square cells to non-square pixels: {crs_transform}")
+
+        cell_size = abs(x_scale) * int(pixels_per_cell)
+        minx, miny, maxx, maxy = bounds
+
+        origin_x = x_translation + np.floor((minx - x_translation) / cell_size) * cell_size
+        origin_y = y_translation + np.floor((miny - y_translation) / cell_size) * cell_size
+        nx = int(np.ceil((maxx - origin_x) / cell_size))
+        ny = int(np.ceil((maxy - origin_y) / cell_size))
+
+        return cls(origin_x, origin_y, cell_size, nx, ny, crs=crs)
+
+    def __repr__(self):
+        return (f"RegularGrid(origin=({self.origin_x}, {self.origin_y}), cell_size={self.cell_size}, "
+                f"shape=({self.nx}, {self.ny}), crs={self.crs})")
+
+    def __eq__(self, other):
+        if not isinstance(other, RegularGrid):
+            return NotImplemented
+        return self.params() == other.params()
+
+    @property
+    def shape(self):
+        return self.nx, self.ny
+
+    @property
+    def n_cells(self):
+        return self.nx * self.ny
+
+    @property
+    def bounds(self):
+        return (self.origin_x, self.origin_y,
+                self.origin_x + self.nx * self.cell_size, self.origin_y + self.ny * self.cell_size)
+
+    def params(self):
+        """Plain dict of the grid parameters (e.g. for metadata, hashing or passing to SQL)"""
+
+        return {
+            'origin_x': self.origin_x,
+            'origin_y': self.origin_y,
+            'cell_size': self.cell_size,
+            'nx': self.nx,
+            'ny': self.ny,
+            'crs': str(self.crs)
+        }
+
+    def window(self, i0, j0, nx, ny):
+        """
+        Sub-grid of nx x ny cells starting at cell (i0, j0), clipped to this grid
+
+        Local indices in the window are offset by (i0, j0) from the indices in this grid.
+        """
+
+        nx = max(0, min(nx, self.nx - i0))
+        ny = max(0, min(ny, self.ny - j0))
+
+        return RegularGrid(self.origin_x + i0 * self.cell_size, self.origin_y + j0 * self.cell_size,
+                           self.cell_size, nx, ny, crs=self.crs)
+
+    @property
+    def crs_transform(self):
+        """The grid as a north-up raster transform, GEE style [xScale, xShear, xTranslation, yShear, yScale, yTranslation]"""
+
+        return [self.cell_size, 0.0, self.origin_x, 0.0, -self.cell_size, self.origin_y + self.ny * self.cell_size]
+
+    def is_aligned_to(self, crs_transform, tolerance=1e-6):
+        """True if every cell edge lies on the pixel lattice of crs_transform and cells are whole pixels"""
+
+        x_scale, x_shear, x_translation, y_shear, y_scale, y_translation = [float(v) for v in crs_transform[:6]]
+
+        if x_shear != 0 or y_shear != 0:
+            return False
+
+        def _on_lattice(value, step):
+            ratio = value / abs(step)
+            return abs(ratio - round(ratio)) < tolerance
+
+        return (_on_lattice(self.cell_size, x_scale) and _on_lattice(self.cell_size, y_scale)
+                and _on_lattice(self.origin_x - x_translation, x_scale)
+                and _on_lattice(self.origin_y - y_translation, y_scale))
+
+    def cell_to_pixel(self, i, j, crs_transform):
+        """
+        (i, j) -> (row, col) of the top-left pixel of each cell in a north-up raster the grid is aligned to
+
+        With one pixel per cell this is a direct array index, raster[row, col], with no resampling.
+        """
+
+        if not self.is_aligned_to(crs_transform):
+            raise ValueError(f"{self} is not aligned to the pixel lattice of {crs_transform}")
+
+        x_scale, _, x_translation, _, y_scale, y_translation = [float(v) for v in crs_transform[:6]]
+        minx, miny, maxx, maxy = self.cell_bounds(i, j)
+
+        col = np.rint((minx - x_translation) / x_scale).astype(np.int64)
+        row = np.rint((maxy - y_translation) / y_scale).astype(np.int64)
+
+        return row, col
+
+    # Index arithmetic
+
+    def contains_index(self, i, j):
+        """Boolean mask of (i, j) pairs that lie inside the grid"""
+
+        i = np.asarray(i)
+        j = np.asarray(j)
+        return (i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny)
+
+    def flat_index(self, i, j):
+        """(i, j) -> flat index in x outer / y inner order"""
+
+        return np.asarray(i, dtype=np.int64) * self.ny + np.asarray(j, dtype=np.int64)
+
+    def unflat_index(self, k):
+        """Flat index -> (i, j)"""
+
+        return np.divmod(np.asarray(k, dtype=np.int64), self.ny)
+
+    def all_indices(self):
+        """(i, j) of every cell, in flat index order"""
+
+        return self.unflat_index(np.arange(self.n_cells, dtype=np.int64))
+
+    def point_to_cell(self, x, y):
+        """
+        Vectorised point -> cell lookup
+
+        Parameters:
+        - x, y: Coordinates (scalars or arrays) in the grid CRS
+
+        Returns:
+        - (i, j) integer arrays, -1 for points outside the grid
+        """
+
+        i = np.floor((np.asarray(x, dtype=float) - self.origin_x) / self.cell_size).astype(np.int64)
+        j = np.floor((np.asarray(y, dtype=float) - self.origin_y) / self.cell_size).astype(np.int64)
+
+        outside = ~self.contains_index(i, j)
+        i = np.where(outside, -1, i)
+        j = np.where(outside, -1, j)
+
+        return i, j
+
+    def cell_bounds(self, i, j):
+        """(i, j) -> (minx, miny, maxx, maxy) arrays"""
+
+        minx = self.origin_x + np.asarray(i, dtype=float) * self.cell_size
+        miny = self.origin_y + np.asarray(j, dtype=float) * self.cell_size
+
+        return minx, miny, minx + self.cell_size, miny + self.cell_size
+
+    def cell_centroid(self, i, j):
+        """(i, j) -> (x, y) arrays of the cell centres"""
+
+        half = self.cell_size / 2
+        return (self.origin_x + (np.asarray(i, dtype=float) * self.cell_size) + half,
+                self.origin_y + (np.asarray(j, dtype=float) * self.cell_size) + half)
+
+    def bbox_to_cell_range(self, minx, miny, maxx, maxy):
+        """
+        Vectorised bbox -> range of cells overlapping the bbox
+
+        Parameters:
+        - minx, miny, maxx, maxy: Bounding box coordinates (scalars or arrays, e.g. GeoSeries.bounds columns)
+
+        Returns:
+        - (i_min, i_max, j_min, j_max), inclusive and clipped to the grid. Where the bbox lies completely outside
+          the grid, i_min > i_max or j_min > j_max.
+        """
+
+        cs = self.cell_size
+
+        i_min = np.floor((np.asarray(minx, dtype=float) - self.origin_x) / cs).astype(np.int64)
+        j_min = np.floor((np.asarray(miny, dtype=float) - self.origin_y) / cs).astype(np.int64)
+        # A bbox edge lying exactly on a grid line does not overlap the next cell
+        i_max = np.maximum(np.ceil((np.asarray(maxx, dtype=float) - self.origin_x) / cs).astype(np.int64) - 1, i_min)
+        j_max = np.maximum(np.ceil((np.asarray(maxy, dtype=float) - self.origin_y) / cs).astype(np.int64) - 1, j_min)
+
+        return (np.clip(i_min, 0, None), np.clip(i_max, None, self.nx - 1),
+                np.clip(j_min, 0, None), np.clip(j_max, None, self.ny - 1))
+
+    # Cell ids
+
+    def cell_ids(self, i, j):
+        """(i, j) -> array of "cell_{i}_{j}" ids"""
+
+        return np.array([f"cell_{a}_{b}" for a, b in zip(np.ravel(i), np.ravel(j))], dtype=object)
+
+    @staticmethod
+    def parse_cell_ids(cell_ids):
+        """Array of "cell_{i}_{j}" ids -> (i, j) integer arrays"""
+
+        parts = np.char.split(np.asarray(cell_ids, dtype=str), "_")
+        i = np.array([int(p[1]) for p in parts], dtype=np.int64)
+        j = np.array([int(p[2]) for p in parts], dtype=np.int64)
+
+        return i, j
+
+    # Geometry, only on request
+
+    def cell_polygons(self, i, j):
+        """(i, j) -> array of shapely box polygons"""
+
+        return shapely.box(*self.cell_bounds(i, j))
+
+    def to_geodataframe(self, i=None, j=None):
+        """
+        Materialise cells as a GeoDataFrame with cell_id, x_index, y_index and geometry
+
+        Parameters:
+        - i, j: Optional subset of cells. All cells are built when omitted.
+        """
+
+        if i is None or j is None:
+            i, j = self.all_indices()
+
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+
+        return gpd.GeoDataFrame({
+            'cell_id': self.cell_ids(i, j),
+            'x_index': i,
+            'y_index': j,
+            'geometry': self.cell_polygons(i, j)
+        }, crs=self.crs)
@@ -1,4 +1,4 @@
-create table height_per_building_30m as
+create table citydb.height_per_building as
 SELECT 
     f.objectid AS building_objectid,
     (CAST(roof.val_string AS numeric) - CAST(ground.val_string AS numeric)) AS building_height
@@ -15,7 +15,7 @@ WHERE
     AND roof.val_string IS NOT NULL 
     AND ground.val_string IS NOT NULL
     AND CAST(roof.val_string AS numeric) > CAST(ground.val_string AS numeric); -- Sanity check
-	
-	-- Add primary key constraint on building_objectid
-ALTER TABLE height_per_building_30m
-ADD CONSTRAINT height_30m_pk PRIMARY KEY (building_objectid);
\ No newline at end of file
+
+-- Add primary key constraint on building_objectid
+ALTER TABLE citydb.height_per_building
+ADD CONSTRAINT height_per_building_pk PRIMARY KEY (building_objectid);
@@ -1,18 +1,19 @@
 -- Create a new table with the aggregated roof area per building
-CREATE TABLE roof_area_per_building_30m AS
+CREATE TABLE citydb.roof_area_per_building AS
 SELECT
   f.objectid AS building_objectid,
   SUM(CAST(p.val_string AS numeric)) AS total_roof_area
 FROM
-  feature f
+  citydb.feature f
 JOIN
-  property p ON f.id = p.feature_id
+  citydb.property p ON f.id = p.feature_id
 WHERE
   f.objectclass_id = 712
   AND p.name = 'Flaeche'
+  AND f.objectid IS NOT NULL  -- GROUP BY would collect these into one NULL row, which the primary key rejects
 GROUP BY
-   building_objectid
+   building_objectid;
 
--- Add primary key constraint on building_objectid
---ALTER TABLE roof_area_per_building_30m
---ADD CONSTRAINT roof_area_30m_pk PRIMARY KEY (building_objectid);
\ No newline at end of file
+-- Add primary key constraint on building_objectid (unique after the GROUP BY, non-NULL after the filter)
+ALTER TABLE citydb.roof_area_per_building
+ADD CONSTRAINT roof_area_per_building_pk PRIMARY KEY (building_objectid);
@@ -1,5 +1,5 @@
 -- Create volume per building table
-CREATE TABLE volume_per_building AS
+CREATE TABLE citydb.volume_per_building AS
 SELECT 
     f.building_objectid,
     f.total_floor_area,
@@ -8,7 +8,7 @@ SELECT
 FROM 
     citydb.floor_area_per_building f
 INNER JOIN 
-    height_per_building h ON f.building_objectid = h.building_objectid
+    citydb.height_per_building h ON f.building_objectid = h.building_objectid
 WHERE 
     f.total_floor_area IS NOT NULL 
     AND h.building_height IS NOT NULL
@@ -16,6 +16,6 @@ WHERE
     AND h.building_height > 0;
 
 -- Add primary key constraint
-ALTER TABLE volume_per_building
+ALTER TABLE citydb.volume_per_building
 ADD CONSTRAINT volume_per_building_pk PRIMARY KEY (building_objectid);
 
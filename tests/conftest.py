@@ -0,0 +1,22 @@
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# The package lives in src/ and is not necessarily installed
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+
+@pytest.fixture
+def short_backoff(monkeypatch):
+    """Cap the retry backoff sleeps of gee_dispatch at 10 ms (the fake latencies are not affected)"""
+
+    from UHI.raster_spectral import gee_dispatch
+
+    monkeypatch.setattr(gee_dispatch, "time", SimpleNamespace(sleep=lambda seconds: time.sleep(min(seconds, 0.01)),
+                                                              monotonic=time.monotonic,
+                                                              perf_counter=time.perf_counter))
@@ -0,0 +1,361 @@
+import io
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+"""
+Offline stand-in for the parts of the ee API used by the fishnet sampler (test double, not part of the package).
+
+FakeEEClient can be passed as ee_client to sample_gee_rasters_at_centroids (and friends) to run the whole batching,
+dispatch, retry and checkpoint machinery without Earth Engine. Every getInfo() sleeps for a simulated network latency,
+and requests above the configured concurrency or rate limits fail with the same messages Earth Engine uses for
+throttling, so retries and backoff can be exercised too.
+
+Pixel values come from plain Python functions of the (projected) point coordinates, e.g.
+
+    client = FakeEEClient(latency=0.3, max_concurrent=4)
+    image = client.Image({'NDVI': lambda x, y: (x % 100) / 100})
+
+client.data.computePixels serves the same images as NUMPY_NDARRAY blocks, and FakeNPYTileServer serves them as .npy
+tiles over HTTP for gee_pixels.HTTPNPYFetcher.
+"""
+
+
+class FakeEEException(Exception):
+    """Raised for simulated throttling and injected failures (stands in for ee.EEException)"""
+
+
+class FakeGeometry:
+    def __init__(self, geo_json, proj=None, **kwargs):
+        self.geo_json = geo_json
+        self.proj = proj
+
+    @property
+    def coordinates(self):
+        return self.geo_json['coordinates']
+
+
+class FakeFeature:
+    def __init__(self, geometry, properties=None):
+        self.geometry = geometry
+        self.properties = dict(properties or {})
+
+
+class FakeFeatureCollection:
+    def __init__(self, features):
+        self.features = list(features)
+
+
+class _FakeResult:
+    """Lazy result, only 'computed' (with latency and throttling) on getInfo()"""
+
+    def __init__(self, client, compute):
+        self._client = client
+        self._compute = compute
+
+    def getInfo(self):
+        return self._client._request(self._compute)
+
+
+class FakeImage:
+    def __init__(self, client, band_functions, crs="EPSG:25832", crs_transform=(30, 0, 600000, 0, -30, 5600020)):
+        self._client = client
+        self.band_functions = dict(band_functions)
+        self.crs = crs
+        self.crs_transform = list(crs_transform)
+
+    def _derive(self, band_functions):
+        return FakeImage(self._client, band_functions, crs=self.crs, crs_transform=self.crs_transform)
+
+    def select(self, selectors, new_names=None):
+        names = list(self.band_functions)
+        selected = [names[s] if isinstance(s, int) else s for s in selectors]
+        new_names = new_names or selected
+        return self._derive({new: self.band_functions[old] for old, new in zip(selected, new_names)})
+
+    def rename(self, *names):
+        names = list(names[0]) if len(names) == 1 and isinstance(names[0], (list, tuple)) else list(names)
+        return self._derive(dict(zip(names, self.band_functions.values())))
+
+    def unmask(self, value=0):
+        def _unmasked(fn):
+            return lambda x, y: value if fn(x, y) is None else fn(x, y)
+
+        return self._derive({name: _unmasked(fn) for name, fn in self.band_functions.items()})
+
+    def sampleRegions(self, collection, properties=None, scale=None, projection=None, tileScale=1, geometries=False):
+        def _compute():
+            features = []
+            for feature in collection.features:
+                x, y = feature.geometry.coordinates
+                values = {name: fn(x, y) for name, fn in self.band_functions.items()}
+                # Like Earth Engine, points that are masked in every band are dropped
+                if all(v is None for v in values.values()):
+                    continue
+                features.append({'type': 'Feature', 'geometry': None,
+                                 'properties': {**feature.properties, **values}})
+            return {'type': 'FeatureCollection', 'features': features}
+
+        return _FakeResult(self._client, _compute)
+
+    def serialize(self):
+        return json.dumps({'bands': list(self.band_functions), 'crs': self.crs, 'crs_transform': self.crs_transform})
+
+    def getInfo(self):
+        return {
+            'type': 'Image',
+            'bands': [{'id': name, 'crs': self.crs, 'crs_transform': self.crs_transform}
+                      for name in self.band_functions]
+        }
+
+
+def _pixel_values(image, bands, x0, y0, width, height, scale):
+    """(band, row, col) array of the band functions at the pixel centres of a north-up block, NaN where masked"""
+
+    x = x0 + (np.arange(width) + 0.5) * scale
+    y = y0 - (np.arange(height) + 0.5) * scale
+    xx, yy = np.meshgrid(x, y)
+
+    out = np.empty((len(bands), height, width))
+    for band_pos, band in enumerate(bands):
+        fn = image.band_functions[band]
+        values = [fn(float(a), float(b)) for a, b in zip(xx.ravel(), yy.ravel())]
+        out[band_pos] = np.array([np.nan if v is None else v for v in values], dtype=float).reshape(height, width)
+
+    return out
+
+
+class _FakeData:
+    """Stand-in for ee.data"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def computePixels(self, request):
+        def _compute():
+            bands = list(request['bandIds'])
+            grid = request['grid']
+            transform = grid['affineTransform']
+            width, height = grid['dimensions']['width'], grid['dimensions']['height']
+
+            values = _pixel_values(request['expression'], bands, transform['translateX'], transform['translateY'],
+                                   width, height, transform['scaleX'])
+
+            result = np.zeros((height, width), dtype=[(band, '<f8') for band in bands])
+            for band_pos, band in enumerate(bands):
+                result[band] = values[band_pos]
+            return result
+
+        return self._client._request(_compute)
+
+
+class FakeNPYTileServer:
+    """
+    Local HTTP server serving blocks of a FakeImage
+
+    - GET /pixels?x0=&y0=&width=&height=&scale=&bands= answers with a (band, row, col) .npy tile
+    - GET /download?(same parameters) answers with a GeoTIFF tile, like a getDownloadURL link
+
+        with FakeNPYTileServer(image) as server:
+            fetch_pixels(image, ['NDVI'], bounds, 30, fetch_block=HTTPNPYFetcher(server.url))
+            download_gee_image(image, ['NDVI'], bounds, 30, output_path, url_fn=server.download_url_fn(['NDVI']))
+
+    Parameters:
+    - failure_rate: Probability of a 503 response (transient, should be retried)
+    - truncate_rate: Probability of a GeoTIFF cut off halfway (should fail verification and be downloaded again)
+    - seed: Random seed for the failures
+    """
+
+    def __init__(self, image, host="127.0.0.1", port=0, failure_rate=0.0, truncate_rate=0.0, seed=None):
+        self.image = image
+        self.failure_rate = failure_rate
+        self.truncate_rate = truncate_rate
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path not in ("/pixels", "/download"):
+                    self.send_error(404)
+                    return
+
+                with server._lock:
+                    server.requests += 1
+                    fail = server._random.random() < server.failure_rate
+                    truncate = server._random.random() < server.truncate_rate
+                    if fail:
+                        server.failures += 1
+
+                if fail:
+                    self.send_error(503, "Service Unavailable")
+                    return
+
+                query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                bands = query['bands'].split(",")
+                x0, y0, scale = float(query['x0']), float(query['y0']), float(query['scale'])
+                width, height = int(query['width']), int(query['height'])
+                values = _pixel_values(server.image, bands, x0, y0, width, height, scale)
+
+                if parsed.path == "/pixels":
+                    buffer = io.BytesIO()
+                    np.save(buffer, values, allow_pickle=False)
+                    payload = buffer.getvalue()
+                else:
+                    payload = _geotiff_bytes(values, bands, x0, y0, scale, query.get('crs', server.image.crs))
+                    if truncate:
+                        payload = payload[:len(payload) // 2]
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def download_url_fn(self, bands):
+        """url_fn for gee_tile_download.download_gee_image"""
+
+        def _url(block):
+            x_scale, _, translate_x, _, _, translate_y = block.crs_transform
+            return (f"{self.url}/download?x0={translate_x}&y0={translate_y}&width={block.nx}&height={block.ny}"
+                    f"&scale={x_scale}&crs={block.crs}&bands={','.join(bands)}")
+
+        return _url
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _geotiff_bytes(values, bands, x0, y0, scale, crs):
+    """(band, row, col) array -> GeoTIFF file content with the top-left corner at (x0, y0)"""
+
+    # Only needed for the /download endpoint
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+
+    count, height, width = values.shape
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', width=width, height=height, count=count, dtype='float32', crs=crs,
+                          transform=from_origin(x0, y0, scale, scale), nodata=np.nan) as dst:
+            dst.write(values.astype(np.float32))
+            for band, name in enumerate(bands, start=1):
+                dst.set_band_description(band, name)
+        return memfile.read()
+
+
+class _FakeImageFactory:
+    def __init__(self, client):
+        self._client = client
+
+    def __call__(self, band_functions, **kwargs):
+        return FakeImage(self._client, band_functions, **kwargs)
+
+    def cat(self, images):
+        band_functions = {}
+        for image in images:
+            band_functions.update(image.band_functions)
+        return FakeImage(self._client, band_functions, crs=images[0].crs, crs_transform=images[0].crs_transform)
+
+
+class FakeEEClient:
+    """
+    Stand-in for the ee module with simulated latency and throttling
+
+    Parameters:
+    - latency: Seconds every getInfo() takes
+    - jitter: Extra random latency (0 - jitter seconds)
+    - max_concurrent: More concurrent getInfo() calls than this fail with "Too many concurrent aggregations"
+    - max_requests_per_second: More getInfo() calls than this within one second fail with "Too many requests"
+    - failure_rate: Probability of a random "Internal error" (transient)
+    - seed: Random seed for jitter and failures
+    """
+
+    EEException = FakeEEException
+    Geometry = FakeGeometry
+    Feature = FakeFeature
+    FeatureCollection = FakeFeatureCollection
+
+    def __init__(self, latency=0.2, jitter=0.0, max_concurrent=None, max_requests_per_second=None, failure_rate=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.max_requests_per_second = max_requests_per_second
+        self.failure_rate = failure_rate
+        self.Image = _FakeImageFactory(self)
+        self.data = _FakeData(self)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._recent = deque()
+
+        # Counters to check the behaviour of the caller
+        self.requests = 0
+        self.throttled = 0
+        self.failures = 0
+        self.max_in_flight_seen = 0
+
+    def _request(self, compute):
+        with self._lock:
+            now = time.monotonic()
+            self.requests += 1
+
+            while self._recent and now - self._recent[0] > 1.0:
+                self._recent.popleft()
+
+            if self.max_requests_per_second is not None and len(self._recent) >= self.max_requests_per_second:
+                self.throttled += 1
+                raise FakeEEException("Too many requests. Rate limit exceeded.")
+
+            if self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                self.throttled += 1
+                raise FakeEEException("Too many concurrent aggregations.")
+
+            if self._random.random() < self.failure_rate:
+                self.failures += 1
+                raise FakeEEException("Internal error.")
+
+            self._recent.append(now)
+            self._in_flight += 1
+            self.max_in_flight_seen = max(self.max_in_flight_seen, self._in_flight)
+            delay = self.latency + self._random.uniform(0, self.jitter)
+
+        try:
+            time.sleep(delay)
+            return compute()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
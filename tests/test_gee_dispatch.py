@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+import requests
+
+from fake_ee import FakeEEClient, FakeEEException
+from UHI.raster_spectral.gee_dispatch import AdaptiveBatchSizer, dispatch_adaptive, dispatch_batches, \
+    is_transient_error
+
+
+def _flaky(fail_times, error):
+    """batch_fn that fails fail_times times per batch with error, then returns the batch doubled"""
+
+    attempts = {}
+    lock = threading.Lock()
+
+    def _fn(batch):
+        with lock:
+            attempts[batch] = attempts.get(batch, 0) + 1
+            attempt = attempts[batch]
+        if attempt <= fail_times:
+            raise error
+        return batch * 2
+
+    return _fn, attempts
+
+
+def _http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(f"{status_code} Error", response=response)
+
+
+@pytest.mark.parametrize("error, transient", [
+    (FakeEEException("Too many concurrent aggregations."), True),
+    (FakeEEException("Computation timed out."), True),
+    (Exception("HTTP Error 503: Service Unavailable"), True),
+    (requests.exceptions.ReadTimeout(), True),
+    (requests.exceptions.ConnectTimeout(), True),
+    (requests.exceptions.ChunkedEncodingError(), True),
+    (_http_error(429), True),
+    (_http_error(502), True),
+    (_http_error(404), False),
+    (ValueError("Band 'B500' not found"), False),
+    (FakeEEException("Image.load: Image asset not found."), False),
+])
+def test_is_transient_error(error, transient):
+    assert is_transient_error(error) is transient
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_dispatch_batches_retries_transient_errors(short_backoff, max_in_flight):
+    batch_fn, attempts = _flaky(2, FakeEEException("Too many requests. Rate limit exceeded."))
+
+    results = dispatch_batches(batch_fn, list(range(10)), max_in_flight=max_in_flight, max_retries=3)
+
+    assert results == [batch * 2 for batch in range(10)]
+    assert attempts == {batch: 3 for batch in range(10)}
+
+
+def test_dispatch_batches_gives_up_after_max_retries(short_backoff):
+    batch_fn, attempts = _flaky(5, requests.exceptions.ReadTimeout("read timed out"))
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        dispatch_batches(batch_fn, [0], max_in_flight=1, max_retries=2)
+
+    assert attempts == {0: 3}
+
+
+def test_dispatch_batches_does_not_retry_other_errors(short_backoff):
+    batch_fn, attempts = _flaky(1, ValueError("Band 'B500' not found"))
+
+    with pytest.raises(ValueError):
+        dispatch_batches(batch_fn, [0, 1, 2], max_in_flight=1, max_retries=3)
+
+    assert attempts == {0: 1}
+
+
+def test_dispatch_batches_against_throttling_fake_client(short_backoff):
+    client = FakeEEClient(latency=0.02, max_concurrent=2, seed=1)
+    image = client.Image({'value': lambda x, y: x + y})
+
+    def _batch_fn(batch):
+        return client.data.computePixels({
+            'expression': image,
+            'bandIds': ['value'],
+            'grid': {
+                'dimensions': {'width': 2, 'height': 1},
+                'affineTransform': {'scaleX': 10, 'translateX': batch * 20, 'translateY': 100}
+            }
+        })['value'].tolist()
+
+    results = dispatch_batches(_batch_fn, list(range(12)), max_in_flight=6, max_retries=50)
+
+    # Pixel centres (batch * 20 + 5 / 15, 95)
+    assert results == [[[batch * 20 + 5 + 95, batch * 20 + 15 + 95]] for batch in range(12)]
+    assert client.throttled > 0
+    assert client.max_in_flight_seen <= 2
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 3])
+def test_dispatch_adaptive_shrinks_on_payload_errors(short_backoff, max_in_flight):
+    covered = []
+    lock = threading.Lock()
+    transient_failures = {'left': 3}
+
+    def _batch_fn(batch_start, batch_end, tile_scale):
+        with lock:
+            if transient_failures['left'] > 0:
+                transient_failures['left'] -= 1
+                raise FakeEEException("Internal error.")
+        if batch_end - batch_start > 60:
+            raise FakeEEException("Payload size exceeds the limit.")
+        with lock:
+            covered.extend(range(batch_start, batch_end))
+        return 100 * (batch_end - batch_start)
+
+    sizer = AdaptiveBatchSizer(initial_size=200, min_size=10, target_latency=10)
+    dispatch_adaptive(_batch_fn, [(0, 500), (700, 1000)], sizer, max_in_flight=max_in_flight, max_retries=5)
+
+    # Every cell exactly once, and the sizer never grows back to a size that failed
+    assert sorted(covered) == list(range(0, 500)) + list(range(700, 1000))
+    assert sizer.max_size < 200
+    assert sizer.metadata()['batch_sizes'][0] <= 60
+    assert sizer.metadata()['errors'] >= 2
+
+
+def test_dispatch_adaptive_raises_tile_scale_on_memory_errors(short_backoff):
+    tile_scales = []
+
+    def _batch_fn(batch_start, batch_end, tile_scale):
+        if tile_scale < 4:
+            raise FakeEEException("User memory limit exceeded.")
+        tile_scales.append(tile_scale)
+        return 0
+
+    sizer = AdaptiveBatchSizer(initial_size=50)
+    dispatch_adaptive(_batch_fn, [(0, 100)], sizer)
+
+    assert sizer.tile_scale == 4
+    assert tile_scales == [4, 4]
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from fake_ee import FakeEEClient, FakeNPYTileServer
+from UHI.raster_spectral.gee_pixels import ComputePixelsFetcher, HTTPNPYFetcher, fetch_pixels, pixel_blocks
+
+# 10m asset lattice with its origin off the multiples of 10
+ASSET_TRANSFORM = [10, 0, 600003, 0, -10, 5600007]
+BOUNDS = (600100, 5600100, 600840, 5600610)
+
+
+def _bands():
+    return {
+        'NDVI': lambda x, y: round((x - 600000) / 1000, 4),
+        # Masked in the western part, those pixels are dropped
+        'LST': lambda x, y: None if x < 600200 else round((y - 5600000) / 10, 3)
+    }
+
+
+def _expected(frame):
+    ndvi = np.round((frame['x'] - 600000) / 1000, 4)
+    lst = np.round((frame['y'] - 5600000) / 10, 3)
+    return ndvi, lst
+
+
+def test_pixel_blocks_follow_the_asset_lattice():
+    pixel_grid, blocks = pixel_blocks(BOUNDS, 10, align_to=ASSET_TRANSFORM, block_size=32)
+
+    assert (pixel_grid.origin_x - 600003) % 10 == pytest.approx(0)
+    assert (pixel_grid.origin_y - 5600007) % 10 == pytest.approx(0)
+    assert sum(block.n_cells for block in blocks) == pixel_grid.n_cells
+    assert max(max(block.nx, block.ny) for block in blocks) == 32
+
+
+@pytest.mark.parametrize("scale", [25, 5, 10.5])
+def test_pixel_blocks_reject_scales_off_the_asset_lattice(scale):
+    with pytest.raises(ValueError, match="whole number"):
+        pixel_blocks(BOUNDS, scale, align_to=ASSET_TRANSFORM)
+
+
+def test_pixel_blocks_at_a_multiple_of_the_asset_pixels():
+    pixel_grid, _ = pixel_blocks(BOUNDS, 30, align_to=ASSET_TRANSFORM)
+
+    assert pixel_grid.cell_size == 30
+    assert (pixel_grid.origin_x - 600003) % 10 == pytest.approx(0)
+
+
+def test_fetch_pixels_with_compute_pixels(short_backoff):
+    client = FakeEEClient(latency=0, max_concurrent=2)
+    image = client.Image(_bands())
+
+    frame = fetch_pixels(image, ['NDVI', 'LST'], BOUNDS, 10, align_to=ASSET_TRANSFORM, block_size=16,
+                         fetch_block=ComputePixelsFetcher(ee_client=client), max_in_flight=4, max_retries=20)
+
+    pixel_grid, _ = pixel_blocks(BOUNDS, 10, align_to=ASSET_TRANSFORM)
+    masked_columns = int(np.ceil((600200 - pixel_grid.origin_x) / 10))
+
+    assert len(frame) == (pixel_grid.nx - masked_columns) * pixel_grid.ny
+    assert frame['x'].min() > 600200
+    # Pixel centres of the asset lattice
+    np.testing.assert_allclose((frame['x'] - 600003 - 5) % 10, 0, atol=1e-6)
+    ndvi, lst = _expected(frame)
+    np.testing.assert_allclose(frame['NDVI'], ndvi)
+    np.testing.assert_allclose(frame['LST'], lst)
+
+
+def test_fetch_pixels_over_http_retries_503(short_backoff):
+    client = FakeEEClient(latency=0)
+    image = client.Image(_bands())
+
+    with FakeNPYTileServer(image, failure_rate=0.3, seed=4) as server:
+        frame = fetch_pixels(image, ['NDVI', 'LST'], BOUNDS, 20, block_size=8,
+                             fetch_block=HTTPNPYFetcher(server.url), max_in_flight=4, max_retries=20)
+
+    assert server.failures > 0
+    assert len(frame) == 32 * 26
+    assert frame[['x', 'y']].duplicated().sum() == 0
+    ndvi, lst = _expected(frame)
+    np.testing.assert_allclose(frame['NDVI'], ndvi)
+    np.testing.assert_allclose(frame['LST'], lst)
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import rasterio
+
+from fake_ee import FakeEEClient, FakeNPYTileServer
+from UHI.raster_spectral.gee_tile_download import MANIFEST_FILE, download_gee_image
+
+BOUNDS = (600000, 5600000, 600700, 5600500)
+BANDS = ['NDVI', 'LST']
+
+
+def _image():
+    return FakeEEClient(latency=0).Image({
+        'NDVI': lambda x, y: (x - 600000) / 1000,
+        'LST': lambda x, y: (y - 5600000) / 10
+    })
+
+
+def _check_mosaic(path):
+    with rasterio.open(path) as src:
+        assert (src.width, src.height, src.count) == (70, 50, 2)
+        assert src.descriptions == tuple(BANDS)
+        assert tuple(src.transform)[:6] == (10, 0, 600000, 0, -10, 5600500)
+        ndvi, lst = src.read()
+
+    cols, rows = np.meshgrid(np.arange(70), np.arange(50))
+    np.testing.assert_allclose(ndvi, (cols * 10 + 5) / 1000, rtol=1e-6)
+    np.testing.assert_allclose(lst, (500 - rows * 10 - 5) / 10, rtol=1e-6)
+
+
+def test_download_retries_and_mosaics(tmp_path, short_backoff):
+    image = _image()
+    output_path = tmp_path / "image.tif"
+
+    with FakeNPYTileServer(image, failure_rate=0.25, truncate_rate=0.25, seed=2) as server:
+        result = download_gee_image(image, BANDS, BOUNDS, 10, output_path, tile_pixels=16,
+                                    url_fn=server.download_url_fn(BANDS), max_in_flight=4, max_retries=20)
+
+    # 5 x 4 tiles of up to 16 x 16 pixels, 503s retried and truncated tiles downloaded again
+    assert result['tiles'] == 20
+    assert result['downloaded'] == 20
+    assert server.failures > 0
+    assert server.requests > 20
+    _check_mosaic(output_path)
+
+    manifest = json.loads((tmp_path / "image_tiles" / MANIFEST_FILE).read_text(encoding="utf-8"))
+    assert len(manifest['tiles']) == 20
+
+
+def test_download_resumes_missing_tiles(tmp_path, short_backoff):
+    image = _image()
+    output_path = tmp_path / "image.tif"
+
+    with FakeNPYTileServer(image) as server:
+        download_gee_image(image, BANDS, BOUNDS, 10, output_path, tile_pixels=16,
+                           url_fn=server.download_url_fn(BANDS))
+
+        # Lose two tiles, only those are downloaded again
+        tiles = sorted((tmp_path / "image_tiles").glob("tile_*.tif"))
+        tiles[0].unlink()
+        tiles[7].write_bytes(b"")
+        requests_before = server.requests
+
+        result = download_gee_image(image, BANDS, BOUNDS, 10, output_path, tile_pixels=16,
+                                    url_fn=server.download_url_fn(BANDS))
+
+    assert result['downloaded'] == 2
+    assert result['resumed'] == 18
+    assert server.requests - requests_before == 2
+    _check_mosaic(output_path)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from fake_ee import FakeEEClient, FakeEEException
+from UHI.raster_spectral.fishnet_2024_summer import sample_gee_rasters_at_centroids
+from UHI.raster_spectral.sampling_checkpoint import SamplingCheckpoint, missing_batches
+from UHI.regular_grid import RegularGrid
+
+
+def _ndvi(x, y):
+    return round((x % 300) / 300 + (y % 90) / 900, 6)
+
+
+@pytest.fixture
+def grid_file(tmp_path):
+    grid = RegularGrid(600000, 5600000, 30, 12, 10, crs="EPSG:25832")
+    path = tmp_path / "grid.gpkg"
+    grid.to_geodataframe().to_file(path, driver="GPKG")
+    return grid, path
+
+
+class FailingAfter(FakeEEClient):
+    """FakeEEClient whose requests fail for good (not transient) after the first n"""
+
+    def __init__(self, n, **kwargs):
+        super().__init__(**kwargs)
+        self.n = n
+
+    def _request(self, compute):
+        if self.requests >= self.n:
+            self.requests += 1
+            raise FakeEEException("Image.load: Image asset not found.")
+        return super()._request(compute)
+
+
+def test_missing_batches_splits_runs_of_missing_cells():
+    done = np.zeros(10, dtype=bool)
+    done[3:5] = True
+    done[9] = True
+
+    assert missing_batches(done, 2) == [(0, 2), (2, 3), (5, 7), (7, 9)]
+    assert missing_batches(np.ones(4, dtype=bool), 2) == []
+
+
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint = SamplingCheckpoint(tmp_path, "asset", "NDVI", "grid", 30)
+    checkpoint.save_batch(0, 2, [{'properties': {'cell_id': 0, 'NDVI': 0.1}}])
+    checkpoint.save_batch(2, 5, [])
+
+    # A new instance with the same key sees the batches, a different key doesn't
+    assert SamplingCheckpoint(tmp_path, "asset", "NDVI", "grid", 30).load_batches() == [
+        (0, 2, [{'properties': {'cell_id': 0, 'NDVI': 0.1}}]),
+        (2, 5, [])
+    ]
+    assert SamplingCheckpoint(tmp_path, "asset", "NDVI", "grid", 10).load_batches() == []
+
+
+def test_sampling_resumes_from_checkpoint(tmp_path, grid_file, short_backoff):
+    grid, grid_path = grid_file
+    checkpoint_dir = tmp_path / "checkpoints"
+    output_path = tmp_path / "out" / "fishnet.gpkg"
+
+    # First run dies after 3 of the 6 batches
+    client = FailingAfter(3, latency=0)
+    first = sample_gee_rasters_at_centroids(grid_path, {'NDVI': client.Image({'NDVI': _ndvi})}, output_path,
+                                            _batch_size=20, grid=grid, ee_client=client,
+                                            checkpoint_dir=checkpoint_dir)
+
+    assert first.attrs['sampling_metadata']['failed_rasters'] == ['NDVI']
+    assert first['NDVI'].notna().sum() == 60
+
+    # Second run only requests the 3 missing batches and fills every cell
+    client = FakeEEClient(latency=0)
+    second = sample_gee_rasters_at_centroids(grid_path, {'NDVI': client.Image({'NDVI': _ndvi})}, output_path,
+                                             _batch_size=20, grid=grid, ee_client=client,
+                                             checkpoint_dir=checkpoint_dir)
+
+    assert client.requests == 3
+    assert second.attrs['sampling_metadata']['failed_rasters'] == []
+    assert second.attrs['sampling_metadata']['rasters']['NDVI']['cells_from_checkpoint'] == 60
+
+    x_index, y_index = RegularGrid.parse_cell_ids(second['cell_id'])
+    x, y = grid.cell_centroid(x_index, y_index)
+    np.testing.assert_allclose(second['NDVI'], [_ndvi(a, b) for a, b in zip(x, y)])
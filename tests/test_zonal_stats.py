@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from UHI.raster_spectral import zonal_stats
+from UHI.raster_spectral.zonal_stats import ZONAL_STATS, zonal_stats_by_cell
+from UHI.regular_grid import RegularGrid
+
+HEIGHT, WIDTH = 203, 157
+TRANSFORM = from_origin(600000, 5602030, 10, 10)
+
+
+@pytest.fixture(scope="module")
+def raster(tmp_path_factory):
+    data = np.random.default_rng(1).random((2, HEIGHT, WIDTH)).astype('float32')
+    data[0, 5:9, 3:50] = np.nan
+
+    path = tmp_path_factory.mktemp("zonal") / "raster.tif"
+    with rasterio.open(path, 'w', driver='GTiff', height=HEIGHT, width=WIDTH, count=2, dtype='float32',
+                       nodata=np.nan, transform=TRANSFORM, crs='EPSG:25832') as dst:
+        dst.write(data)
+        dst.set_band_description(1, 'NDVI')
+
+    return path, data
+
+
+@pytest.fixture
+def pending_peak(monkeypatch):
+    """Largest number of pixel values held for the median after a flush"""
+
+    peak = {'values': 0}
+    flush = zonal_stats._CellAccumulator.flush
+
+    def _flush(self, finished=None):
+        flush(self, finished)
+        peak['values'] = max(peak['values'], len(self.pending_labels))
+
+    monkeypatch.setattr(zonal_stats._CellAccumulator, "flush", _flush)
+    return peak
+
+
+def _expected(grid, data, band):
+    """Per-cell statistics of one band with a pandas groupby over all pixels"""
+
+    cols, rows = np.meshgrid(np.arange(WIDTH) + 0.5, np.arange(HEIGHT) + 0.5)
+    x, y = TRANSFORM * (cols, rows)
+    i, j = grid.point_to_cell(x, y)
+    labels = np.where(i >= 0, grid.flat_index(i, j), -1)
+
+    valid = (labels >= 0) & ~np.isnan(data[band])
+    groups = pd.Series(data[band][valid].astype(float)).groupby(labels[valid])
+
+    return groups.agg(['mean', 'median', 'min', 'max', 'count']).reindex(range(grid.n_cells))
+
+
+def test_default_stats_include_the_median():
+    assert 'median' in ZONAL_STATS
+
+
+@pytest.mark.parametrize("grid", [
+    RegularGrid(600000, 5600000, 30, 53, 68),
+    # Origin off the pixel lattice, and cells that are not a whole number of pixels
+    RegularGrid(600013, 5600007, 30, 50, 66),
+    RegularGrid(600000, 5600000, 25, 60, 80),
+])
+def test_streamed_median_matches_groupby(raster, pending_peak, grid):
+    path, data = raster
+
+    result = zonal_stats_by_cell(path, grid, window_rows=40)
+
+    for band, name in enumerate(['NDVI', 'band_2']):
+        expected = _expected(grid, data, band)
+        for stat in ('mean', 'median', 'min', 'max'):
+            np.testing.assert_allclose(result[f"{name}_{stat}"], expected[stat], equal_nan=True)
+        np.testing.assert_array_equal(result[f"{name}_count"], expected['count'].fillna(0))
+
+    # Windows are cut at cell rows, so no values are carried over from one window to the next
+    assert pending_peak['values'] == 0
+
+
+def test_polygon_grid_median_does_not_depend_on_windows(raster, pending_peak):
+    path, _ = raster
+    cells = RegularGrid(600013, 5600007, 30, 50, 66).to_geodataframe()
+
+    streamed = zonal_stats_by_cell(path, cells, window_rows=40)
+    streamed_peak = pending_peak['values']
+    whole = zonal_stats_by_cell(path, cells, window_rows=HEIGHT)
+
+    pd.testing.assert_frame_equal(streamed, whole)
+    # Only the cells straddling a window edge are carried over
+    assert 0 < streamed_peak < 2 * 50 * 9